@@ -0,0 +1,312 @@
+import numpy as np
+from pathlib import Path
+from natsort import natsorted
+from hdmf.common import DynamicTable, VectorData
+from pynwb import TimeSeries
+from pynwb.behavior import Position, CompassDirection
+from pynwb.ecephys import SpikeEventSeries
+
+from buffalonwb.add_raw_nlx_data import _CSC_HEADER_SIZE, check_num_records, parse_header, read_csc_records
+from buffalonwb.exceptions import UnexpectedInputException
+
+
+# Event (.nev) records: TTL inputs and event strings
+_NEV_RECORD_DTYPE = np.dtype([('nstx', '<i2'),
+                              ('packet_id', '<i2'),
+                              ('packet_data_size', '<i2'),
+                              ('timestamp', '<u8'),  # microseconds
+                              ('event_id', '<i2'),
+                              ('ttl', '<u2'),
+                              ('crc', '<i2'),
+                              ('dummy1', '<i2'),
+                              ('dummy2', '<i2'),
+                              ('extra', '<i4', (8, )),
+                              ('event_string', 'S128')])  # null-terminated
+
+# Video tracking (.nvt) records: the extracted position and head direction of each video frame
+_NVT_RECORD_DTYPE = np.dtype([('swstx', '<u2'),
+                              ('swid', '<u2'),
+                              ('swdata_size', '<u2'),
+                              ('timestamp', '<u8'),  # microseconds
+                              ('points', '<u4', (400, )),  # bit-packed colored pixels
+                              ('crc', '<i2'),
+                              ('x', '<i4'),  # pixels, 0 if no target was found
+                              ('y', '<i4'),
+                              ('angle', '<i4'),  # degrees
+                              ('targets', '<i4', (50, ))])
+
+# Tetrode (.ntt) records: one spike waveform on 4 channels
+_NTT_SAMPLES_PER_SPIKE = 32
+_NTT_RECORD_DTYPE = np.dtype([('timestamp', '<u8'),  # microseconds
+                              ('acq_entity', '<u4'),
+                              ('cell_number', '<u4'),
+                              ('features', '<u4', (8, )),
+                              ('samples', '<i2', (_NTT_SAMPLES_PER_SPIKE, 4))])  # (sample, channel)
+
+# the FileType entry of the header of each file type
+_NLX_FILE_TYPES = {'.nev': 'Event', '.nvt': 'Video', '.ntt': 'Spike'}
+_NLX_RECORD_DTYPES = {'.nev': _NEV_RECORD_DTYPE, '.nvt': _NVT_RECORD_DTYPE, '.ntt': _NTT_RECORD_DTYPE}
+
+
+def add_nlx_records(nwbfile, raw_nlx_path, csc_directory):
+    """Add the events (.nev), video tracking (.nvt) and tetrode spikes (.ntt) recorded with the CSC files.
+
+    The times are in seconds relative to the first CSC record, like the raw ElectricalSeries, since all the files of a
+    session share the Cheetah clock. The electrodes table of nwbfile must have one row per CSC file, see
+    conversion_module.add_electrodes.
+
+    Parameters
+    ----------
+    nwbfile : NWBFile
+        The NWB file to add the data to.
+    raw_nlx_path : Path
+        Path for directory of raw NLX files.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files.
+
+    """
+    raw_nlx_path = Path(raw_nlx_path)
+    first_record = read_csc_records(csc_directory.data_paths[0], num_records=csc_directory.num_records[0])[0]
+    t0_us = int(first_record['timestamp'])
+
+    for nev_file_path in natsorted(raw_nlx_path.glob('*.nev')):
+        print('adding events from %s...' % nev_file_path.name)
+        add_nlx_events(nwbfile, nev_file_path, t0_us)
+    for nvt_file_path in natsorted(raw_nlx_path.glob('*.nvt')):
+        print('adding video tracking from %s...' % nvt_file_path.name)
+        add_nlx_position(nwbfile, nvt_file_path, t0_us)
+    for ntt_file_path in natsorted(raw_nlx_path.glob('*.ntt')):
+        print('adding tetrode spikes from %s...' % ntt_file_path.name)
+        header, _ = read_nlx_file(ntt_file_path)
+        electrodes = nwbfile.create_electrode_table_region(
+            region=get_ntt_electrode_indices(header, csc_directory),
+            description='tetrode channels of %s' % ntt_file_path.name
+        )
+        add_nlx_spikes(nwbfile, ntt_file_path, electrodes, t0_us)
+
+
+def add_nlx_events(nwbfile, nev_file_path, t0_us):
+    """Add the TTL values and the event strings of a .nev file to nwbfile.
+
+    The TTL values are added to the acquisition as a TimeSeries. The event strings are added as an EventsTable with
+    timestamp and event_string columns: the EventsTable of the NWB core if pynwb has it, otherwise that of the
+    ndx-events extension if it is installed. Without either, they are added to the acquisition as a DynamicTable with
+    the same columns.
+
+    Parameters
+    ----------
+    nwbfile : NWBFile
+        The NWB file to add the data to.
+    nev_file_path : Path
+        Path of the .nev file.
+    t0_us : int
+        Timestamp in microseconds of time 0 of the NWB file.
+
+    """
+    _, records = read_nlx_file(nev_file_path)
+    timestamps = get_nlx_times(records, t0_us)
+    stem = Path(nev_file_path).stem
+    nwbfile.add_acquisition(TimeSeries(
+        name='TTL' + stem,
+        data=records['ttl'],
+        unit='n/a',
+        timestamps=timestamps,
+        description='value of the TTL input port at each event of %s' % Path(nev_file_path).name
+    ))
+
+    try:  # the events table of ndx-events was added to the NWB core in pynwb 4
+        from pynwb.event import EventsTable, TimestampVectorData
+    except ImportError:
+        try:
+            from ndx_events import EventsTable, TimestampVectorData
+        except ImportError:
+            EventsTable = None
+    event_strings = VectorData(name='event_string',
+                               description='event string of each event',
+                               data=np.char.decode(records['event_string'], 'latin-1').tolist())
+    description = 'event strings of %s' % Path(nev_file_path).name
+    if EventsTable is None:
+        nwbfile.add_acquisition(DynamicTable(
+            name='EventStrings' + stem,
+            description=description,
+            columns=[VectorData(name='timestamp', description='time of each event, in seconds', data=timestamps),
+                     event_strings]
+        ))
+        return
+    events = EventsTable(
+        name='EventStrings' + stem,
+        description=description,
+        source_description='Neuralynx Cheetah',
+        columns=[TimestampVectorData(name='timestamp', description='time of each event, in seconds', data=timestamps),
+                 event_strings]
+    )
+    if hasattr(nwbfile, 'add_events_table'):
+        nwbfile.add_events_table(events)
+    else:  # the NWBFile of pynwb has no events group before the core EventsTable
+        nwbfile.add_acquisition(events)
+
+
+def add_nlx_position(nwbfile, nvt_file_path, t0_us):
+    """Add the position and head direction extracted from a .nvt file to the acquisition of nwbfile.
+
+    The position is NaN in the frames where the tracker found no target, which Cheetah writes as (0, 0).
+
+    Parameters
+    ----------
+    nwbfile : NWBFile
+        The NWB file to add the data to.
+    nvt_file_path : Path
+        Path of the .nvt file.
+    t0_us : int
+        Timestamp in microseconds of time 0 of the NWB file.
+
+    """
+    _, records = read_nlx_file(nvt_file_path)
+    timestamps = get_nlx_times(records, t0_us)
+    stem = Path(nvt_file_path).stem
+
+    xy = np.column_stack([records['x'], records['y']]).astype(np.float32)
+    xy[(records['x'] == 0) & (records['y'] == 0)] = np.nan
+    position = Position(name='NlxPosition' + stem)
+    position.create_spatial_series(
+        name='SpatialSeries',
+        data=xy,
+        reference_frame='video frame, origin at the top left corner',
+        unit='pixels',
+        timestamps=timestamps,
+        description='position extracted by Cheetah from the video tracking of %s' % Path(nvt_file_path).name
+    )
+    nwbfile.add_acquisition(position)
+
+    direction = CompassDirection(name='NlxHeadDirection' + stem)
+    direction.create_spatial_series(
+        name='SpatialSeries',
+        data=records['angle'],
+        reference_frame='video frame',
+        unit='degrees',
+        timestamps=position['SpatialSeries'],  # link, the timestamps are stored once
+        description='head direction extracted by Cheetah from the video tracking of %s' % Path(nvt_file_path).name
+    )
+    nwbfile.add_acquisition(direction)
+
+
+def add_nlx_spikes(nwbfile, ntt_file_path, electrodes, t0_us):
+    """Add the spike waveforms of a .ntt file to the acquisition of nwbfile as a SpikeEventSeries.
+
+    The waveforms are stored as int16 with the ADBitVolts conversion of the header if it is the same on all 4
+    channels, and as float32 volts otherwise.
+
+    Parameters
+    ----------
+    nwbfile : NWBFile
+        The NWB file to add the data to.
+    ntt_file_path : Path
+        Path of the .ntt file.
+    electrodes : DynamicTableRegion
+        The electrodes of the 4 tetrode channels, see get_ntt_electrode_indices.
+    t0_us : int
+        Timestamp in microseconds of time 0 of the NWB file.
+
+    """
+    header, records = read_nlx_file(ntt_file_path)
+    # (spike, sample, channel) to the (spike, channel, sample) order of SpikeEventSeries, as a view of the file
+    data = records['samples'].transpose(0, 2, 1)
+    bit_volts = np.atleast_1d(header['ADBitVolts'])
+    if np.all(bit_volts == bit_volts[0]):
+        conversion = float(bit_volts[0])
+    else:
+        data = data * bit_volts.astype(np.float32)[:, np.newaxis]
+        conversion = 1.
+    nwbfile.add_acquisition(SpikeEventSeries(
+        name='SpikeEvents' + Path(ntt_file_path).stem,
+        data=data,
+        timestamps=get_nlx_times(records, t0_us),
+        electrodes=electrodes,
+        conversion=conversion,
+        description='spike waveforms detected by Cheetah, %d samples at %s Hz aligned on sample %s'
+                    % (_NTT_SAMPLES_PER_SPIKE, header.get('SamplingFrequency'), header.get('AlignmentPt'))
+    ))
+
+
+def get_ntt_electrode_indices(header, csc_directory):
+    """Get the indices of the CSC files recorded from the same AD channels as a tetrode.
+
+    Parameters
+    ----------
+    header : dict
+        Header of the .ntt file, see read_nlx_file.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files.
+
+    Returns
+    -------
+    list of int
+        The index of the CSC file of each tetrode channel, in order.
+
+    Raises
+    ------
+    UnexpectedInputException
+        if an AD channel of the tetrode was not recorded in a CSC file.
+
+    """
+    csc_indices = {csc_header['ADChannel']: i for i, csc_header in enumerate(csc_directory.headers)}
+    indices = list()
+    for ad_channel in np.atleast_1d(header['ADChannel']):
+        if ad_channel not in csc_indices:
+            raise UnexpectedInputException('AD channel %d of the tetrode %s was not recorded in a CSC file.'
+                                           % (ad_channel, header.get('AcqEntName')))
+        indices.append(csc_indices[ad_channel])
+    return indices
+
+
+def get_nlx_times(records, t0_us):
+    """Get the times of the records in seconds relative to the timestamp t0_us in microseconds."""
+    return (records['timestamp'].astype(np.int64) - t0_us) / 1e6
+
+
+def read_nlx_file(file_path, allow_partial=False):
+    """Read the header of a Neuralynx .nev, .nvt or .ntt file and memory-map its records as a structured array.
+
+    The header is parsed like a CSC header (see parse_header) without checking its keys, but its FileType and
+    RecordSize must match the file extension. No data is read until a field is accessed, and fields are views into
+    the file.
+
+    Parameters
+    ----------
+    file_path : Path
+        Path of the file.
+    allow_partial : bool
+        Whether to allow a partially written last record, e.g. while Cheetah is still recording. It is not mapped.
+
+    Returns
+    -------
+    tuple
+        The header metadata as a dict, and the records as a np.memmap of _NEV_RECORD_DTYPE, _NVT_RECORD_DTYPE or
+        _NTT_RECORD_DTYPE.
+
+    Raises
+    ------
+    UnexpectedInputException
+        if the file type or the record size in the header do not match the file extension, or if the file size is not
+        compatible with an integer number of records.
+
+    """
+    file_path = Path(file_path)
+    extension = file_path.suffix.lower()
+    if extension not in _NLX_RECORD_DTYPES:
+        raise ValueError('Neuralynx file must be one of %s: %s' % (', '.join(_NLX_RECORD_DTYPES), file_path))
+    record_dtype = _NLX_RECORD_DTYPES[extension]
+
+    with open(file_path, 'rb') as data_file:
+        header = parse_header(data_file.read(_CSC_HEADER_SIZE), expected_keys=None)
+    if header.get('FileType') != _NLX_FILE_TYPES[extension]:
+        raise UnexpectedInputException('Expected FileType %s in the header of %s: %s'
+                                       % (_NLX_FILE_TYPES[extension], file_path, header.get('FileType')))
+    if header.get('RecordSize') != record_dtype.itemsize:
+        raise UnexpectedInputException('Expected RecordSize %d in the header of %s: %s'
+                                       % (record_dtype.itemsize, file_path, header.get('RecordSize')))
+
+    num_records = check_num_records(file_path, allow_partial=allow_partial, record_size=record_dtype.itemsize)
+    if num_records == 0:  # an empty range cannot be mapped
+        return header, np.zeros(0, dtype=record_dtype)
+    return header, np.memmap(file_path, dtype=record_dtype, mode='r', offset=_CSC_HEADER_SIZE, shape=(num_records, ))
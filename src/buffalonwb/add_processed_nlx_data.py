@@ -3,33 +3,74 @@ import h5py
 from pynwb.ecephys import ElectricalSeries, LFP
 import numpy as np
 import os
-from hdmf.data_utils import DataChunkIterator
-from buffalonwb.exceptions import UnexpectedInputException
-from tqdm import trange
+from pathlib import Path
+from warnings import warn
+from hdmf.data_utils import DataChunkIterator, GenericDataChunkIterator
+from buffalonwb.compression import get_dataio
+from buffalonwb.exceptions import InconsistentInputException, UnexpectedInputException
+from buffalonwb.utils import ordered_prefetch
+from tqdm import tqdm
 import natsort
 
 
-def add_lfp(nwbfile, lfp_path, electrodes, iterator_flag, all_electrode_labels):
-    num_electrodes = len(all_electrode_labels)
-    if iterator_flag:
+# storage types of the LFP. int16 is scaled by a conversion computed from the range of the LFP
+LFP_DTYPES = ('float64', 'float32', 'int16')
+# value of the NaN values of the LFP in int16 storage
+LFP_INT16_NAN_FILL = 0
+
+
+def add_lfp(nwbfile, lfp_path, electrodes, iterator_flag, all_electrode_labels, chunk_shape=None, compression=None,
+            compression_level=None, shuffle=False, backend='hdf5', dtype='float64', scaling='global', num_workers=None,
+            iterator='block', buffer_mb=256.):
+    if iterator not in ('block', 'channel'):
+        raise ValueError("LFP iterator must be 'block' or 'channel': %s" % iterator)
+    if dtype not in LFP_DTYPES:
+        raise ValueError('LFP dtype must be one of %s: %s' % (', '.join(LFP_DTYPES), dtype))
+    if scaling not in ('global', 'channel'):
+        raise ValueError("LFP scaling must be 'global' or 'channel': %s" % scaling)
+    lfp_directory = LfpDirectory(lfp_path)
+
+    # only the electrodes with a processed file are stored, instead of filling the other columns with NaN
+    channel_names = [x for x in all_electrode_labels if lfp_directory.get_data_path(x) is not None]
+    if not channel_names:
+        raise UnexpectedInputException('No processed file in %s matches an electrode label.' % lfp_directory.path)
+    if len(channel_names) < len(all_electrode_labels):
+        electrodes = nwbfile.create_electrode_table_region(
+            region=[electrodes.data[i] for i, x in enumerate(all_electrode_labels) if x in channel_names],
+            description='the electrodes with LFP'
+        )
+
+    scales = None
+    if dtype == 'int16':
+        scales = get_lfp_scales(lfp_directory, channel_names, scaling=scaling, num_workers=num_workers)
+    if iterator_flag and iterator == 'block':
+        print('Adding LFP using time block data chunk iterator')
+        lfp_data = LfpDataChunkIterator(lfp_directory=lfp_directory, channel_names=channel_names, dtype=dtype,
+                                        scales=scales, buffer_mb=buffer_mb, chunk_shape=chunk_shape,
+                                        num_workers=num_workers)
+    elif iterator_flag:
         print('Adding LFP using data chunk iterator')
-        lfp, lfp_timestamps, lfp_rate = get_lfp_data(num_electrodes=1,
-                                                     lfp_path=lfp_path,
-                                                     all_electrode_labels=all_electrode_labels)
-        lfp_gen = lfp_generator(lfp_path=lfp_path, num_electrodes=num_electrodes,
-                                all_electrode_labels=all_electrode_labels)
-        lfp_data = DataChunkIterator(data=lfp_gen, iter_axis=1)
+        lfp_gen = lfp_generator(lfp_directory=lfp_directory, channel_names=channel_names, dtype=dtype, scales=scales,
+                                num_workers=num_workers)
+        lfp_data = DataChunkIterator(data=lfp_gen, iter_axis=1, dtype=np.dtype(dtype),
+                                     maxshape=(lfp_directory.num_samples, len(channel_names)))
     else:
         print('Adding LFP')
-        lfp_data, lfp_timestamps, lfp_rate = get_lfp_data(num_electrodes=num_electrodes,
-                                                          lfp_path=lfp_path,
-                                                          all_electrode_labels=all_electrode_labels)
+        lfp_data = get_lfp_data(lfp_directory=lfp_directory, channel_names=channel_names, dtype=dtype, scales=scales,
+                                num_workers=num_workers)
+
+    lfp_data = get_dataio(lfp_data, backend=backend, chunk_shape=chunk_shape, compression=compression,
+                          compression_level=compression_level, shuffle=shuffle)
 
-    lfp_timestamps_sq = np.squeeze(lfp_timestamps)
-    # if 1/(lfp_timestamps_sq[1]-lfp_timestamps_sq[0]) !=lfp_rate:
-    #     print("not equal to rate!!")
-    #     print(str(lfp_timestamps_sq[1]-lfp_timestamps_sq[0]))
-    #     print(str(lfp_rate))
+    # with a global scaling, the scale is the same for all channels
+    conversion_kwargs = dict()
+    if scales is not None:
+        conversion_kwargs.update(comments='NaN values of the processed LFP are stored as %d in the int16 data.'
+                                          % LFP_INT16_NAN_FILL)
+    if scales is not None and scaling == 'global':
+        conversion_kwargs.update(conversion=float(scales[0]))
+    elif scales is not None:
+        conversion_kwargs.update(channel_conversion=scales.tolist())
 
     # time x 120
     # add the lfp metadata - some in the lab metadata and some in the electrical series
@@ -37,9 +78,10 @@ def add_lfp(nwbfile, lfp_path, electrodes, iterator_flag, all_electrode_labels):
         name='ElectricalSeries',
         data=lfp_data,
         electrodes=electrodes,
-        #starting_time=float(lfp_timestamps_sq[0]),
-        rate=lfp_rate,
-        description="LFP"
+        #starting_time=float(lfp_directory.first_timestamps[0]),
+        rate=lfp_directory.rate,
+        description="LFP",
+        **conversion_kwargs
     )
 
     proc_module = nwbfile.create_processing_module(
@@ -52,74 +94,274 @@ def add_lfp(nwbfile, lfp_path, electrodes, iterator_flag, all_electrode_labels):
     proc_module.add(lfp)
 
 
-# FUNCTIONS FOR PROCESSED DATA
-# no input checking for now
-# add back input checking soon #FIXTHIS
+class LfpDirectory:
+    """Directory of processed *_ex.mat files, indexed once from the metadata of each file.
+
+    The channel name (chname), number of LFP samples, LFP rate, first LFP timestamp and LFP dtype of each file are read
+    without reading the LFP itself, see NlxMatFile. The files are mapped to electrodes by channel name.
+
+    Parameters
+    ----------
+    lfp_path : Path
+        Path of directory of processed *_ex.mat files.
+
+    Raises
+    ------
+    UnexpectedInputException
+        if the directory has no *_ex.mat files.
+    InconsistentInputException
+        if two files have the same channel name, or if the files have different numbers of LFP samples or rates.
+
+    """
+
+    def __init__(self, lfp_path):
+        self.path = Path(lfp_path)
+        self.data_paths = natsort.natsorted(self.path.glob('*_ex.mat'))
+        if not self.data_paths:
+            raise UnexpectedInputException('No processed *_ex.mat files in %s' % self.path)
+
+        index = [self._index_file(data_path) for data_path in self.data_paths]
+        self.channel_names = [channel_name for channel_name, _, _, _, _ in index]
+        self.first_timestamps = [first_timestamp for _, _, _, first_timestamp, _ in index]
+        self.dtypes = [dtype for _, _, _, _, dtype in index]
+
+        self._file_indices = {channel_name: i for i, channel_name in enumerate(self.channel_names)}
+        if len(self._file_indices) != len(self.channel_names):
+            raise InconsistentInputException('Processed files in %s have duplicate channel names: %s'
+                                             % (self.path, self.channel_names))
+        for name, values in (('numbers of LFP samples', [num_samples for _, num_samples, _, _, _ in index]),
+                             ('LFP rates', [rate for _, _, rate, _, _ in index])):
+            if len(set(values)) != 1:
+                raise InconsistentInputException('Processed files in %s have different %s: %s'
+                                                 % (self.path, name, values))
+        self.num_samples = index[0][1]
+        self.rate = index[0][2]
+
+    @staticmethod
+    def _index_file(data_path):
+        with NlxMatFile(data_path) as nlx_file:
+            lfp = nlx_file['lfp']
+            if lfp.ndim != 2 or lfp.shape[0] != 1:
+                raise UnexpectedInputException('LFP of %s must have shape (1, num_samples): %s'
+                                               % (data_path, lfp.shape))
+            return (nlx_file.get_string('chname'), lfp.shape[1], nlx_file.get_scalar('lfpfq'),
+                    nlx_file['lfpts'][0, 0], lfp.dtype)
+
+    def __len__(self):
+        return len(self.data_paths)
+
+    def get_data_path(self, channel_name):
+        """Get the path of the file of a channel, e.g. 'CSC1', or None if the channel has no file."""
+        i = self._file_indices.get(channel_name)
+        return None if i is None else self.data_paths[i]
+
+
+class NlxMatFile:
+    """Processed *_ex.mat file (MATLAB v7.3, i.e. HDF5), opened lazily.
+
+    Fields are returned as h5py datasets, so only the fields and hyperslabs that are indexed are read from disk, e.g.
+    nlx_file['lfp'][0, start:stop] reads a time window of the LFP without the spike waveforms. MATLAB stores arrays
+    transposed, so the LFP is a (1, num_samples) dataset. Use as a context manager to close the file when done.
+
+    Parameters
+    ----------
+    nlx_file_name : str or Path
+        Path of the *_ex.mat file.
+
+    """
+
+    def __init__(self, nlx_file_name):
+        self.path = Path(nlx_file_name)
+        self._file = h5py.File(self.path, 'r')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def __getitem__(self, field):
+        """Get the h5py dataset of a field, e.g. 'lfp' or 'params/n_std'. No data is read."""
+        return self._file[field]
+
+    def get_scalar(self, field):
+        """Read a scalar field, stored by MATLAB as a (1, 1) array."""
+        return check_get_scalar(self._file[field][()])
+
+    def get_string(self, field):
+        """Read a string field, stored by MATLAB as an array of character codes."""
+        return ''.join(map(chr, self._file[field][()].ravel()))
+
+    def read_lfp(self, start=0, stop=None):
+        """Read samples start to stop of the LFP as a 1D array."""
+        return self._file['lfp'][0, start:stop]
+
 
 # process nlx mat file into dictionary
 # needs: data, timestamps, resolution, time, rate
-def MH_process_nlx_mat_file(nlx_file_name):
+_NLX_MAT_FIELDS = {
+    'Fs': lambda f: f.get_scalar('Fs'),  # raw sampling frequency
+    'first_ts': lambda f: f.get_scalar('firstts'),  # first timestamp in raw data
+    'lfp_Fs': lambda f: f.get_scalar('lfpfq'),  # lfp sampling frequency, should be same as value in params.lfpfq
+    'lfp': lambda f: f['lfp'][()],  # lfp values -- units?
+    'lfp_ts': lambda f: f['lfpts'][()],  # lfp timestamps, num columns should match num columns of lfp
+    'first_lfp_ts': lambda f: f['lfpts'][0, 0],
+    'spk_ts': lambda f: f['spkts'][()],  # spike times
+    'spk_wfs': lambda f: f['spkwv'][()],  # spike waveforms
+    # preprocessing parameters
+    'n_std': lambda f: f.get_scalar('params/n_std'),  # standard deviations used for thresholding
+    'rawspk': lambda f: f.get_scalar('params/rawspk'),  # ??? 0 in sample file
+    'resamp': lambda f: f.get_scalar('params/resamp'),  # ??? 1 in sample file
+    'saveupsamp': lambda f: f.get_scalar('params/saveupsamp'),  # ??? 0 in sample file
+    'spkfq': lambda f: f.get_scalar('params/spkfq'),  # ??? 400 in sample file
+    # i'm guessing spkbuff specifies num samples before threshold crossing and num samples after threshold
+    'spk_buff': lambda f: f['params/spkbuff'][()].transpose()[0].tolist(),
+}
+
+
+def MH_process_nlx_mat_file(nlx_file_name, fields=None):
+    """Read fields of a processed *_ex.mat file into a dictionary.
+
+    Only the requested fields are read, e.g. fields=('lfp_Fs', 'first_lfp_ts') skips the LFP and the spike waveforms.
+    Use NlxMatFile directly to read hyperslabs of a field.
+
+    Parameters
+    ----------
+    nlx_file_name : str or Path
+        Path of the *_ex.mat file.
+    fields : iterable of str
+        Names of the fields to read, keys of _NLX_MAT_FIELDS. Defaults to all fields.
+
+    Returns
+    -------
+    dict
+        The fields, or an empty dict if the file does not exist.
+
+    """
     # for some reason files 7-9 don't exist
     # as a stop gap we'll skip them
     # FIXTHIS
-    if os.path.exists(nlx_file_name):
-        nlx_file = h5py.File(nlx_file_name, 'r')
-    else:
-        msg = 'skipped ' + str(nlx_file_name + ', returning empty dict')
+    if not os.path.exists(nlx_file_name):
+        msg = 'skipped ' + str(nlx_file_name) + ', returning empty dict'
         print(msg)
         return dict()
 
-    # raw sampling frequency
-    Fs = check_get_scalar(nlx_file['Fs'][()])
+    with NlxMatFile(nlx_file_name) as nlx_file:
+        return {field: _NLX_MAT_FIELDS[field](nlx_file) for field in (fields or _NLX_MAT_FIELDS)}
 
-    # first timestamp in raw data
-    first_ts = check_get_scalar(nlx_file['firstts'][()])
 
-    # lfp sampling frequency, should be same as value in params.lfpfq
-    lfp_Fs = check_get_scalar(nlx_file['lfpfq'][()])
+class LfpDataChunkIterator(GenericDataChunkIterator):
+    """Data chunk iterator that reads aligned time blocks of the LFP from all processed files at once.
 
-    # lfp values -- units?
-    lfp = nlx_file['lfp'][()]
+    All files are kept open, and each buffer is a (time block x all channels) array read from matching hyperslabs of
+    the 'lfp' dataset of each file and converted to the storage dtype (see convert_lfp). The (time, channel) dataset is
+    then written in chunks spanning all channels, so that reading a short window of all channels reads few chunks, and
+    memory use is bounded by buffer_mb regardless of the session length. The files are closed after the last buffer.
 
-    # lfp timestamps, num columns should match num columns of lfp
-    lfp_ts = nlx_file['lfpts'][()]
-    lfp_ts = nlx_file['lfpts'][()]
+    With num_workers, the hyperslabs are instead read and converted by a pool of processes, since h5py serializes
+    reads within a process. Each process opens the file of the hyperslab it reads, and at most num_workers hyperslabs
+    are read ahead of the one being consumed, across buffers. The buffers must then be read in order.
 
-    # check lfp_ts, then keep only starting time (first_lfp_ts) and rate (lfp_Fs)
-    diff_lfp_ts = np.diff(lfp_ts)
-    first_lfp_ts = lfp_ts[0][0]
+    Parameters
+    ----------
+    lfp_directory : LfpDirectory
+        The indexed directory of processed files.
+    channel_names : list of str
+        The channels, in order, which must have a processed file.
+    dtype : str
+        Storage type of the LFP, one of LFP_DTYPES.
+    scales : np.ndarray
+        Scale of each channel, for int16, see get_lfp_scales.
+    buffer_mb : float
+        Maximum size of a buffer (time block x all channels), in MB.
+    chunk_shape : tuple
+        Shape of the HDF5 chunks. Defaults to chunks spanning all channels and ~chunk_mb MB.
+    chunk_mb : float
+        Size of the default HDF5 chunks, in MB.
+    display_progress : bool
+        Whether to display a progress bar over the buffers.
+    num_workers : int
+        Number of processes reading hyperslabs concurrently. Defaults to reading them one after the other.
 
-    # get spike times
-    spk_ts = nlx_file['spkts'][()]
+    """
 
-    # get spike waveforms
-    spk_wfs = nlx_file['spkwv'][()]
+    def __init__(self, lfp_directory, channel_names, dtype='float64', scales=None, buffer_mb=256., chunk_shape=None,
+                 chunk_mb=1., display_progress=True, num_workers=None):
+        self._dtype = np.dtype(dtype)
+        self.scales = scales
+        self.num_workers = num_workers
+        self._num_samples = lfp_directory.num_samples
+        self._data_paths = [lfp_directory.get_data_path(x) for x in channel_names]
+        self._files = list() if num_workers else [NlxMatFile(data_path) for data_path in self._data_paths]
+        self._hyperslabs = None
+        self._next_start = 0
 
-    # get preprocessing parameters
-    n_std = check_get_scalar(nlx_file['params']['n_std'])  # standard deviations used for thresholding
-    rawspk = check_get_scalar(nlx_file['params']['rawspk'])  # ??? 0 in sample file
-    resamp = check_get_scalar(nlx_file['params']['resamp'])  # ??? 1 in sample file
-    saveupsamp = check_get_scalar(nlx_file['params']['saveupsamp'])  # ??? 0 in sample file
-    spkfq = check_get_scalar(nlx_file['params']['spkfq'])  # ??? 400 in sample file
-    # MH- ??? what is up with this #FIXTHIS
+        num_channels = len(channel_names)
+        if chunk_shape is None:
+            chunk_time = int(chunk_mb * 1e6 // (num_channels * self._dtype.itemsize))
+            chunk_shape = (max(1, min(chunk_time, self._num_samples)), num_channels)
+        buffer_time = int(buffer_mb * 1e6 // (num_channels * self._dtype.itemsize)) // chunk_shape[0] * chunk_shape[0]
+        buffer_time = min(max(chunk_shape[0], buffer_time), self._num_samples)
 
-    # i'm guessing spkbuff specifies num samples before threshold crossing and num samples after threshold
-    spk_buff = nlx_file['params']['spkbuff'][()]
-    spk_buff = spk_buff.transpose()[0].tolist()
+        super().__init__(buffer_shape=(buffer_time, num_channels),
+                         chunk_shape=tuple(chunk_shape),
+                         display_progress=display_progress,
+                         progress_bar_options=dict(desc='Writing LFP'))
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except StopIteration:
+            self.close()
+            raise
 
-    # variables of interest
-    dict_vars = {'Fs', 'first_ts', 'lfp_Fs', 'lfp', 'lfp_ts', 'first_lfp_ts', 'spk_ts', 'spk_wfs', 'n_std', 'rawspk',
-                 'resamp', 'saveupsamp', 'spkfq', 'spk_buff'}
+    def close(self):
+        """Close the processed files, or shut down the pool of processes reading them."""
+        for nlx_file in self._files:
+            nlx_file.close()
+        if self._hyperslabs is not None:
+            self._hyperslabs.close()
+            self._hyperslabs = None
 
-    # make a dictionary
-    file_dict = dict()
-    for i in dict_vars:
-        file_dict[i] = locals()[i]
+    def _get_data(self, selection):
+        time_selection, channel_selection = selection
+        start, stop, _ = time_selection.indices(self._num_samples)
+        channels = range(len(self._data_paths))[channel_selection]
 
-    # DELETE NLX FILE TO CLEAN MEMORY
-    del nlx_file
+        data = np.empty((stop - start, len(channels)), dtype=self._dtype)
+        if self.num_workers:
+            if start != self._next_start or len(channels) != len(self._data_paths):
+                raise UnexpectedInputException('LFP buffers must be read in order with num_workers: expected the '
+                                               'buffer at sample %d of all channels.' % self._next_start)
+            if self._hyperslabs is None:
+                self._hyperslabs = _map_lfp_files(_read_lfp_hyperslab, self._get_hyperslab_items(),
+                                                  num_workers=self.num_workers)
+            for j in range(len(channels)):
+                data[:, j] = next(self._hyperslabs)
+            self._next_start = stop
+            return data
 
-    return file_dict
+        for j, ch in enumerate(channels):
+            data[:, j] = convert_lfp(self._files[ch].read_lfp(start, stop), self._dtype,
+                                     None if self.scales is None else self.scales[ch])
+        return data
+
+    def _get_hyperslab_items(self):
+        """Generate the arguments of _read_lfp_hyperslab for each channel of each buffer, in order."""
+        buffer_time = self.buffer_shape[0]
+        for start in range(0, self._num_samples, buffer_time):
+            stop = min(start + buffer_time, self._num_samples)
+            for ch, data_path in enumerate(self._data_paths):
+                yield data_path, start, stop, self._dtype, None if self.scales is None else self.scales[ch]
+
+    def _get_dtype(self):
+        return self._dtype
+
+    def _get_maxshape(self):
+        return self._num_samples, len(self._data_paths)
 
 
 def check_get_scalar(v):
@@ -130,40 +372,125 @@ def check_get_scalar(v):
     return v[0][0]
 
 
-def get_lfp_data(num_electrodes, lfp_path, all_electrode_labels):
-    all_files = natsort.natsorted(os.listdir(lfp_path))
-    processed = MH_process_nlx_mat_file(lfp_path.joinpath(all_files[0]))
-    num_ts = max(processed["lfp_ts"].shape)
-    lfp = np.full((num_ts, num_electrodes), np.nan)
-    ts = processed["lfp_ts"]
-    fs = processed["lfp_Fs"]
-    # check if ts are all the same
-    lfp_channel_names = [x[:-7] for x in all_files]
-    file_counter = 0
-    for i in trange(num_electrodes, desc='reading LFP'):
-        if all_electrode_labels[i] in lfp_channel_names:
-            file_name = lfp_path.joinpath(all_files[file_counter])
-            file_counter += 1
-            processed_file = MH_process_nlx_mat_file(file_name)
-            lfp[:, i] = processed_file["lfp"]
-
-    return lfp, ts, fs
-
-
-def lfp_generator(lfp_path, num_electrodes, all_electrode_labels):
-    all_lfp_files = natsort.natsorted(os.listdir(lfp_path))
-    lfp_channel_names = [x[:-7] for x in all_lfp_files]
-    # generate lfp data chunks
-    file_counter = 0
-    for i in trange(num_electrodes, desc='writing LFP'):
-        if all_electrode_labels[i] in lfp_channel_names:
-            file_name = lfp_path.joinpath(all_lfp_files[file_counter])
-            file_counter += 1
-            processed_data = MH_process_nlx_mat_file(file_name)
-            lfp_data = processed_data["lfp"]
-            nt = lfp_data.shape[1]
-            del processed_data
-            yield np.squeeze(lfp_data).T
-        else:
-            yield np.full((nt,), np.nan)
-    return
+def get_lfp_scales(lfp_directory, channel_names, scaling='global', block_size=1000000, num_workers=None):
+    """Get the scales of the LFP of channels stored as int16, from a streaming pass over their range.
+
+    Parameters
+    ----------
+    lfp_directory : LfpDirectory
+        The indexed directory of processed files.
+    channel_names : list of str
+        The channels, which must have a processed file.
+    scaling : str
+        'global' for the same scale for all channels, from the largest absolute value of all channels, or 'channel' for
+        a scale per channel, from the largest absolute value of each channel.
+    block_size : int
+        Number of samples read at once from each file.
+    num_workers : int
+        Number of processes scanning files concurrently. Defaults to scanning them one after the other.
+
+    Returns
+    -------
+    np.ndarray
+        The scale of each channel, i.e. the value of one int16 step.
+
+    """
+    items = [(lfp_directory.get_data_path(x), lfp_directory.num_samples, block_size) for x in channel_names]
+    max_abs = np.array(list(tqdm(_map_lfp_files(_get_lfp_max_abs, items, num_workers), total=len(items),
+                                 desc='scanning LFP range')))
+    if scaling == 'global':
+        max_abs[:] = max_abs.max()
+    scales = max_abs / np.iinfo(np.int16).max
+    scales[scales == 0] = 1.  # a flat channel
+    return scales
+
+
+def _get_lfp_max_abs(item):
+    """Get the largest absolute value of the LFP of a file, reading block_size samples at once."""
+    data_path, num_samples, block_size = item
+    max_abs = 0.
+    with NlxMatFile(data_path) as nlx_file:
+        for start in range(0, num_samples, block_size):
+            block = np.abs(nlx_file.read_lfp(start, start + block_size))
+            if not np.isnan(block).all():
+                max_abs = max(max_abs, float(np.nanmax(block)))
+    return max_abs
+
+
+def convert_lfp(lfp, dtype='float64', scale=None):
+    """Convert the LFP of a channel to its storage dtype, dividing it by its scale for int16.
+
+    int16 has no NaN, so NaN values are stored as 0 (LFP_INT16_NAN_FILL), with a warning.
+    """
+    if scale is None:
+        return lfp.astype(dtype, copy=False)
+    lfp = lfp / scale
+    nan_values = np.isnan(lfp)
+    if nan_values.any():
+        warn('%d NaN values of the LFP are stored as %d in the int16 data' % (nan_values.sum(), LFP_INT16_NAN_FILL))
+        lfp[nan_values] = LFP_INT16_NAN_FILL
+    return np.clip(np.round(lfp), np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(dtype)
+
+
+def read_lfp_channels(lfp_directory, channel_names, dtype='float64', scales=None, num_workers=None):
+    """Read and convert the LFP of channels, see convert_lfp, in order.
+
+    With num_workers, the files are decoded concurrently by a pool of processes, since h5py serializes reads within a
+    process, and at most num_workers channels are decoded ahead of the one being consumed.
+
+    Parameters
+    ----------
+    lfp_directory : LfpDirectory
+        The indexed directory of processed files.
+    channel_names : list of str
+        The channels, which must have a processed file.
+    dtype : str
+        Storage type of the LFP, one of LFP_DTYPES.
+    scales : np.ndarray
+        Scale of each channel, for int16.
+    num_workers : int
+        Number of processes decoding files concurrently. Defaults to decoding them one after the other.
+
+    Returns
+    -------
+    iterator of np.ndarray
+        The LFP of each channel, in the order of channel_names.
+
+    """
+    items = [(lfp_directory.get_data_path(x), dtype, None if scales is None else scales[i])
+             for i, x in enumerate(channel_names)]
+    return _map_lfp_files(_read_lfp_channel, items, num_workers)
+
+
+def _read_lfp_channel(item):
+    data_path, dtype, scale = item
+    with NlxMatFile(data_path) as nlx_file:
+        return convert_lfp(nlx_file.read_lfp(), dtype, scale)
+
+
+def _read_lfp_hyperslab(item):
+    data_path, start, stop, dtype, scale = item
+    with NlxMatFile(data_path) as nlx_file:
+        return convert_lfp(nlx_file.read_lfp(start, stop), dtype, scale)
+
+
+def _map_lfp_files(function, items, num_workers=None):
+    """Apply a function to items in order, in a pool of num_workers processes if set."""
+    if num_workers:
+        return ordered_prefetch(function, items, num_workers=num_workers, processes=True)
+    return map(function, items)
+
+
+def get_lfp_data(lfp_directory, channel_names, dtype='float64', scales=None, num_workers=None):
+    lfp = np.empty((lfp_directory.num_samples, len(channel_names)), dtype=dtype)
+    channels = read_lfp_channels(lfp_directory, channel_names, dtype=dtype, scales=scales, num_workers=num_workers)
+    for i, channel in enumerate(tqdm(channels, total=len(channel_names), desc='reading LFP')):
+        lfp[:, i] = channel
+
+    return lfp
+
+
+def lfp_generator(lfp_directory, channel_names, dtype='float64', scales=None, num_workers=None):
+    # generate lfp data chunks, decoded ahead of the channel being written with num_workers
+    channels = read_lfp_channels(lfp_directory, channel_names, dtype=dtype, scales=scales, num_workers=num_workers)
+    yield from tqdm(channels, total=len(channel_names), desc='writing LFP')
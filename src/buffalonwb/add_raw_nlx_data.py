@@ -1,14 +1,21 @@
+import bisect
+import tempfile
+from functools import partial
 import numpy as np
 from datetime import datetime
 from uuid import UUID
-from struct import unpack
 from warnings import warn
-from tqdm import trange
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 from natsort import natsorted
-from hdmf.data_utils import DataChunkIterator
+from hdmf.data_utils import DataChunkIterator, GenericDataChunkIterator
 from pynwb.ecephys import ElectricalSeries
 
+from buffalonwb.compression import get_dataio
 from buffalonwb.exceptions import InconsistentInputException, UnexpectedInputException
+from buffalonwb.raw_preview import RawPreview
+from buffalonwb.utils import ordered_prefetch
 
 
 _CSC_HEADER_SIZE = 16384  # bytes
@@ -16,8 +23,41 @@ _CSC_SAMPLES_PER_RECORD = 512  # int16 array
 _CSC_RECORD_HEADER_SIZE = 20  # bytes: 1 uint64 (1*8) + 3 uint32 (3*4)
 _CSC_RECORD_SIZE = _CSC_RECORD_HEADER_SIZE + _CSC_SAMPLES_PER_RECORD * 2
 
+# timestamp: Cheetah timestamp for this record. This corresponds to the sample time for the first data point in the
+#   samples array, in MICROseconds. This timestamp appears not to have any real-world meaning.
+# channel_number: The channel number for this record. This is NOT the A/D channel number.
+# sampling_frequency: The sampling frequency (Hz) for the samples array.
+# num_valid_samples: Number of values in the samples array containing valid data (max 512).
+_CSC_RECORD_DTYPE = np.dtype([('timestamp', '<u8'),
+                              ('channel_number', '<u4'),
+                              ('sampling_frequency', '<u4'),
+                              ('num_valid_samples', '<u4'),
+                              ('samples', '<h', (_CSC_SAMPLES_PER_RECORD, ))])
+assert _CSC_RECORD_DTYPE.itemsize == _CSC_RECORD_SIZE
 
-def add_raw_nlx_data(nwbfile, raw_nlx_path, electrode_table_region):
+_CSC_HEADER_KEYS = frozenset({
+    'FileType', 'FileVersion', 'FileUUID', 'SessionUUID', 'ProbeName', 'OriginalFileName', 'TimeCreated', 'TimeClosed',
+    'RecordSize', 'ApplicationName', 'ApplicationVersion', 'AcquisitionSystem', 'ReferenceChannelSource',
+    'ReferenceChannelReference', 'SamplingFrequency', 'ADMaxValue', 'ADBitVolts', 'AcqEntName', 'NumADChannels',
+    'ADChannel', 'InputRange', 'InputInverted', 'DSPLowCutFilterEnabled', 'DspLowCutFrequency', 'DspLowCutNumTaps',
+    'DspLowCutFilterType', 'DSPHighCutFilterEnabled', 'DspHighCutFrequency', 'DspHighCutNumTaps',
+    'DspHighCutFilterType', 'DspDelayCompensation', 'DspFilterDelay_µs'})
+
+# continuous segment of a recording, see find_csc_segments
+_CSC_SEGMENT_DTYPE = np.dtype([('start_sample', '<i8'),
+                               ('start_time_us', '<u8'),
+                               ('num_samples', '<i8'),
+                               ('rate', '<f8'),
+                               ('fit_start_time_us', '<f8'),
+                               ('residual_rms_us', '<f8'),
+                               ('residual_max_us', '<f8')])
+
+
+def add_raw_nlx_data(nwbfile, raw_nlx_path, electrode_table_region, raw_iterator='block', buffer_mb=1024.,
+                     chunk_shape=None, compression=None, compression_level=None, shuffle=False,
+                     compression_workers=None, index_cache=None, csc_directory=None, preallocate=False,
+                     time_range=None, channels=None, backend='hdf5', live=False, scratch_dir=None,
+                     preview_rate=None):
     """Add raw acquisition data from Neuralynx CSC .ncs files to an NWB file using a data chunk iterator
 
     Parameters
@@ -29,57 +69,617 @@ def add_raw_nlx_data(nwbfile, raw_nlx_path, electrode_table_region):
     electrode_table_region : DynamicTableRegion
         The set of electrodes corresponding to these acquisition time series data. There should be one .ncs data file
         for every electrode in the electrode_table_region.
+    raw_iterator : str
+        'block' to write aligned time blocks of all channels with CscDataChunkIterator, 'transpose' to stream each
+        channel into a scratch file first with CscTransposeDataChunkIterator, or 'channel' to write one whole channel
+        at a time with raw_generator.
+    buffer_mb : float
+        Size of the time blocks read from all channels at once, in MB. With raw_iterator 'transpose', the RAM
+        ceiling of the transpose. Not used when raw_iterator is 'channel'.
+    chunk_shape : tuple
+        Shape of the HDF5 chunks of the (time, channel) dataset.
+    compression : str
+        Compression codec of the dataset, one of buffalonwb.compression.COMPRESSION_CODECS, or None.
+    compression_level : int
+        Compression level.
+    shuffle : bool
+        Whether to shuffle bytes before compression.
+    compression_workers : int
+        If set, the dataset is only preallocated here. After the NWB file is written, fill it with
+        buffalonwb.write_raw_nlx_data.write_raw_nlx_data_parallel, which compresses chunks with this many workers.
+        Only gzip compression is supported in this mode. With the Zarr backend, fill it with
+        buffalonwb.write_raw_nlx_data.write_raw_nlx_data_zarr instead, which writes chunks with this many processes.
+    index_cache : CscIndexCache
+        Cache of the CSC file indexes, used to skip validating the files again in repeated conversions.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
+    preallocate : bool
+        If True, the dataset is only preallocated here. After the NWB file is written, fill it with
+        buffalonwb.write_raw_nlx_data.write_raw_nlx_data_resumable, or replace it with the virtual dataset of
+        buffalonwb.write_raw_nlx_data.write_raw_nlx_data_parts. Implied by compression_workers.
+    time_range : tuple of float
+        Start and end, in seconds relative to the first sample of the recording, of a time window to extract. Only
+        the records in the window are read. Defaults to the whole recording.
+    channels : list of str or int
+        Electrode labels (e.g. 'CSC1') or indices of the channels to extract. Defaults to all channels. The
+        ElectricalSeries then refers to a new region of the electrode table with only these electrodes.
+    backend : str
+        Storage backend the NWB file will be written with, 'hdf5' or 'zarr'.
+    live : bool
+        If True, the CSC files may still be written by Cheetah. An empty ElectricalSeries dataset, resizable along
+        time, is created here with the nominal rate and a starting time of 0. After the NWB file is written, append
+        the records as they are completed with buffalonwb.write_raw_nlx_data.write_raw_nlx_data_live, which then sets
+        the fitted rate and starting time. Only supported with the HDF5 backend.
+    scratch_dir : str or Path
+        Directory of the scratch files of raw_iterator 'transpose' and of the previews, ideally on a local SSD.
+        Defaults to the system temporary directory.
+    preview_rate : float
+        If set, an anti-aliased preview of each raw ElectricalSeries, decimated to about this rate in Hz, is computed
+        from the blocks read while the raw data is written. The previews are added as ElectricalSeries named after the
+        raw ElectricalSeries plus 'Preview' in the 'ecephys' processing module. Their datasets are preallocated. After
+        the NWB file is written, fill them with buffalonwb.raw_preview.write_raw_previews. Only supported with the
+        HDF5 backend and raw_iterator 'block' or 'transpose', and not with live.
+
+    Returns
+    -------
+    list of RawPreview
+        The previews, if preview_rate is set.
 
     """
     print('Adding raw NLX data using data chunk iterator')
     num_electrodes = len(electrode_table_region)
 
-    # get paths to all CSC data files, excluding the 16 kB header files with '_' in the name
-    data_files = natsorted([x.name for x in raw_nlx_path.glob('CSC*.ncs') if '_' not in x.stem])
-    data_paths = [raw_nlx_path / x for x in data_files]
-    assert(len(data_paths) == num_electrodes)
-
-    # read first file fully to initialize a few variables
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path, index_cache=index_cache)
+    assert(len(csc_directory) == num_electrodes)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    if channels is not None:
+        electrode_table_region = nwbfile.create_electrode_table_region(
+            region=[electrode_table_region.data[i] for i in channel_indices],
+            description='the extracted electrodes'
+        )
+    if raw_iterator == 'channel' and (time_range is not None or channels is not None):
+        raise ValueError("raw_iterator='channel' cannot extract a time window or channel subset, "
+                         "use raw_iterator='block'")
 
-    # NOTE: use starting time of 0. the neuralynx starting time is arbitrary.
+    # NOTE: use the first record of the recording as time 0. the neuralynx starting time is arbitrary.
     # TODO: store neuralynx starting time in case it is useful for alignment
-    raw_header, raw_ts, raw_data = read_csc_file(data_paths[0])
-    starting_time = 0.
+    raw_header = csc_directory.headers[0]
     rate = float(raw_header['SamplingFrequency'])
     conversion_factor = raw_header['ADBitVolts']
     # TODO put header data into NWBFile under Neuralynx device
 
-    data = raw_generator(raw_nlx_path,
-                         first_raw_ts=raw_ts,
-                         first_raw_data=raw_data)
-    ephys_data = DataChunkIterator(data=data,
-                                   iter_axis=1,
-                                   maxshape=(len(raw_ts), num_electrodes),
-                                   dtype=np.dtype('int16'))
-
-    # NOTE: starting time and rate are provided instead of timestamps. rate may be 32000.012966 Hz rather than 32000 Hz
-    # but use the reported 32000 Hz anyway.
-    ephys_ts = ElectricalSeries(name='ElectricalSeries',
+    if compression_workers and backend == 'hdf5' and compression not in (None, 'gzip'):
+        raise ValueError("Only gzip compression is supported with compression_workers: %s" % compression)
+    dataio_kwargs = dict(backend=backend, compression=compression, compression_level=compression_level,
+                         shuffle=shuffle)
+
+    if live:
+        if backend != 'hdf5' or time_range is not None or raw_iterator != 'block':
+            raise ValueError("live conversion requires the HDF5 backend and raw_iterator='block', without time_range")
+        if preview_rate is not None:
+            raise ValueError("preview_rate is not supported with live conversion")
+        _add_live_raw_series(nwbfile, electrode_table_region, len(channel_indices), rate, conversion_factor,
+                             chunk_shape, dataio_kwargs)
+        return
+
+    previews = None
+    if preview_rate is not None:
+        if backend != 'hdf5' or raw_iterator not in ('block', 'transpose') or preallocate or compression_workers:
+            raise ValueError("preview_rate requires the HDF5 backend and raw_iterator 'block' or 'transpose', without "
+                             "preallocate or compression_workers")
+        previews = list()
+        preview_module = nwbfile.create_processing_module(
+            name='ecephys',
+            description='decimated preview of the raw extracellular electrophysiology data'
+        )
+
+    # split the recording at gaps in the record timestamps, e.g. when Cheetah was paused. timestamps are aligned
+    # across channels, so the segments of the first channel apply to all channels
+    segments, starting_times = get_raw_segments(csc_directory, time_range)
+    if len(segments) > 1:
+        print('Found %d gaps in the raw NLX data, writing %d ElectricalSeries' % (len(segments) - 1, len(segments)))
+        if raw_iterator == 'channel' and not (preallocate or compression_workers):
+            raise ValueError("raw_iterator='channel' cannot write recordings with gaps, use raw_iterator='block'")
+
+    for segment_index, segment in enumerate(segments):
+        preview = None
+        if previews is not None:
+            preview = RawPreview(name=get_raw_series_name(segment_index) + 'Preview', rate=float(segment['rate']),
+                                 num_samples=int(segment['num_samples']), num_channels=len(channel_indices),
+                                 preview_rate=preview_rate, scratch_dir=scratch_dir)
+            previews.append(preview)
+        ephys_data = _get_raw_segment_data(csc_directory, channel_indices, segment, raw_iterator, buffer_mb,
+                                           chunk_shape, preallocate or compression_workers, scratch_dir, preview,
+                                           dataio_kwargs)
+
+        # NOTE: starting time and rate are provided instead of timestamps. the reported rate is e.g. 32000 Hz while
+        # the actual rate relative to the Cheetah clock may be 32000.012966 Hz, so both are fit to the record start
+        # times of the segment, see fit_csc_rate
+        ephys_ts = ElectricalSeries(name=get_raw_series_name(segment_index),
+                                    data=ephys_data,
+                                    electrodes=electrode_table_region,
+                                    starting_time=float(starting_times[segment_index]),
+                                    rate=float(segment['rate']),
+                                    conversion=conversion_factor,
+                                    description='This is a recording from the hippocampus',
+                                    comments='Segment %d of %d of the recording, starting at sample %d and Cheetah '
+                                             'timestamp %d us. The rate and starting time are a least-squares fit '
+                                             'of the record start times (nominal rate %g Hz, fitted Cheetah time of '
+                                             'the first sample %.3f us, residual RMS %.3f us, max %.3f us).'
+                                             % (segment_index + 1, len(segments), segment['start_sample'],
+                                                segment['start_time_us'], rate, segment['fit_start_time_us'],
+                                                segment['residual_rms_us'], segment['residual_max_us']))
+        nwbfile.add_acquisition(ephys_ts)
+
+        if preview is not None:
+            preview_data = get_dataio(None, shape=preview.shape, dtype=np.dtype('int16'), **dataio_kwargs)
+            preview_module.add(ElectricalSeries(name=preview.name,
+                                                data=preview_data,
+                                                electrodes=electrode_table_region,
+                                                starting_time=ephys_ts.starting_time,
+                                                rate=preview.rate,
+                                                conversion=conversion_factor,
+                                                description='Anti-aliased preview of %s, decimated from %g Hz '
+                                                            'to %g Hz' % (ephys_ts.name, ephys_ts.rate,
+                                                                          preview.rate)))
+
+    return previews
+
+
+def _add_live_raw_series(nwbfile, electrode_table_region, num_channels, rate, conversion_factor, chunk_shape,
+                         dataio_kwargs):
+    """Add the empty ElectricalSeries of a live conversion, resizable along time, see add_raw_nlx_data."""
+    if chunk_shape is None:
+        # same default as CscDataChunkIterator, ~10 MB chunks spanning all channels
+        chunk_shape = (int(10e6 // (num_channels * np.dtype('int16').itemsize)), num_channels)
+    ephys_data = get_dataio(None, shape=(0, num_channels), maxshape=(None, num_channels), dtype=np.dtype('int16'),
+                            chunk_shape=chunk_shape, **dataio_kwargs)
+    ephys_ts = ElectricalSeries(name=get_raw_series_name(0),
                                 data=ephys_data,
                                 electrodes=electrode_table_region,
-                                starting_time=starting_time,
+                                starting_time=0.,
                                 rate=rate,
                                 conversion=conversion_factor,
-                                description='This is a recording from the hippocampus')
+                                description='This is a recording from the hippocampus',
+                                comments='Recording converted live while Cheetah was writing the CSC files. '
+                                         'The nominal rate is replaced by its fit to the record start times '
+                                         'when appending ends.')
     nwbfile.add_acquisition(ephys_ts)
 
 
-def raw_generator(raw_nlx_path, first_raw_ts=None, first_raw_data=None):
+def _get_raw_segment_data(csc_directory, channel_indices, segment, raw_iterator, buffer_mb, chunk_shape,
+                          preallocate, scratch_dir, preview, dataio_kwargs):
+    """Get the wrapped data of the ElectricalSeries of a segment of the recording, see add_raw_nlx_data.
+
+    If preallocate is True, the dataset is only allocated, with the chunk shape of a CscDataChunkIterator.
+    """
+    data_paths = [csc_directory.data_paths[i] for i in channel_indices]
+    num_records = [csc_directory.num_records[i] for i in channel_indices]
+    start_sample = int(segment['start_sample'])
+    num_samples = int(segment['num_samples'])
+    validated = csc_directory.is_validated(channel_indices)
+    if preallocate:
+        iterator = CscDataChunkIterator(data_paths=data_paths, chunk_shape=chunk_shape, display_progress=False,
+                                        start_sample=start_sample, num_samples=num_samples, num_records=num_records,
+                                        validated=validated)
+        return get_dataio(None, shape=iterator.maxshape, dtype=iterator.dtype, chunk_shape=iterator.chunk_shape,
+                          **dataio_kwargs)
+
+    on_checked = partial(csc_directory.add_checked_samples, channel_indices, start_sample, num_samples)
+    if raw_iterator == 'block':
+        data = CscDataChunkIterator(data_paths=data_paths, buffer_mb=buffer_mb, chunk_shape=chunk_shape,
+                                    start_sample=start_sample, num_samples=num_samples, num_records=num_records,
+                                    preview=preview, validated=validated, on_checked=on_checked)
+        chunk_shape = None  # the iterator recommends its own chunk shape to the DataIO
+    elif raw_iterator == 'transpose':
+        data = CscTransposeDataChunkIterator(data_paths=data_paths, buffer_mb=buffer_mb, chunk_shape=chunk_shape,
+                                             scratch_dir=scratch_dir, start_sample=start_sample,
+                                             num_samples=num_samples, num_records=num_records, preview=preview,
+                                             validated=validated, on_checked=on_checked)
+        chunk_shape = None
+    elif raw_iterator == 'channel':
+        # read first file fully to initialize a few variables
+        _, raw_ts, raw_data = read_csc_file(data_paths[0])
+        data = DataChunkIterator(data=raw_generator(csc_directory.path,
+                                                    first_raw_ts=raw_ts,
+                                                    first_raw_data=raw_data,
+                                                    csc_directory=csc_directory),
+                                 iter_axis=1,
+                                 maxshape=(len(raw_ts), len(data_paths)),
+                                 dtype=np.dtype('int16'))
+    else:
+        raise ValueError("raw_iterator must be 'block', 'transpose' or 'channel': %s" % raw_iterator)
+    return get_dataio(data, chunk_shape=chunk_shape, **dataio_kwargs)
+
+
+def get_raw_series_name(segment_index):
+    """Get the name of the raw ElectricalSeries of a segment of the recording.
+
+    The first segment, which is the whole recording if there are no gaps, is named 'ElectricalSeries'. The segments
+    after each gap are named 'ElectricalSeriesSegment1', 'ElectricalSeriesSegment2', etc.
+    """
+    if segment_index == 0:
+        return 'ElectricalSeries'
+    return 'ElectricalSeriesSegment%d' % segment_index
+
+
+def get_raw_channel_indices(csc_directory, channels=None):
+    """Get the indices of a subset of the channels of a directory of raw NLX CSC files.
+
+    Parameters
+    ----------
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files.
+    channels : list of str or int
+        Electrode labels (e.g. 'CSC1') or indices of the channels. Defaults to all channels.
+
+    Returns
+    -------
+    list of int
+        Sorted indices of the channels in csc_directory.
+
+    Raises
+    ------
+    ValueError
+        if a channel is not in the directory.
+
+    """
+    if channels is None:
+        return list(range(len(csc_directory)))
+    channel_indices = set()
+    for channel in channels:
+        if isinstance(channel, str):
+            if channel not in csc_directory.electrode_labels:
+                raise ValueError('Channel %s is not in %s' % (channel, csc_directory.path))
+            channel_indices.add(csc_directory.electrode_labels.index(channel))
+        elif 0 <= channel < len(csc_directory):
+            channel_indices.add(int(channel))
+        else:
+            raise ValueError('Channel index %d is out of range for %d channels in %s'
+                             % (channel, len(csc_directory), csc_directory.path))
+    if not channel_indices:
+        raise ValueError('No channels selected in %s' % csc_directory.path)
+    return sorted(channel_indices)
+
+
+def get_raw_segments(csc_directory, time_range=None):
+    """Get the continuous segments of the raw data to write, optionally restricted to a time window.
+
+    The segments of the whole recording come from the index of the first file (see find_csc_segments), so they are
+    read from the index cache of csc_directory in repeated conversions. With a time window, its first and last
+    samples are found by binary search over the record timestamps of the first file (see find_csc_sample), reading
+    one record per step, and only the records in the window are read to find its gaps and fit its rate. If the
+    index of the first file is already known, the segments of the whole recording are cut to the window instead, so
+    the rate and starting time of each segment are still fit to the record start times of the whole segment.
+
+    Parameters
+    ----------
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files.
+    time_range : tuple of float
+        Start and end of the window, in seconds relative to the first sample of the recording. Defaults to the whole
+        recording.
+
+    Returns
+    -------
+    tuple
+        The segments, as a structured array like find_csc_segments returns, and the fitted starting time of each
+        segment in seconds relative to the first record of the recording.
+
+    Raises
+    ------
+    ValueError
+        if the time window contains no samples.
+
+    """
+    if time_range is None:
+        index = csc_directory.get_index(0)
+        segments = index['segments']
+        return segments, (segments['fit_start_time_us'] - index['first_timestamp']) / 1e6
+
+    t_start, t_end = time_range
+    data_path, num_records = csc_directory.data_paths[0], csc_directory.num_records[0]
+    first_record, last_record = (read_csc_records_at(data_path, record, 1)[0] for record in (0, num_records - 1))
+    first_time_us = int(first_record['timestamp'])
+    rate = float(first_record['sampling_frequency'])
+    num_samples = (num_records - 1) * _CSC_SAMPLES_PER_RECORD + int(last_record['num_valid_samples'])
+    record_starts = _CscRecordStarts(data_path, num_records)
+    start_sample = find_csc_sample(record_starts, first_time_us + max(t_start, 0.) * 1e6, rate, num_samples)
+    stop_sample = find_csc_sample(record_starts, first_time_us + t_end * 1e6, rate, num_samples)
+    if stop_sample <= start_sample:
+        raise ValueError('The time range %s s contains no samples of the raw data in %s'
+                         % (tuple(time_range), csc_directory.path))
+
+    window_first_record = start_sample // _CSC_SAMPLES_PER_RECORD
+    window_starts = record_starts.read(window_first_record, -(-stop_sample // _CSC_SAMPLES_PER_RECORD))
+    window_offset = window_first_record * _CSC_SAMPLES_PER_RECORD
+    index = csc_directory.get_cached_index(0)
+    if index is None:
+        segments = find_csc_segments(CscTimestamps(window_starts, rate, stop_sample - window_offset))
+        segments['start_sample'] += window_offset
+    else:
+        segments = index['segments']
+        segment_stops = segments['start_sample'] + segments['num_samples']
+        segments = segments[(segments['start_sample'] < stop_sample) & (segment_stops > start_sample)].copy()
+        segments['num_samples'] = np.minimum(segments['start_sample'] + segments['num_samples'],
+                                             stop_sample) - segments['start_sample']
+
+    # the window starts within the first segment, usually not at the start of a record
+    skipped = start_sample - int(segments['start_sample'][0])
+    segments['start_sample'][0] = start_sample
+    segments['start_time_us'][0] = int(window_starts[0]) + int(round((start_sample - window_offset) * 1e6 / rate))
+    segments['fit_start_time_us'][0] += skipped * 1e6 / segments['rate'][0]
+    segments['num_samples'][0] -= skipped
+    return segments, (segments['fit_start_time_us'] - first_time_us) / 1e6
+
+
+class CscDataChunkIterator(GenericDataChunkIterator):
+    """Data chunk iterator that reads aligned time blocks from all CSC .ncs files at once.
+
+    Each buffer is a (time block x all channels) int16 array, so the (time, channel) ElectricalSeries dataset is
+    written contiguously and memory use is bounded by buffer_mb regardless of the session length. Record consistency
+    and cross-channel timestamp alignment are checked on each block as it is read, except record consistency when the
+    files were already validated.
+
+    Parameters
+    ----------
+    data_paths : list of Path
+        Paths of the CSC .ncs files, one per channel, in channel order.
+    buffer_mb : float
+        Maximum size of a buffer (time block x all channels), in MB.
+    chunk_shape : tuple
+        Shape of the HDF5 chunks. Defaults to chunks spanning all channels and ~chunk_mb MB.
+    chunk_mb : float
+        Size of the default HDF5 chunks, in MB.
+    display_progress : bool
+        Whether to display a progress bar over the buffers.
+    start_sample : int
+        Index of the first sample of the files to iterate over.
+    num_samples : int
+        Number of samples to iterate over. Defaults to all samples after start_sample.
+    num_records : list of int
+        Number of records of each file, if already known, e.g. from CscDirectory.
+    preview : RawPreview
+        Decimated preview that the buffers are fed to as they are read, see buffalonwb.raw_preview.
+    validated : bool
+        Whether the records of the files were already checked by check_csc_records, e.g. in a previous conversion
+        with an index cache (see CscDirectory.is_validated). The per-block record checks are then skipped.
+    on_checked : callable
+        Function called without arguments after the last buffer, if the records of all buffers were checked, e.g. to
+        record the checked samples with CscDirectory.add_checked_samples.
+
+    """
+
+    def __init__(self, data_paths, buffer_mb=1024., chunk_shape=None, chunk_mb=10., display_progress=True,
+                 start_sample=0, num_samples=None, num_records=None, preview=None, validated=False, on_checked=None):
+        self.data_paths = list(data_paths)
+        self.preview = preview
+        self.validated = validated
+        self.on_checked = on_checked
+        if num_records is None:
+            num_records = [None] * len(self.data_paths)
+        self._records = [read_csc_records(data_path, num_records=n)
+                         for data_path, n in zip(self.data_paths, num_records)]
+
+        # all files must have the same number of records and valid samples. timestamps are checked block by block
+        last_records = [records[-1] for records in self._records]
+        for data_path, records, last_record in zip(self.data_paths[1:], self._records[1:], last_records[1:]):
+            if (len(records) != len(self._records[0])
+                    or last_record['num_valid_samples'] != last_records[0]['num_valid_samples']):
+                raise InconsistentInputException('Timestamps are not aligned between %s and %s'
+                                                 % (self.data_paths[0], data_path))
+        num_file_samples = ((len(self._records[0]) - 1) * _CSC_SAMPLES_PER_RECORD
+                            + int(last_records[0]['num_valid_samples']))
+        if num_samples is None:
+            num_samples = num_file_samples - start_sample
+        if start_sample < 0 or num_samples <= 0 or start_sample + num_samples > num_file_samples:
+            raise ValueError('Samples %d to %d are out of the range of the CSC files (%d samples).'
+                             % (start_sample, start_sample + num_samples, num_file_samples))
+        self._start_sample = start_sample
+        self._num_samples = num_samples
+        self._channel_numbers = [records[0]['channel_number'] for records in self._records]
+        self.rate = float(self._records[0][0]['sampling_frequency'])
+
+        num_channels = len(self.data_paths)
+        itemsize = np.dtype('int16').itemsize
+        if chunk_shape is None:
+            chunk_time = int(chunk_mb * 1e6 // (num_channels * itemsize))
+            chunk_shape = (max(1, min(chunk_time, self._num_samples)), num_channels)
+        buffer_time = int(buffer_mb * 1e6 // (num_channels * itemsize)) // chunk_shape[0] * chunk_shape[0]
+        buffer_time = max(chunk_shape[0], buffer_time)
+        if buffer_time >= self._num_samples:
+            buffer_time = self._num_samples
+
+        super().__init__(buffer_shape=(buffer_time, num_channels),
+                         chunk_shape=tuple(chunk_shape),
+                         display_progress=display_progress,
+                         progress_bar_options=dict(desc='Writing raw data'))
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except StopIteration:
+            if not self.validated and self.on_checked is not None:
+                self.on_checked()
+            raise
+
+    def get_block(self, start, stop):
+        """Read samples start to stop (relative to start_sample) of all channels as a (time, channel) int16 array."""
+        return self._read_data((slice(start, stop), slice(None)))
+
+    def _get_data(self, selection):
+        data = self._read_data(selection)
+        if self.preview is not None:
+            self.preview.process(selection[0].indices(self._num_samples)[0], data)
+        return data
+
+    def _read_data(self, selection):
+        time_selection, channel_selection = selection
+        start, stop, _ = time_selection.indices(self._num_samples)
+        start += self._start_sample
+        stop += self._start_sample
+        channels = range(len(self.data_paths))[channel_selection]
+
+        first_record = start // _CSC_SAMPLES_PER_RECORD
+        last_record = -(-stop // _CSC_SAMPLES_PER_RECORD)
+        offset = first_record * _CSC_SAMPLES_PER_RECORD
+
+        data = np.empty((stop - start, len(channels)), dtype=np.int16)
+        timestamps = list()
+        for j, ch in enumerate(channels):
+            records = self._records[ch][first_record:last_record]
+            if not self.validated:
+                self._check_block(ch, records, last_record)
+            timestamps.append(CscTimestamps(record_starts=records['timestamp'],
+                                            rate=self.rate,
+                                            num_samples=stop - start))
+            data[:, j] = records['samples'].reshape(-1)[start - offset:stop - offset]
+        check_csc_timestamps_aligned(timestamps, [self.data_paths[ch] for ch in channels])
+        return data
+
+    def _check_block(self, ch, records, last_record):
+        """Check the consistency of a block of records of a channel, like check_csc_records does for a whole file."""
+        if np.any(records['channel_number'] != self._channel_numbers[ch]):
+            raise InconsistentInputException('Channel number is not consistent across records in %s.'
+                                             % self.data_paths[ch])
+        if np.any(records['sampling_frequency'] != self.rate):
+            raise InconsistentInputException('Sampling rate is not consistent across records in %s.'
+                                             % self.data_paths[ch])
+        # OK if last record of the file has fewer than 512 valid samples
+        num_full = len(records) - 1 if last_record == len(self._records[ch]) else len(records)
+        bad_records = np.flatnonzero(records['num_valid_samples'][:num_full] != _CSC_SAMPLES_PER_RECORD)
+        if len(bad_records):
+            raise UnexpectedInputException('Record %d of %s has fewer than %d valid samples. These data need to be '
+                                           'handled specially.'
+                                           % (last_record - len(records) + bad_records[0], self.data_paths[ch],
+                                              _CSC_SAMPLES_PER_RECORD))
+
+    def _get_dtype(self):
+        return np.dtype('int16')
+
+    def _get_maxshape(self):
+        return self._num_samples, len(self.data_paths)
+
+
+class CscTransposeDataChunkIterator(CscDataChunkIterator):
+    """Data chunk iterator that transposes the CSC .ncs files out of core, through a scratch file on local disk.
+
+    CSC data is stored channel-major but the ElectricalSeries is time-major, so CscDataChunkIterator reads a slice of
+    every file for each time block. This iterator instead streams each file once, sequentially, into a memory-mapped
+    scratch file before the first buffer is returned, and then serves (time block x all channels) buffers from it.
+
+    The scratch file holds the time blocks one after the other, each as a (channel, time) int16 array. Each channel
+    is then written as one contiguous run per block, and each buffer is one contiguous read transposed in memory.
+    Memory use is bounded by buffer_mb regardless of the session length. The scratch file takes 2 bytes per sample
+    and channel and is deleted when the iteration is complete, or by close().
+
+    Parameters
+    ----------
+    data_paths : list of Path
+        Paths of the CSC .ncs files, one per channel, in channel order.
+    buffer_mb : float
+        RAM ceiling, in MB. A buffer and the block of the scratch file it is transposed from fit together within it.
+    scratch_dir : str or Path
+        Directory of the scratch file, ideally on a local SSD. Defaults to the system temporary directory.
+    **kwargs
+        Other arguments of CscDataChunkIterator.
+
+    """
+
+    def __init__(self, data_paths, buffer_mb=1024., scratch_dir=None, **kwargs):
+        super().__init__(data_paths, buffer_mb=buffer_mb / 2, **kwargs)
+        self.scratch_dir = scratch_dir
+        self._scratch_file = None
+        self._scratch = None
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        """Delete the scratch file."""
+        self._scratch = None
+        if self._scratch_file is not None:
+            self._scratch_file.close()
+            self._scratch_file = None
+
+    def _transpose(self):
+        """Stream each channel into the scratch file, checking its records block by block."""
+        num_channels = len(self.data_paths)
+        block_size = self.buffer_shape[0]
+        num_blocks = -(-self._num_samples // block_size)
+        # unnamed on POSIX, so the scratch file is removed even if the conversion fails
+        self._scratch_file = tempfile.TemporaryFile(dir=self.scratch_dir, prefix='buffalonwb_transpose_')
+        self._scratch = np.memmap(self._scratch_file, dtype=np.int16, mode='w+',
+                                  shape=(num_blocks, num_channels, block_size))
+
+        # record start times of the first channel, 8 bytes per record, to check the alignment of the others
+        reference_starts = list()
+        for ch in tqdm(range(num_channels), desc='Transposing raw data'):
+            for block in range(num_blocks):
+                start = self._start_sample + block * block_size
+                stop = min(start + block_size, self._start_sample + self._num_samples)
+                first_record = start // _CSC_SAMPLES_PER_RECORD
+                last_record = -(-stop // _CSC_SAMPLES_PER_RECORD)
+                offset = first_record * _CSC_SAMPLES_PER_RECORD
+
+                records = self._records[ch][first_record:last_record]
+                if not self.validated:
+                    self._check_block(ch, records, last_record)
+                record_starts = np.array(records['timestamp'])
+                if ch == 0:
+                    reference_starts.append(record_starts)
+                else:
+                    check_csc_timestamps_aligned(
+                        [CscTimestamps(reference_starts[block], self.rate, stop - start),
+                         CscTimestamps(record_starts, self.rate, stop - start)],
+                        [self.data_paths[0], self.data_paths[ch]])
+                self._scratch[block, ch, :stop - start] = records['samples'].reshape(-1)[start - offset:stop - offset]
+
+    def _read_data(self, selection):
+        if self._scratch is None:
+            try:
+                self._transpose()
+            except BaseException:
+                self.close()
+                raise
+        time_selection, channel_selection = selection
+        start, stop, _ = time_selection.indices(self._num_samples)
+        channels = np.arange(len(self.data_paths))[channel_selection]
+        block_size = self._scratch.shape[2]
+
+        data = np.empty((stop - start, len(channels)), dtype=np.int16)
+        for block in range(start // block_size, -(-stop // block_size)):
+            block_start = block * block_size
+            block_stop = min(stop, block_start + block_size)
+            first = max(start, block_start)
+            block_data = self._scratch[block, channels, first - block_start:block_stop - block_start]
+            data[first - start:block_stop - start] = block_data.T
+        return data
+
+
+def raw_generator(raw_nlx_path, first_raw_ts=None, first_raw_data=None, prefetch=2, csc_directory=None):
     """Generator that returns an array of all of the raw data for a single channel (from a single CSC .ncs file)
 
+    Upcoming CSC files are decoded in background threads while the current channel is being written.
+
     Parameters
     ----------
     raw_nlx_path : Path
         Path for directory of raw NLX CSC files.
-    first_raw_ts : np.array
-        Array of timestamps for the first channel.
+    first_raw_ts : CscTimestamps
+        Timestamps for the first channel.
     first_raw_data : np.array
-        Array of raw data values for the first channel.
+        Array of int16 raw data values for the first channel.
+    prefetch : int
+        Number of CSC files decoded ahead of the channel being written. Each holds a full channel in memory. Use 0 to
+        read the files one after the other.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
 
     Yields
     ------
@@ -92,33 +692,42 @@ def raw_generator(raw_nlx_path, first_raw_ts=None, first_raw_data=None):
         if the timestamps differ between channels.
 
     """
-    data_files = natsorted([x.name for x in raw_nlx_path.glob('CSC*.ncs') if '_' not in x.stem])
-    data_paths = [raw_nlx_path / x for x in data_files]
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path)
+    data_paths = csc_directory.data_paths
 
-    # generate raw data chunks for data chunk iterator
-    for i in trange(len(data_paths), desc='Writing raw data'):
+    def read_channel(i):
         if i == 0 and first_raw_ts is not None and first_raw_data is not None:
-            raw_ts = first_raw_ts
-            raw_data = first_raw_data
-        else:
-            _, raw_ts, raw_data = read_csc_file(data_paths[i])
+            return first_raw_ts, first_raw_data
+        _, raw_ts, raw_data = read_csc_file(data_paths[i])
+        return raw_ts, raw_data
+
+    if prefetch:
+        channels = ordered_prefetch(read_channel, range(len(data_paths)), num_workers=prefetch)
+    else:
+        channels = map(read_channel, range(len(data_paths)))
 
+    # generate raw data chunks for data chunk iterator
+    for i, (raw_ts, raw_data) in enumerate(tqdm(channels, total=len(data_paths), desc='Writing raw data')):
         if i == 0:
             raw_ts_ch0 = raw_ts  # save timestamps to check with timestamps for other channels
         else:
-            if not np.all(raw_ts_ch0 == raw_ts):
-                raise InconsistentInputException('Timestamps are not aligned between %s and %s'
-                                                 % (data_paths[0], data_paths[i]))
-        yield raw_data.astype(np.int16)
+            check_csc_timestamps_aligned([raw_ts_ch0, raw_ts], [data_paths[0], data_paths[i]])
+        yield raw_data
 
 
-def parse_header(header):  # noqa: C901
+def parse_header(header, expected_keys=_CSC_HEADER_KEYS):  # noqa: C901
     """Parse the 16 kB header of a Neuralynx CSC (.ncs) file into a dictionary.
 
+    The headers of the other Neuralynx file types (.nev, .nvt, .ntt) have the same format with different keys, and
+    lines of several values, which are parsed into lists when expected_keys is None.
+
     Parameters
     ----------
-    raw_nlx_path : Path
-        Path for directory of raw NLX CSC files.
+    header : bytes
+        The 16 kB header.
+    expected_keys : set
+        The keys the header must have, or None to accept any keys. Defaults to the keys of a CSC header.
 
     Returns
     -------
@@ -128,17 +737,17 @@ def parse_header(header):  # noqa: C901
     Raises
     ------
     UnexpectedInputException
-        if a header line cannot be parsed because the line does not conform to an expected format.
+        if a header line cannot be parsed because the line does not conform to an expected format, or if the keys
+        differ from expected_keys.
 
     """
     header_data = dict()
-    for line in header.splitlines():
+    # the header text is padded with null bytes to 16 kB. latin-1 maps each byte to the character with that code
+    for line in header.split(b'\x00', 1)[0].splitlines():
         if not line:
             continue
-        if line[0] == '\x00':  # end of file
-            break
 
-        line = ''.join(map(chr, line))
+        line = line.decode('latin-1')
         if line[0] == '#':  # comment
             continue
         if line[0] == '-':  # metadata
@@ -163,46 +772,45 @@ def parse_header(header):  # noqa: C901
                     raise UnexpectedInputException('Line cannot be parsed: %s' % line)
                 header_data[key] = line_parts[1] + ' ' + line_parts[2]
             else:
-                if len(line_parts) > 2:
+                if len(line_parts) > 2 and expected_keys is not None:
                     raise UnexpectedInputException('Line cannot be parsed: %s' % line)
                 if key in {'InputInverted', 'DSPLowCutFilterEnabled', 'DSPHighCutFilterEnabled'}:
-                    header_data[key] = bool(line_parts[1])
+                    values = [bool(x) for x in line_parts[1:]]
                 elif key in {'RecordSize', 'SamplingFrequency', 'ADMaxValue', 'NumADChannels', 'ADChannel',
                              'InputRange', 'DspLowCutNumTaps', 'DspHighCutFrequency', 'DspHighCutNumTaps',
-                             'DspFilterDelay_µs'}:
-                    header_data[key] = int(line_parts[1])
+                             'DspFilterDelay_µs', 'WaveformLength', 'AlignmentPt', 'ThreshVal', 'SpikeRetriggerTime'}:
+                    values = [int(x) for x in line_parts[1:]]
                 elif key in {'ADBitVolts', 'DspLowCutFrequency'}:
-                    header_data[key] = float(line_parts[1])
+                    values = [float(x) for x in line_parts[1:]]
                 else:
-                    header_data[key] = line_parts[1]
-
-    expected_keys = {'FileType', 'FileVersion', 'FileUUID', 'SessionUUID', 'ProbeName', 'OriginalFileName',
-                     'TimeCreated', 'TimeClosed', 'RecordSize', 'ApplicationName', 'ApplicationVersion',
-                     'AcquisitionSystem', 'ReferenceChannelSource', 'ReferenceChannelReference', 'SamplingFrequency',
-                     'ADMaxValue', 'ADBitVolts', 'AcqEntName',
-                     'NumADChannels', 'ADChannel', 'InputRange', 'InputInverted', 'DSPLowCutFilterEnabled',
-                     'DspLowCutFrequency', 'DspLowCutNumTaps', 'DspLowCutFilterType', 'DSPHighCutFilterEnabled',
-                     'DspHighCutFrequency', 'DspHighCutNumTaps', 'DspHighCutFilterType', 'DspDelayCompensation',
-                     'DspFilterDelay_µs'}
-
-    if set(header_data.keys()) != expected_keys:
+                    values = line_parts[1:]
+                # lines of the headers of other file types may have several values, e.g. one per tetrode channel
+                header_data[key] = values[0] if len(values) == 1 else values
+
+    if expected_keys is not None and set(header_data.keys()) != expected_keys:
         raise UnexpectedInputException('Expected keys are missing from header.')
 
     return header_data
 
 
-def check_num_records(csc_file_path):
+def check_num_records(csc_file_path, file_size=None, allow_partial=False, record_size=_CSC_RECORD_SIZE):
     """Check that the size of the file is consistent with an integer number of records and return the number of records.
 
     Parameters
     ----------
     csc_file_path : Path
         Path for for a single CSC .ncs file.
+    file_size : int
+        Size of the file in bytes, if already known.
+    allow_partial : bool
+        Whether to allow a partially written last record, e.g. while Cheetah is still recording. It is not counted.
+    record_size : int
+        Size of the records in bytes, to check the other Neuralynx file types, which have the same 16 kB header.
 
     Returns
     -------
     int
-        The number of records in the file.
+        The number of (complete) records in the file.
 
     Raises
     ------
@@ -211,14 +819,421 @@ def check_num_records(csc_file_path):
         written correctly.
 
     """
-    file_size = csc_file_path.stat().st_size
-    num_records = (file_size - _CSC_HEADER_SIZE) / _CSC_RECORD_SIZE
+    if file_size is None:
+        file_size = csc_file_path.stat().st_size
+    num_records = (file_size - _CSC_HEADER_SIZE) / record_size
+    if allow_partial:
+        return max(0, int(num_records))
     if int(num_records) != num_records:  # check integer
         raise UnexpectedInputException('Number of records in %s must be an integer: %d' %
                                        (str(csc_file_path), num_records))
     return int(num_records)
 
 
+def read_csc_header(csc_file_path):
+    """Read and parse the 16 kB header of a CSC .ncs file.
+
+    Parameters
+    ----------
+    csc_file_path : Path
+        Path for for a single CSC .ncs file.
+
+    Returns
+    -------
+    dict
+        The header metadata.
+
+    """
+    with open(csc_file_path, 'rb') as data_file:
+        header = data_file.read(_CSC_HEADER_SIZE)
+    return parse_header(header)
+
+
+def read_csc_records(csc_file_path, num_records=None):
+    """Memory-map the records of a CSC .ncs file as a structured array.
+
+    The file is mapped read-only past the 16 kB header using _CSC_RECORD_DTYPE. No data is read until a field is
+    accessed, and fields are views into the file, e.g. records['samples'] is a zero-copy (num_records, 512) int16 view.
+
+    Parameters
+    ----------
+    csc_file_path : Path
+        Path for for a single CSC .ncs file.
+    num_records : int
+        Number of records in the file, if already known from check_num_records.
+
+    Returns
+    -------
+    np.memmap
+        Structured array of records with fields timestamp, channel_number, sampling_frequency, num_valid_samples and
+        samples.
+
+    """
+    if num_records is None:
+        num_records = check_num_records(csc_file_path)
+    return np.memmap(csc_file_path, dtype=_CSC_RECORD_DTYPE, mode='r', offset=_CSC_HEADER_SIZE,
+                     shape=(num_records, ))
+
+
+def read_csc_records_at(csc_file_path, start_record, num_records):
+    """Read records of a CSC .ncs file from a byte offset, e.g. the records appended since the last read.
+
+    Unlike read_csc_records, the file is not mapped, so it may still be growing.
+
+    Parameters
+    ----------
+    csc_file_path : Path
+        Path for for a single CSC .ncs file.
+    start_record : int
+        Index of the first record to read.
+    num_records : int
+        Number of records to read. They must be complete in the file.
+
+    Returns
+    -------
+    np.ndarray
+        Structured array of records, with the fields of read_csc_records.
+
+    Raises
+    ------
+    UnexpectedInputException
+        if the file has fewer records than requested.
+
+    """
+    records = np.fromfile(csc_file_path, dtype=_CSC_RECORD_DTYPE, count=num_records,
+                          offset=_CSC_HEADER_SIZE + start_record * _CSC_RECORD_SIZE)
+    if len(records) != num_records:
+        raise UnexpectedInputException('Expected %d records from record %d of %s but read %d.'
+                                       % (num_records, start_record, csc_file_path, len(records)))
+    return records
+
+
+def check_csc_records(records):
+    """Check that the channel number, sampling rate and number of valid samples are consistent across records.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Structured array of records, as returned by read_csc_records.
+
+    Returns
+    -------
+    int
+        The number of valid samples in the records.
+
+    Raises
+    ------
+    InconsistentInputException
+        if channel number or sampling rate is not consistent across records.
+    UnexpectedInputException
+        if a record other than the last one has fewer than _CSC_SAMPLES_PER_RECORD valid samples.
+
+    """
+    if len(records) == 0:
+        return 0
+
+    # first timestamp of the record might not be what we expect it to be -- see warning in read_csc_file
+    channel_numbers = records['channel_number']
+    if np.any(channel_numbers != channel_numbers[0]):
+        raise InconsistentInputException('Channel number is not consistent across records.')
+    sampling_frequencies = records['sampling_frequency']
+    if np.any(sampling_frequencies != sampling_frequencies[0]):
+        raise InconsistentInputException('Sampling rate is not consistent across records.')
+
+    # OK if last record has fewer than 512 valid samples
+    num_valid_samples = records['num_valid_samples']
+    bad_records = np.flatnonzero(num_valid_samples[:-1] != _CSC_SAMPLES_PER_RECORD)
+    if len(bad_records):
+        raise UnexpectedInputException('Record %d has %d valid samples instead of %d. These data need '
+                                       'to be handled specially.'
+                                       % (bad_records[0], num_valid_samples[bad_records[0]], _CSC_SAMPLES_PER_RECORD))
+    if num_valid_samples[-1] > _CSC_SAMPLES_PER_RECORD:
+        raise UnexpectedInputException('Record %d has %d valid samples, more than the maximum of %d.'
+                                       % (len(records) - 1, num_valid_samples[-1], _CSC_SAMPLES_PER_RECORD))
+
+    return (len(records) - 1) * _CSC_SAMPLES_PER_RECORD + int(num_valid_samples[-1])
+
+
+class CscTimestamps:
+    """Timestamps of a CSC .ncs file, stored as one Cheetah timestamp per record plus the sampling rate.
+
+    Per-sample timestamps (in microseconds) are only computed on demand, by indexing or with expand().
+
+    Parameters
+    ----------
+    record_starts : np.array
+        np.uint64 array of the Cheetah timestamp of the first sample of each record, in microseconds.
+    rate : float
+        The sampling frequency (Hz) of the records.
+    num_samples : int
+        The number of valid samples in the records.
+
+    """
+
+    def __init__(self, record_starts, rate, num_samples):
+        self.record_starts = np.asarray(record_starts, dtype=np.uint64)
+        self.rate = rate
+        self.num_samples = num_samples
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.num_samples)
+            return self.expand(start, stop)[::step]
+        index = range(self.num_samples)[key]
+        return self.expand(index, index + 1)[0]
+
+    def expand(self, start=0, stop=None):
+        """Compute the per-sample timestamps for samples start to stop.
+
+        Parameters
+        ----------
+        start : int
+            Index of the first sample.
+        stop : int
+            Index after the last sample. Defaults to the number of samples.
+
+        Returns
+        -------
+        np.array
+            np.uint64 array of timestamps in microseconds.
+
+        """
+        if stop is None:
+            stop = self.num_samples
+        first_record = start // _CSC_SAMPLES_PER_RECORD
+        last_record = -(-stop // _CSC_SAMPLES_PER_RECORD)
+        sample_offsets = np.arange(_CSC_SAMPLES_PER_RECORD) * (1e6 / self.rate)
+        ts = self.record_starts[first_record:last_record, np.newaxis] + sample_offsets
+        offset = first_record * _CSC_SAMPLES_PER_RECORD
+        return ts.astype(np.uint64).reshape(-1)[start - offset:stop - offset]
+
+
+def read_csc_timestamps(records):
+    """Get the record-level timestamps of memory-mapped CSC records.
+
+    Parameters
+    ----------
+    records : np.ndarray
+        Structured array of records, as returned by read_csc_records.
+
+    Returns
+    -------
+    CscTimestamps
+        The timestamps of the records.
+
+    """
+    num_samples = check_csc_records(records)
+    return CscTimestamps(record_starts=np.array(records['timestamp']),
+                         rate=float(records['sampling_frequency'][0]),
+                         num_samples=num_samples)
+
+
+def check_csc_timestamps_aligned(timestamps, data_paths):
+    """Check that the timestamps of several CSC .ncs files are aligned.
+
+    The record start times of all files are compared in a single vectorized pass.
+
+    Parameters
+    ----------
+    timestamps : list of CscTimestamps
+        Timestamps for each file.
+    data_paths : list of Path
+        Paths of the files, used for the error message.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the timestamps differ between files.
+
+    """
+    for ts, data_path in zip(timestamps[1:], data_paths[1:]):
+        if ts.num_samples != timestamps[0].num_samples or ts.rate != timestamps[0].rate:
+            raise InconsistentInputException('Timestamps are not aligned between %s and %s'
+                                             % (data_paths[0], data_path))
+
+    record_starts = np.stack([ts.record_starts for ts in timestamps])
+    misaligned = np.flatnonzero(np.any(record_starts != record_starts[0], axis=1))
+    if len(misaligned):
+        raise InconsistentInputException('Timestamps are not aligned between %s and %s'
+                                         % (data_paths[0], data_paths[misaligned[0]]))
+
+
+def find_csc_segments(timestamps, tolerance_us=None):
+    """Find the continuous segments of a CSC recording from its record start times.
+
+    A new segment starts wherever the start time of a record differs from the start time of the previous record plus
+    the duration of a record by more than tolerance_us, e.g. when Cheetah was paused during the recording.
+
+    Parameters
+    ----------
+    timestamps : CscTimestamps
+        Timestamps of the recording.
+    tolerance_us : float
+        Maximum deviation of the record start times, in microseconds, before it is considered a gap. Defaults to one
+        sample period, well above the 1 us discrepancy that occurs every ~156 records.
+
+    Returns
+    -------
+    np.array
+        Structured array with one row per segment and fields start_sample (index of the first sample of the segment),
+        start_time_us (Cheetah timestamp of the first sample, in microseconds), num_samples, and the fit of the
+        record start times of the segment by fit_csc_rate: rate, fit_start_time_us, residual_rms_us and
+        residual_max_us.
+
+    """
+    if tolerance_us is None:
+        tolerance_us = 1e6 / timestamps.rate
+    record_duration_us = _CSC_SAMPLES_PER_RECORD * 1e6 / timestamps.rate
+    record_steps = np.diff(timestamps.record_starts.astype(np.int64))
+    first_records = np.concatenate([[0], np.flatnonzero(np.abs(record_steps - record_duration_us) > tolerance_us) + 1])
+
+    segments = np.empty(len(first_records), dtype=_CSC_SEGMENT_DTYPE)
+    segments['start_sample'] = first_records * _CSC_SAMPLES_PER_RECORD
+    segments['start_time_us'] = timestamps.record_starts[first_records]
+    segments['num_samples'] = np.diff(np.append(segments['start_sample'], timestamps.num_samples))
+    for segment, first_record, last_record in zip(segments, first_records,
+                                                  np.append(first_records[1:], len(timestamps.record_starts))):
+        fit = fit_csc_rate(timestamps.record_starts[first_record:last_record], timestamps.rate)
+        segment['rate'], segment['fit_start_time_us'], segment['residual_rms_us'], segment['residual_max_us'] = fit
+    return segments
+
+
+def fit_csc_rate(record_starts, nominal_rate):
+    """Fit the sampling rate of a continuous CSC recording to its record start times by least squares.
+
+    The Cheetah clock and the sampling clock drift apart, e.g. 32000 Hz is nominally reported when the actual rate
+    is about 32000.013 Hz. The record start times are fit as a linear function of the index of the first sample of
+    each record, so the time of any sample is start_time + index / rate without per-sample timestamps.
+
+    Parameters
+    ----------
+    record_starts : np.array
+        np.uint64 array of the Cheetah timestamp of the first sample of each record, in microseconds, without gaps.
+    nominal_rate : float
+        The sampling frequency (Hz) reported in the records, returned if there are fewer than two records.
+
+    Returns
+    -------
+    tuple
+        The fitted rate in Hz, the fitted Cheetah time of the first sample in microseconds, and the root mean square
+        and maximum absolute residuals of the record start times, in microseconds.
+
+    """
+    if len(record_starts) < 2:
+        return nominal_rate, float(record_starts[0]), 0., 0.
+    sample_index = np.arange(len(record_starts), dtype=np.float64) * _CSC_SAMPLES_PER_RECORD
+    # relative to the first record, so the float64 fit keeps sub-microsecond precision
+    relative_starts = (record_starts - record_starts[0]).astype(np.float64)
+    slope, intercept = np.polyfit(sample_index, relative_starts, 1)
+    residuals = relative_starts - (slope * sample_index + intercept)
+    return (1e6 / slope, float(record_starts[0]) + intercept, float(np.sqrt(np.mean(residuals ** 2))),
+            float(np.max(np.abs(residuals))))
+
+
+class _CscRecordStarts:
+    """Record start times of a CSC .ncs file, read from the file one record at a time, e.g. to bisect them."""
+
+    def __init__(self, csc_file_path, num_records, block_records=65536):
+        self.csc_file_path = csc_file_path
+        self.num_records = num_records
+        self.block_records = block_records
+
+    def __len__(self):
+        return self.num_records
+
+    def __getitem__(self, record):
+        return int(read_csc_records_at(self.csc_file_path, range(self.num_records)[record], 1)[0]['timestamp'])
+
+    def read(self, start_record, stop_record):
+        """Read the start times of records start_record to stop_record, block_records records at a time."""
+        return np.concatenate([read_csc_records_at(self.csc_file_path, block_start,
+                                                   min(self.block_records, stop_record - block_start))['timestamp']
+                               for block_start in range(start_record, stop_record, self.block_records)])
+
+
+def find_csc_sample(record_starts, time_us, rate, num_samples):
+    """Find the first sample of CSC records at or after a Cheetah timestamp.
+
+    The record is found by binary search over the record start times, which must be increasing, so only about
+    log2(number of records) of them are read when record_starts reads them on demand.
+
+    Parameters
+    ----------
+    record_starts : sequence of int
+        The Cheetah timestamp of the first sample of each record, in microseconds.
+    time_us : float
+        Cheetah timestamp, in microseconds.
+    rate : float
+        The sampling frequency (Hz) of the records.
+    num_samples : int
+        The number of valid samples in the records.
+
+    Returns
+    -------
+    int
+        Index of the first sample at or after time_us, or num_samples if time_us is after the last sample.
+
+    """
+    # bisect indexes the record start times one by one, whereas np.searchsorted would read all of them
+    record = bisect.bisect_right(record_starts, time_us) - 1
+    if record < 0:
+        return 0
+    sample_offset = int(np.ceil((time_us - int(record_starts[record])) * rate / 1e6))
+    # a time in a gap after the record maps to the first sample of the next record
+    sample = record * _CSC_SAMPLES_PER_RECORD + min(sample_offset, _CSC_SAMPLES_PER_RECORD)
+    return min(sample, num_samples)
+
+
+def index_csc_file(csc_file_path, cache=None):
+    """Validate a CSC .ncs file and summarize it, without keeping its data.
+
+    Parameters
+    ----------
+    csc_file_path : Path
+        Path for for a single CSC .ncs file.
+    cache : CscIndexCache
+        Cache of indexes. If the file is in the cache and did not change since it was indexed, the cached index is
+        returned without reading the file. Otherwise, the new index is stored in the cache.
+
+    Returns
+    -------
+    dict
+        The index, with keys header (the header metadata), num_records, num_samples, first_timestamp and
+        last_timestamp (Cheetah timestamps of the first and last records, in microseconds), channel_number,
+        sampling_frequency and segments (see find_csc_segments).
+
+    Raises
+    ------
+    InconsistentInputException
+        if channel number or sampling rate is not consistent across records.
+    UnexpectedInputException
+        if the file size or number of valid samples of the records is not as expected.
+
+    """
+    if cache is not None:
+        index = cache.get(csc_file_path)
+        if index is not None:
+            return index
+
+    records = read_csc_records(csc_file_path)
+    timestamps = read_csc_timestamps(records)
+    index = dict(header=read_csc_header(csc_file_path),
+                 num_records=len(records),
+                 num_samples=timestamps.num_samples,
+                 first_timestamp=int(timestamps.record_starts[0]),
+                 last_timestamp=int(timestamps.record_starts[-1]),
+                 channel_number=int(records[0]['channel_number']),
+                 sampling_frequency=timestamps.rate,
+                 segments=find_csc_segments(timestamps))
+
+    if cache is not None:
+        cache.put(csc_file_path, index)
+    return index
+
+
 def read_csc_file(csc_file_path, use_tqdm=False):
     """Read and parse a CSC .ncs file.
 
@@ -227,12 +1242,12 @@ def read_csc_file(csc_file_path, use_tqdm=False):
     csc_file_path : Path
         Path for for a single CSC .ncs file.
     use_tqdm: bool
-        Whether to use tqdm to display read progress
+        Unused. Records are read in a single vectorized pass. Kept for backwards compatibility.
 
     Returns
     -------
     tuple
-        Header data, timestamps, and data values from the file
+        Header data, timestamps (as CscTimestamps), and int16 data values from the file
 
     Raises
     ------
@@ -242,80 +1257,162 @@ def read_csc_file(csc_file_path, use_tqdm=False):
         if a record has fewer than _CSC_SAMPLES_PER_RECORD per record.
 
     """
-    num_records = check_num_records(csc_file_path)
+    header_data = read_csc_header(csc_file_path)
+    records = read_csc_records(csc_file_path)
+    ts = read_csc_timestamps(records)
+    Fs = ts.rate
 
-    channel_number = None
-    Fs = None
-    ts = np.ndarray((num_records * _CSC_SAMPLES_PER_RECORD, ), dtype=np.uint64)
-    data = np.ndarray((num_records * _CSC_SAMPLES_PER_RECORD, ))
+    # keep the native int16 samples. flattening the strided record view makes the only copy, at 2 bytes per sample
+    data = records['samples'].reshape(-1)[:len(ts)]
 
-    with open(csc_file_path, 'rb') as data_file:
-        header = data_file.read(_CSC_HEADER_SIZE)
-        header_data = parse_header(header)
-
-        # first_ts_r: Cheetah timestamp for this record. This corresponds to the sample time for the first data point
-        # in the data array, in MICROseconds. This timestamp appears not to have any real-world meaning.
-        # channel_number_r: The channel number for this record. This is NOT the A/D channel number.
-        # Fs_r: The sampling frequency (Hz) for the data array.
-        # num_valid_samples_r: Number of values in the data array containing valid data (max 512).
-        # NOTE: for nested progress bars on Windows, the colorama package is required
-        if use_tqdm:
-            record_iter = trange(num_records, desc='Reading raw data: %s' % csc_file_path.stem, leave=False)
-        else:
-            record_iter = range(num_records)
-        for record_ind in record_iter:
-            read_record_header = data_file.read(_CSC_RECORD_HEADER_SIZE)
-            first_ts_r, channel_number_r, Fs_r, num_valid_samples_r = unpack('<QIII', read_record_header)
-
-            if record_ind == 0:
-                channel_number = channel_number_r
-                Fs = Fs_r
-            else:  # verify matching record
-                # first timestamp of the record might not be what we expect it to be -- see warning later
-                if channel_number != channel_number_r:
-                    raise InconsistentInputException('Channel number is not consistent across records.')
-                if Fs != Fs_r:
-                    raise InconsistentInputException('Sampling rate is not consistent across records.')
-
-            # OK if last record has fewer than 512 valid samples -- handle in delete below
-            if record_ind < num_records - 1 and num_valid_samples_r != _CSC_SAMPLES_PER_RECORD:
-                raise UnexpectedInputException('Record %d has %d valid samples instead of %d. These data need '
-                                               'to be handled specially.')
-
-            data_ind_start = record_ind * _CSC_SAMPLES_PER_RECORD
-            data_ind_end = data_ind_start + _CSC_SAMPLES_PER_RECORD
-            ts[data_ind_start:data_ind_end] = np.arange(first_ts_r,
-                                                        first_ts_r + _CSC_SAMPLES_PER_RECORD * 1e6 / Fs,
-                                                        1e6 / Fs)
-            data[data_ind_start:data_ind_end] = np.fromfile(data_file, dtype='<h', count=_CSC_SAMPLES_PER_RECORD)
-
-        # there should not be any leftover data in the file
-        leftover_data = data_file.read()
-        assert(not leftover_data)
-
-        # delete invalid entries if last num_valid_samples_r != samples_per_record
-        ts = np.delete(ts, np.s_[-(_CSC_SAMPLES_PER_RECORD - num_valid_samples_r):])
-        data = np.delete(data, np.s_[-(_CSC_SAMPLES_PER_RECORD - num_valid_samples_r):])
-
-        # check that final timestamp makes sense
-        # NOTE: a discrepancy of 1 us occurs approximately once every 155-157 records, resulting in a sampling rate
-        # just larger than 32 kHz
-        expected_last_ts = ts[0] + len(ts) * 1e6 / Fs
-        if abs(expected_last_ts - ts[-1]) > 0:
-            warn(('Last timestamp expected to be %d us based on starting time and sampling rate, but got %d us '
-                  '(difference of %0.3f ms). Actual sampling rate may be %f Hz.')
-                 % (expected_last_ts, ts[-1], (expected_last_ts - ts[-1]) / 1000, 1e6 * len(ts) / (ts[-1] - ts[0])))
-
-        return header_data, ts, data
+    # check that final timestamp makes sense
+    # NOTE: a discrepancy of 1 us occurs approximately once every 155-157 records, resulting in a sampling rate
+    # just larger than 32 kHz
+    expected_last_ts = ts[0] + len(ts) * 1e6 / Fs
+    if abs(expected_last_ts - ts[-1]) > 0:
+        warn(('Last timestamp expected to be %d us based on starting time and sampling rate, but got %d us '
+              '(difference of %0.3f ms). Actual sampling rate may be %f Hz.')
+             % (expected_last_ts, ts[-1], (expected_last_ts - ts[-1]) / 1000, 1e6 * len(ts) / (ts[-1] - ts[0])))
+
+    return header_data, ts, data
 
 
 def get_csc_file_header_info(raw_nlx_path):
     """Get header info from a CSC .ncs file."""
-    # get paths to all CSC data files, excluding the 16 kB header files with '_' in the name
+    # get the first CSC data file, excluding the 16 kB header files with '_' in the name
     data_files = natsorted([x.name for x in raw_nlx_path.glob('CSC*.ncs') if '_' not in x.stem])
-    data_paths = [raw_nlx_path / x for x in data_files]
+    return read_csc_header(raw_nlx_path / data_files[0])
 
-    with open(data_paths[0], 'rb') as data_file:
-        header = data_file.read(_CSC_HEADER_SIZE)
-        header_data = parse_header(header)
-    return header_data
+
+class CscDirectory:
+    """Directory of raw NLX CSC .ncs files, scanned once and shared by all stages of a conversion.
+
+    The directory is listed once, and the headers of all files are read and parsed concurrently. The parsed headers,
+    file sizes and record counts are kept, and the full index of each file (see index_csc_file) is computed on first
+    use and kept as well.
+
+    With an index cache, no file is indexed up front. Instead, the data chunk iterators that write the raw data report
+    the samples whose records they checked (see add_checked_samples). Once all the samples of a file were checked, it
+    is indexed without being read again and its index is stored in the cache. In repeated conversions, the files with
+    a cached index are validated (see is_validated), and the iterators skip their per-block record checks.
+
+    Parameters
+    ----------
+    raw_nlx_path : Path
+        Path of directory of raw NLX CSC files.
+    num_workers : int
+        Number of threads reading the headers.
+    index_cache : CscIndexCache
+        Cache of the CSC file indexes, used to skip validating the files again in repeated conversions.
+    allow_partial_records : bool
+        Whether to allow files with a partially written last record, e.g. while Cheetah is still recording. Only the
+        complete records are counted, and the index cache is not used, since the files may still grow.
+
+    """
+
+    def __init__(self, raw_nlx_path, num_workers=16, index_cache=None, allow_partial_records=False):
+        self.path = Path(raw_nlx_path)
+        self.index_cache = None if allow_partial_records else index_cache
+        self.allow_partial_records = allow_partial_records
+
+        # get paths to all CSC data files, excluding the 16 kB header files with '_' in the name
+        self.electrode_labels = natsorted([x.stem for x in self.path.glob('CSC*.ncs') if '_' not in x.stem])
+        self.data_paths = [self.path / (x + '.ncs') for x in self.electrode_labels]
+
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            scans = list(pool.map(self._scan_file, self.data_paths))
+        self.headers = [header for header, _, _ in scans]
+        self.file_sizes = [file_size for _, file_size, _ in scans]
+        self.num_records = [num_records for _, _, num_records in scans]
+        self._indexes = dict()
+        self._checked_samples = dict()
+
+    def _scan_file(self, csc_file_path):
+        file_size = csc_file_path.stat().st_size
+        num_records = check_num_records(csc_file_path, file_size=file_size, allow_partial=self.allow_partial_records)
+        return read_csc_header(csc_file_path), file_size, num_records
+
+    def __len__(self):
+        return len(self.data_paths)
+
+    def get_index(self, i):
+        """Get the index of the i-th file, see index_csc_file."""
+        if i not in self._indexes:
+            self._indexes[i] = index_csc_file(self.data_paths[i], cache=self.index_cache)
+        return self._indexes[i]
+
+    def get_cached_index(self, i):
+        """Get the index of the i-th file if it was already computed or is in the index cache, otherwise None.
+
+        The file is not read.
+        """
+        if i not in self._indexes and self.index_cache is not None:
+            index = self.index_cache.get(self.data_paths[i])
+            if index is not None:
+                self._indexes[i] = index
+        return self._indexes.get(i)
+
+    def is_validated(self, channel_indices=None):
+        """Whether files were validated by check_csc_records or by the checks of a data chunk iterator.
+
+        Parameters
+        ----------
+        channel_indices : list of int
+            Indices of the files. Defaults to all files.
+
+        Returns
+        -------
+        bool
+            True if every file has an index, computed in this conversion or read from the index cache.
+
+        """
+        if channel_indices is None:
+            channel_indices = range(len(self))
+        return all(self.get_cached_index(i) is not None for i in channel_indices)
+
+    def add_checked_samples(self, channel_indices, start_sample, num_samples):
+        """Record that a data chunk iterator checked the records of samples of files, and index the complete files.
+
+        Once all the samples of a file were checked, its records passed the checks of check_csc_records. The file is
+        then indexed from the index of the first file, whose timestamps it shares, without reading it again, and the
+        index is stored in the index cache. Only its first and last records are read, to confirm the shared timestamps.
+
+        Parameters
+        ----------
+        channel_indices : list of int
+            Indices of the files.
+        start_sample : int
+            Index of the first checked sample.
+        num_samples : int
+            Number of checked samples.
+
+        """
+        reference = self.get_index(0)
+        for i in channel_indices:
+            checked = self._checked_samples.setdefault(i, set())
+            checked.add((start_sample, num_samples))
+            if i in self._indexes or self.num_records[i] != reference['num_records']:
+                continue
+            # number of samples in the union of the checked ranges
+            num_checked, checked_stop = 0, 0
+            for start, n in sorted(checked):
+                num_checked += max(0, start + n - max(start, checked_stop))
+                checked_stop = max(checked_stop, start + n)
+            if num_checked != reference['num_samples']:
+                continue
+
+            first_record = read_csc_records_at(self.data_paths[i], 0, 1)[0]
+            last_record = read_csc_records_at(self.data_paths[i], self.num_records[i] - 1, 1)[0]
+            num_file_samples = ((self.num_records[i] - 1) * _CSC_SAMPLES_PER_RECORD
+                                + int(last_record['num_valid_samples']))
+            if (int(first_record['timestamp']) != reference['first_timestamp']
+                    or int(last_record['timestamp']) != reference['last_timestamp']
+                    or num_file_samples != reference['num_samples']):
+                continue
+            index = dict(reference,
+                         header=self.headers[i],
+                         channel_number=int(first_record['channel_number']),
+                         sampling_frequency=float(first_record['sampling_frequency']))
+            self._indexes[i] = index
+            if self.index_cache is not None:
+                self.index_cache.put(self.data_paths[i], index)
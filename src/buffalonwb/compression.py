@@ -0,0 +1,238 @@
+import numpy as np
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+from hdmf.data_utils import DataChunkIterator
+
+
+# codecs built into h5py
+_H5PY_CODECS = {'gzip', 'lzf'}
+
+# codecs provided by the hdf5plugin package
+_HDF5PLUGIN_CODECS = {'blosc', 'blosc-zstd', 'zstd', 'bitshuffle'}
+
+_DEFAULT_LEVELS = {'gzip': 4, 'blosc': 5, 'blosc-zstd': 5, 'zstd': 3, 'bitshuffle': 3}
+
+COMPRESSION_CODECS = sorted(_H5PY_CODECS | _HDF5PLUGIN_CODECS)
+
+
+def get_compression_kwargs(compression=None, compression_level=None, shuffle=False):
+    """Get the h5py dataset keyword arguments for a compression codec.
+
+    Parameters
+    ----------
+    compression : str
+        One of COMPRESSION_CODECS, or None for no compression. 'blosc', 'blosc-zstd', 'zstd' and 'bitshuffle' require
+        the hdf5plugin package.
+    compression_level : int
+        Compression level. Ignored for 'lzf'. Defaults to a moderate level for each codec.
+    shuffle : bool
+        Whether to shuffle bytes before compression. For 'blosc' this is the Blosc internal shuffle; 'bitshuffle'
+        always shuffles bits.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for h5py.Group.create_dataset.
+
+    Raises
+    ------
+    ValueError
+        if the codec is not supported.
+    ImportError
+        if the codec requires hdf5plugin and it is not installed.
+
+    """
+    if compression is None or compression == 'none':
+        return dict()
+    if compression not in _H5PY_CODECS | _HDF5PLUGIN_CODECS:
+        raise ValueError('compression must be one of %s: %s' % (', '.join(COMPRESSION_CODECS), compression))
+    if compression_level is None:
+        compression_level = _DEFAULT_LEVELS.get(compression)
+
+    if compression == 'gzip':
+        return dict(compression='gzip', compression_opts=compression_level, shuffle=shuffle)
+    if compression == 'lzf':
+        return dict(compression='lzf', shuffle=shuffle)
+
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError("The hdf5plugin package is required for '%s' compression: pip install hdf5plugin"
+                          % compression)
+    if compression in ('blosc', 'blosc-zstd'):
+        cname = 'lz4' if compression == 'blosc' else 'zstd'
+        blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE
+        return dict(hdf5plugin.Blosc(cname=cname, clevel=compression_level, shuffle=blosc_shuffle))
+    if compression == 'zstd':
+        return dict(shuffle=shuffle, **hdf5plugin.Zstd(clevel=compression_level))
+    return dict(hdf5plugin.Bitshuffle(cname='zstd', clevel=compression_level))
+
+
+def get_h5dataio(data, chunk_shape=None, compression=None, compression_level=None, shuffle=False, shape=None,
+                 dtype=None, maxshape=None):
+    """Wrap data in an H5DataIO with the given chunking and compression.
+
+    Parameters
+    ----------
+    data : np.array or AbstractDataChunkIterator
+        The data to wrap, or None to preallocate an empty dataset of the given shape and dtype.
+    chunk_shape : tuple
+        Shape of the HDF5 chunks. Defaults to the chunk shape recommended by a data chunk iterator, or to h5py
+        auto-chunking when compression is used.
+    compression : str
+        One of COMPRESSION_CODECS, or None for no compression.
+    compression_level : int
+        Compression level.
+    shuffle : bool
+        Whether to shuffle bytes before compression.
+    shape : tuple
+        Shape of the empty dataset, if data is None.
+    dtype : np.dtype
+        Data type of the empty dataset, if data is None.
+    maxshape : tuple
+        Maximum shape of the empty dataset, if data is None, with None for resizable dimensions. Requires chunking.
+
+    Returns
+    -------
+    H5DataIO or np.array or AbstractDataChunkIterator
+        The wrapped data, or the data unchanged if no chunking or compression is requested.
+
+    """
+    kwargs = get_compression_kwargs(compression=compression, compression_level=compression_level, shuffle=shuffle)
+    if chunk_shape is not None:
+        kwargs.update(chunks=tuple(chunk_shape))
+    if data is None:
+        kwargs.update(shape=tuple(shape), dtype=dtype)
+        if maxshape is not None:
+            kwargs.update(maxshape=tuple(maxshape))
+    elif not kwargs:
+        return data
+    if compression in _HDF5PLUGIN_CODECS:
+        kwargs.update(allow_plugin_filters=True)
+    return H5DataIO(data=data, **kwargs)
+
+
+def get_zarr_compression_kwargs(compression=None, compression_level=None, shuffle=False, itemsize=2):
+    """Get the ZarrDataIO keyword arguments for a compression codec.
+
+    Parameters
+    ----------
+    compression : str
+        One of COMPRESSION_CODECS except 'lzf', or None for no compression. The codecs are provided by the numcodecs
+        package, which hdmf-zarr depends on.
+    compression_level : int
+        Compression level. Defaults to a moderate level for each codec.
+    shuffle : bool
+        Whether to shuffle bytes before compression. For 'blosc' this is the Blosc internal shuffle; 'bitshuffle'
+        always shuffles bits.
+    itemsize : int
+        Size in bytes of the elements of the data, for the shuffle filter.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for hdmf_zarr.ZarrDataIO.
+
+    Raises
+    ------
+    ValueError
+        if the codec is not supported.
+    ImportError
+        if the numcodecs package is not installed.
+
+    """
+    if compression is None or compression == 'none':
+        return dict()
+    if compression not in _H5PY_CODECS | _HDF5PLUGIN_CODECS or compression == 'lzf':
+        raise ValueError('compression must be one of %s for the Zarr backend: %s'
+                         % (', '.join(c for c in COMPRESSION_CODECS if c != 'lzf'), compression))
+    if compression_level is None:
+        compression_level = _DEFAULT_LEVELS.get(compression)
+
+    try:
+        import numcodecs
+    except ImportError:
+        raise ImportError("The hdmf-zarr package is required for the Zarr backend: pip install hdmf-zarr")
+    if compression in ('blosc', 'blosc-zstd', 'bitshuffle'):
+        cname = 'lz4' if compression == 'blosc' else 'zstd'
+        if compression == 'bitshuffle':
+            blosc_shuffle = numcodecs.Blosc.BITSHUFFLE
+        else:
+            blosc_shuffle = numcodecs.Blosc.SHUFFLE if shuffle else numcodecs.Blosc.NOSHUFFLE
+        return dict(compressor=numcodecs.Blosc(cname=cname, clevel=compression_level, shuffle=blosc_shuffle))
+    filters = [numcodecs.Shuffle(elementsize=itemsize)] if shuffle else None
+    if compression == 'gzip':
+        return dict(compressor=numcodecs.GZip(level=compression_level), filters=filters)
+    return dict(compressor=numcodecs.Zstd(level=compression_level), filters=filters)
+
+
+def get_zarr_dataio(data, chunk_shape=None, compression=None, compression_level=None, shuffle=False, shape=None,
+                    dtype=None):
+    """Wrap data in a ZarrDataIO with the given chunking and compression.
+
+    Parameters
+    ----------
+    data : np.array or AbstractDataChunkIterator
+        The data to wrap, or None to preallocate an empty array of the given shape and dtype.
+    chunk_shape : tuple
+        Shape of the Zarr chunks. Defaults to the chunk shape recommended by a data chunk iterator.
+    compression : str
+        One of COMPRESSION_CODECS except 'lzf', or None for no compression.
+    compression_level : int
+        Compression level.
+    shuffle : bool
+        Whether to shuffle bytes before compression.
+    shape : tuple
+        Shape of the empty array, if data is None.
+    dtype : np.dtype
+        Data type of the empty array, if data is None.
+
+    Returns
+    -------
+    ZarrDataIO or np.array or AbstractDataChunkIterator
+        The wrapped data, or the data unchanged if no chunking or compression is requested.
+
+    Raises
+    ------
+    ImportError
+        if the hdmf-zarr package is not installed.
+
+    """
+    itemsize = np.dtype(dtype if data is None else getattr(data, 'dtype', None)).itemsize
+    kwargs = get_zarr_compression_kwargs(compression=compression, compression_level=compression_level,
+                                         shuffle=shuffle, itemsize=itemsize)
+    if chunk_shape is not None:
+        kwargs.update(chunks=list(chunk_shape))
+    if data is None:
+        # an iterator without data is written as an empty array of its full shape
+        data = DataChunkIterator(data=None, maxshape=tuple(shape), dtype=np.dtype(dtype))
+    elif not kwargs:
+        return data
+
+    try:
+        from hdmf_zarr import ZarrDataIO
+    except ImportError:
+        raise ImportError("The hdmf-zarr package is required for the Zarr backend: pip install hdmf-zarr")
+    return ZarrDataIO(data=data, **kwargs)
+
+
+def get_dataio(data, backend='hdf5', **kwargs):
+    """Wrap data for the given storage backend, see get_h5dataio and get_zarr_dataio for the keyword arguments.
+
+    Parameters
+    ----------
+    data : np.array or AbstractDataChunkIterator
+        The data to wrap, or None to preallocate an empty dataset.
+    backend : str
+        'hdf5' or 'zarr'.
+
+    Returns
+    -------
+    DataIO or np.array or AbstractDataChunkIterator
+        The wrapped data.
+
+    """
+    if backend == 'hdf5':
+        return get_h5dataio(data, **kwargs)
+    if backend == 'zarr':
+        return get_zarr_dataio(data, **kwargs)
+    raise ValueError("backend must be 'hdf5' or 'zarr': %s" % backend)
@@ -1,13 +1,19 @@
 from pynwb import NWBHDF5IO, NWBFile
 
 from buffalonwb import __version__
-from buffalonwb.add_raw_nlx_data import add_raw_nlx_data, get_csc_file_header_info
+from buffalonwb.add_nlx_records import add_nlx_records
+from buffalonwb.add_raw_nlx_data import CscDirectory, add_raw_nlx_data
 from buffalonwb.add_units import add_units, get_t0_nex5
 from buffalonwb.add_behavior import add_behavior, get_t0_behavior
-from buffalonwb.add_processed_nlx_data import add_lfp
+from buffalonwb.add_processed_nlx_data import LFP_DTYPES, add_lfp
+from buffalonwb.compression import COMPRESSION_CODECS
+from buffalonwb.csc_index_cache import CscIndexCache
+from buffalonwb.raw_preview import write_raw_previews
+from buffalonwb.write_raw_nlx_data import (get_raw_journal_path, write_raw_nlx_data_parallel,
+                                           write_raw_nlx_data_live, write_raw_nlx_data_parts,
+                                           write_raw_nlx_data_resumable, write_raw_nlx_data_zarr)
 from nexfile import nexfile
 
-from natsort import natsorted
 from pathlib import Path
 import numpy as np
 import ruamel.yaml as yaml
@@ -16,7 +22,13 @@ import math
 import argparse
 
 
-def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed, no_lfp_iterator):
+def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed, no_lfp_iterator,
+                        raw_iterator='block', raw_buffer_mb=1024., raw_dataset_options=None,
+                        lfp_dataset_options=None, raw_compression_workers=None, index_cache_dir=None,
+                        raw_resumable=False, raw_time_range=None, raw_channels=None, backend='hdf5',
+                        raw_parts=None, raw_live=False, raw_live_idle_timeout=60.,
+                        raw_scratch_dir=None, raw_preview_rate=None, raw_nlx_records=False, lfp_dtype='float64',
+                        lfp_scaling='global', lfp_workers=None, lfp_iterator='block'):
     """
     Main function for conversion of Buffalo lab data from Neuralynx/Matlab/Neuroexplorer formats to NWB.
 
@@ -30,7 +42,8 @@ def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed,
          'processed behavior': {'type': 'file', 'path': ''}}
     f_nwb : str
         Stem to output file. Two files might be produced using this stem:
-        'f_nwb_raw.nwb' and 'f_nwb_processed.nwb'
+        'f_nwb_raw.nwb' and 'f_nwb_processed.nwb', or 'f_nwb_raw.nwb.zarr' and 'f_nwb_processed.nwb.zarr' with the
+        Zarr backend
     metadata : dict
         Metadata dictionary.
     skip_raw : bool
@@ -38,7 +51,68 @@ def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed,
     skip_processed : bool
         Whether to skip adding processed data to the file.
     no_lfp_iterator : bool
-        Whether to not use a data chunk iterator over channels for the LFP data.
+        Whether to not use a data chunk iterator for the LFP data.
+    raw_iterator : str
+        'block' to write the raw data in aligned time blocks of all channels, 'transpose' to first stream each channel
+        into a scratch file and then write aligned time blocks from it, or 'channel' to write one channel at a time.
+    raw_buffer_mb : float
+        Size of the time blocks of raw data read from all channels at once, in MB. With raw_iterator 'transpose', the
+        RAM ceiling of the transpose.
+    raw_dataset_options : dict
+        HDF5 layout of the raw data, with optional keys 'chunk_shape', 'compression', 'compression_level' and
+        'shuffle'. e.g.: {'compression': 'gzip', 'compression_level': 4, 'shuffle': True}
+        See buffalonwb.compression.COMPRESSION_CODECS for the supported codecs.
+    lfp_dataset_options : dict
+        HDF5 layout of the LFP data, with the same keys as raw_dataset_options.
+    lfp_dtype : str
+        Storage type of the LFP data, 'float64', 'float32', or 'int16' scaled by a conversion computed from the range
+        of the LFP, which stores NaN values as 0. Only the electrodes with a processed file are stored.
+    lfp_scaling : str
+        With lfp_dtype 'int16', 'global' for one conversion for all channels, or 'channel' for a conversion per channel
+        (the channel_conversion of the ElectricalSeries).
+    lfp_workers : int
+        If set, read the processed files concurrently in a pool of this many processes: the time blocks of each
+        channel with lfp_iterator 'block', otherwise whole channels. The data are still written in order.
+    lfp_iterator : str
+        'block' to write the LFP data in aligned time blocks of all channels read from all processed files at once, or
+        'channel' to write one channel at a time. Ignored with no_lfp_iterator.
+    raw_compression_workers : int
+        If set, compress the raw data chunks with this many workers and write them directly to the preallocated
+        dataset after the NWB file is written. Only gzip compression is supported in this mode with the HDF5 backend.
+        With the Zarr backend, this many processes write disjoint chunks of the raw data concurrently.
+    index_cache_dir : str
+        Directory of a cache of the CSC file indexes (record counts, timestamps, headers and gaps), so that repeated
+        conversions skip validating unchanged files again.
+    raw_resumable : bool
+        Whether to write the raw data in checkpointed time blocks. If the conversion is interrupted, e.g. by SIGINT or
+        SIGTERM, running it again with the same arguments resumes from the last completed block.
+    raw_time_range : tuple of float
+        Start and end, in seconds relative to the first sample of the recording, of a time window of raw data to
+        convert. Only the records in the window are read. Defaults to the whole recording.
+    raw_channels : list of str or int
+        Electrode labels (e.g. 'CSC1') or indices of the channels of raw data to convert. Defaults to all channels.
+    backend : str
+        Storage backend of the output files, 'hdf5' or 'zarr'. The Zarr backend writes directory stores and requires
+        the hdmf-zarr package.
+    raw_parts : int
+        If set, write the raw data as this many channel groups in separate part files from parallel processes, next to
+        'f_nwb_raw.nwb', which exposes them as one ElectricalSeries through an HDF5 virtual dataset. The part files
+        must be kept in the same directory as 'f_nwb_raw.nwb'.
+    raw_live : bool
+        Whether to convert the raw data while Cheetah is still writing the CSC files. The records are appended to
+        'f_nwb_raw.nwb' as they are completed, and the files are validated when they stop growing.
+    raw_live_idle_timeout : float
+        Time in seconds without new records after which a live recording is considered finished.
+    raw_scratch_dir : str
+        Directory of the scratch files of raw_iterator 'transpose' and of the raw previews, ideally on a local SSD.
+        Defaults to the system temporary directory.
+    raw_preview_rate : float
+        If set, also write an anti-aliased preview of the raw data decimated to about this rate in Hz, e.g. 1000.,
+        computed in the same pass over the CSC files, to the 'ecephys' processing module of 'f_nwb_raw.nwb'. Not
+        supported with raw_live.
+    raw_nlx_records : bool
+        Whether to also add the events (.nev), video tracking (.nvt) and tetrode spikes (.ntt) files of the raw NLX
+        directory to 'f_nwb_raw.nwb'.
 
     """
 
@@ -47,17 +121,23 @@ def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed,
     if raw_nlx_path is None:
         raise ValueError('Raw NLX file is required for getting the nub: %s' % sorted_spikes_nex5_file)
 
+    # Scan the raw nlx directory once, the headers and file indexes are shared by all stages of the conversion
+    index_cache = CscIndexCache(index_cache_dir) if index_cache_dir else None
+    csc_directory = CscDirectory(raw_nlx_path, index_cache=index_cache, allow_partial_records=raw_live)
+
     # Output files
+    io_class = get_nwb_io_class(backend)
+    suffix = '.nwb.zarr' if backend == 'zarr' else '.nwb'
     nwbpath = Path(f_nwb).parent
-    out_file_raw = str(nwbpath.joinpath(Path(f_nwb).stem + '_raw.nwb'))
-    out_file_processed = str(nwbpath.joinpath(Path(f_nwb).stem + '_processed.nwb'))
+    out_file_raw = str(nwbpath.joinpath(Path(f_nwb).stem + '_raw' + suffix))
+    out_file_processed = str(nwbpath.joinpath(Path(f_nwb).stem + '_processed' + suffix))
 
     # Get electrode labels from raw nlx directory file names
-    electrode_labels = natsorted([x.stem for x in raw_nlx_path.glob('CSC*.ncs') if '_' not in x.stem])
+    electrode_labels = csc_directory.electrode_labels
 
     # localize session start time to Pacific time for Buffalo Lab
     # Get session_start_time from CSC 'TimeCreated' field, it does not contain Milliseconds
-    header = get_csc_file_header_info(raw_nlx_path=raw_nlx_path)
+    header = csc_directory.headers[0]
     metadata['NWBFile']['session_start_time'] = pytz.timezone('US/Pacific').localize(
         header['TimeCreated']
     )
@@ -65,30 +145,76 @@ def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed,
     if skip_raw:
         print("Skipping raw data...")
     if not skip_raw:
-        # Build NWB file
-        nwb_raw = NWBFile(**metadata['NWBFile'])
+        check_raw_options(backend=backend, raw_compression_workers=raw_compression_workers,
+                          raw_resumable=raw_resumable, raw_parts=raw_parts, raw_live=raw_live,
+                          raw_preview_rate=raw_preview_rate, raw_nlx_records=raw_nlx_records)
+
+        # An interrupted resumable conversion continues in the partial file from its progress journal
+        resume_raw = raw_resumable and get_raw_journal_path(out_file_raw).exists() and Path(out_file_raw).exists()
+        if not resume_raw:
+            # Build NWB file
+            nwb_raw = NWBFile(**metadata['NWBFile'])
+
+            # Add device and electrodes based on given metadata and electrode labels
+            electrode_table_region = add_electrodes(
+                nwbfile=nwb_raw,
+                metadata_ecephys=metadata['Ecephys'],
+                num_electrodes=len(electrode_labels),
+                electrode_labels=electrode_labels
+            )
 
-        # Add device and electrodes based on given metadata and electrode labels
-        electrode_table_region = add_electrodes(
-            nwbfile=nwb_raw,
-            metadata_ecephys=metadata['Ecephys'],
-            num_electrodes=len(electrode_labels),
-            electrode_labels=electrode_labels
-        )
+            # Add raw data
+            raw_previews = add_raw_nlx_data(
+                nwbfile=nwb_raw,
+                raw_nlx_path=raw_nlx_path,
+                electrode_table_region=electrode_table_region,
+                raw_iterator=raw_iterator,
+                buffer_mb=raw_buffer_mb,
+                compression_workers=raw_compression_workers,
+                csc_directory=csc_directory,
+                preallocate=raw_resumable or bool(raw_parts),
+                time_range=raw_time_range,
+                channels=raw_channels,
+                backend=backend,
+                live=raw_live,
+                scratch_dir=raw_scratch_dir,
+                preview_rate=raw_preview_rate,
+                **(raw_dataset_options or dict())
+            )
 
-        # Add raw data
-        add_raw_nlx_data(
-            nwbfile=nwb_raw,
+            # Add events, video tracking and tetrode spikes recorded with the CSC files
+            if raw_nlx_records:
+                add_nlx_records(
+                    nwbfile=nwb_raw,
+                    raw_nlx_path=raw_nlx_path,
+                    csc_directory=csc_directory,
+                )
+
+            # Write raw data to NWB file
+            print('Writing to file: ' + out_file_raw)
+            with io_class(out_file_raw, mode='w') as io:
+                io.write(nwb_raw)
+            if raw_previews:
+                write_raw_previews(out_file_raw, raw_previews)
+            print(nwb_raw)
+
+        # Fill the preallocated raw dataset, or append to it while Cheetah is writing
+        fill_raw_data(
+            nwb_path=out_file_raw,
             raw_nlx_path=raw_nlx_path,
-            electrode_table_region=electrode_table_region,
+            csc_directory=csc_directory,
+            backend=backend,
+            raw_buffer_mb=raw_buffer_mb,
+            raw_dataset_options=raw_dataset_options,
+            raw_compression_workers=raw_compression_workers,
+            raw_resumable=raw_resumable,
+            raw_time_range=raw_time_range,
+            raw_channels=raw_channels,
+            raw_parts=raw_parts,
+            raw_live=raw_live,
+            raw_live_idle_timeout=raw_live_idle_timeout,
         )
 
-        # Write raw data to NWB file
-        print('Writing to file: ' + out_file_raw)
-        with NWBHDF5IO(out_file_raw, mode='w') as io:
-            io.write(nwb_raw)
-        print(nwb_raw)
-
     if skip_processed:
         print("Skipping processed data...")
     else:
@@ -135,14 +261,116 @@ def conversion_function(source_paths, f_nwb, metadata, skip_raw, skip_processed,
                 electrodes=electrode_table_region,
                 iterator_flag=not no_lfp_iterator,
                 all_electrode_labels=electrode_labels,
+                backend=backend,
+                dtype=lfp_dtype,
+                scaling=lfp_scaling,
+                num_workers=lfp_workers,
+                iterator=lfp_iterator,
+                **(lfp_dataset_options or dict())
             )
 
         # Write processed data to NWB file
         print('Writing to file: ' + out_file_processed)
-        with NWBHDF5IO(out_file_processed, mode='w') as io:
+        with io_class(out_file_processed, mode='w') as io:
             io.write(nwb_proc)
 
 
+def check_raw_options(backend='hdf5', raw_compression_workers=None, raw_resumable=False, raw_parts=None,
+                      raw_live=False, raw_preview_rate=None, raw_nlx_records=False):
+    """Check that the raw data options of conversion_function can be used together.
+
+    Raises
+    ------
+    ValueError
+        if the options cannot be used together.
+
+    """
+    if raw_resumable and raw_compression_workers:
+        raise ValueError('raw_resumable and raw_compression_workers cannot be used together.')
+    if raw_resumable and backend != 'hdf5':
+        raise ValueError('raw_resumable is only supported with the HDF5 backend.')
+    if raw_parts and (raw_resumable or raw_compression_workers or backend != 'hdf5'):
+        raise ValueError('raw_parts cannot be used with raw_resumable, raw_compression_workers or the Zarr '
+                         'backend.')
+    if raw_live and (raw_resumable or raw_compression_workers or raw_parts):
+        raise ValueError('raw_live cannot be used with raw_resumable, raw_compression_workers or raw_parts.')
+    if raw_live and raw_nlx_records:
+        raise ValueError('raw_nlx_records cannot be used with raw_live, the files are still being written.')
+    if raw_live and raw_preview_rate is not None:
+        raise ValueError('raw_preview_rate cannot be used with raw_live, the files are still being written.')
+
+
+def fill_raw_data(nwb_path, raw_nlx_path, csc_directory, backend='hdf5', raw_buffer_mb=1024.,
+                  raw_dataset_options=None, raw_compression_workers=None, raw_resumable=False, raw_time_range=None,
+                  raw_channels=None, raw_parts=None, raw_live=False, raw_live_idle_timeout=60.):
+    """Write the raw data to the dataset preallocated in the written raw NWB file, see conversion_function.
+
+    Nothing is written if the raw data was already written with the NWB file by a data chunk iterator.
+    """
+    if raw_compression_workers and backend == 'zarr':
+        write_raw_nlx_data_zarr(
+            nwb_path=nwb_path,
+            raw_nlx_path=raw_nlx_path,
+            num_workers=raw_compression_workers,
+            buffer_mb=raw_buffer_mb,
+            csc_directory=csc_directory,
+            time_range=raw_time_range,
+            channels=raw_channels,
+        )
+    elif raw_compression_workers:
+        write_raw_nlx_data_parallel(
+            nwb_path=nwb_path,
+            raw_nlx_path=raw_nlx_path,
+            num_workers=raw_compression_workers,
+            buffer_mb=raw_buffer_mb,
+            csc_directory=csc_directory,
+            time_range=raw_time_range,
+            channels=raw_channels,
+        )
+    if raw_live:
+        write_raw_nlx_data_live(
+            nwb_path=nwb_path,
+            raw_nlx_path=raw_nlx_path,
+            idle_timeout=raw_live_idle_timeout,
+            buffer_mb=raw_buffer_mb,
+            csc_directory=csc_directory,
+            channels=raw_channels,
+        )
+    if raw_parts:
+        write_raw_nlx_data_parts(
+            nwb_path=nwb_path,
+            raw_nlx_path=raw_nlx_path,
+            num_parts=raw_parts,
+            buffer_mb=raw_buffer_mb,
+            csc_directory=csc_directory,
+            time_range=raw_time_range,
+            channels=raw_channels,
+            **(raw_dataset_options or dict())
+        )
+    if raw_resumable:
+        write_raw_nlx_data_resumable(
+            nwb_path=nwb_path,
+            raw_nlx_path=raw_nlx_path,
+            buffer_mb=raw_buffer_mb,
+            csc_directory=csc_directory,
+            time_range=raw_time_range,
+            channels=raw_channels,
+        )
+
+
+def get_nwb_io_class(backend='hdf5'):
+    """Get the NWB IO class of a storage backend, 'hdf5' (NWBHDF5IO) or 'zarr' (hdmf_zarr.nwb.NWBZarrIO)."""
+    if backend == 'hdf5':
+        return NWBHDF5IO
+    if backend == 'zarr':
+        try:
+            from hdmf_zarr.nwb import NWBZarrIO
+        except ImportError:
+            raise ImportError("The hdmf-zarr package is required for the Zarr backend: pip install hdmf-zarr")
+        return NWBZarrIO
+    raise ValueError("backend must be 'hdf5' or 'zarr': %s" % backend)
+
+
 def check_source_paths(source_paths):
     key = 'raw Nlx'
     raw_nlx_path = None
@@ -240,7 +468,10 @@ if __name__ == '__main__':
         help="Show the version, and exit.",
     )
     parser.add_argument(
-        "raw_nlx_dir", help="The path to the directory holding raw Neuralynx CSC files."
+        "raw_nlx_dir",
+        help="The path to the directory holding raw Neuralynx CSC files. If the recording has gaps, e.g. when Cheetah "
+             "was paused, the continuous segments between them are written as 'ElectricalSeries', "
+             "'ElectricalSeriesSegment1', 'ElectricalSeriesSegment2', etc.",
     )
     parser.add_argument(
         "processed_mat_dir", help="The path to the directory holding processed .mat files."
@@ -275,6 +506,144 @@ if __name__ == '__main__':
         default=False,
         help="Whether to use the LFP channel iterator",
     )
+    parser.add_argument(
+        "--rawiterator",
+        choices=["block", "transpose", "channel"],
+        default="block",
+        help="Whether to write the raw data in time blocks of all channels, in time blocks transposed through a "
+             "scratch file, or one channel at a time",
+    )
+    parser.add_argument(
+        "--rawbuffermb",
+        type=float,
+        default=1024.,
+        help="Size of the time blocks of raw data read from all channels at once, in MB (with --rawiterator "
+             "transpose, the RAM ceiling of the transpose)",
+    )
+    parser.add_argument(
+        "--rawscratchdir",
+        default=None,
+        help="Directory of the scratch file of --rawiterator transpose, ideally on a local SSD",
+    )
+    parser.add_argument(
+        "--rawcompressionworkers",
+        type=int,
+        default=None,
+        help="Number of workers compressing raw data chunks in parallel (gzip only)",
+    )
+    parser.add_argument(
+        "--indexcachedir",
+        default=None,
+        help="Directory of a cache of the CSC file indexes, to skip validating unchanged files again",
+    )
+    parser.add_argument(
+        "--rawresumable",
+        action="store_true",
+        default=False,
+        help="Whether to write the raw data in checkpointed time blocks, resuming an interrupted conversion",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["hdf5", "zarr"],
+        default="hdf5",
+        help="Storage backend of the output files; zarr requires the hdmf-zarr package",
+    )
+    parser.add_argument(
+        "--rawparts",
+        type=int,
+        default=None,
+        help="Number of channel groups of raw data written to separate part files by parallel processes",
+    )
+    parser.add_argument(
+        "--rawlive",
+        action="store_true",
+        default=False,
+        help="Whether to convert the raw data while Cheetah is still writing the CSC files",
+    )
+    parser.add_argument(
+        "--rawliveidletimeout",
+        type=float,
+        default=60.,
+        help="Seconds without new records after which a live recording is considered finished",
+    )
+    parser.add_argument(
+        "--rawpreviewrate",
+        type=float,
+        default=None,
+        help="Rate in Hz of a decimated preview of the raw data computed in the same pass, e.g. 1000",
+    )
+    parser.add_argument(
+        "--nlxrecords",
+        action="store_true",
+        default=False,
+        help="Whether to also convert the .nev, .nvt and .ntt files of the raw NLX directory",
+    )
+    parser.add_argument(
+        "--rawtimerange",
+        type=float,
+        nargs=2,
+        default=None,
+        metavar=("START", "END"),
+        help="Time window of raw data to convert, in seconds from the first sample of the recording",
+    )
+    parser.add_argument(
+        "--rawchannels",
+        nargs="+",
+        default=None,
+        help="Electrode labels of the channels of raw data to convert, e.g. CSC1 CSC2",
+    )
+    parser.add_argument(
+        "--lfpdtype",
+        choices=LFP_DTYPES,
+        default="float64",
+        help="Storage type of the LFP data; int16 is scaled by a conversion computed from the range of the LFP, and "
+             "stores NaN values as 0",
+    )
+    parser.add_argument(
+        "--lfpscaling",
+        choices=["global", "channel"],
+        default="global",
+        help="Whether the int16 LFP conversion is the same for all channels or computed per channel",
+    )
+    parser.add_argument(
+        "--lfpiterator",
+        choices=["block", "channel"],
+        default="block",
+        help="Whether to write the LFP data in time blocks of all channels or one channel at a time",
+    )
+    parser.add_argument(
+        "--lfpworkers",
+        type=int,
+        default=None,
+        help="Number of processes reading processed LFP files concurrently",
+    )
+    for prefix in ("raw", "lfp"):
+        parser.add_argument(
+            "--%scompression" % prefix,
+            choices=COMPRESSION_CODECS,
+            default=None,
+            help="Compression codec of the %s data" % prefix.upper(),
+        )
+        parser.add_argument(
+            "--%scompressionlevel" % prefix,
+            type=int,
+            default=None,
+            help="Compression level of the %s data" % prefix.upper(),
+        )
+        parser.add_argument(
+            "--%sshuffle" % prefix,
+            action="store_true",
+            default=False,
+            help="Whether to shuffle bytes before compressing the %s data" % prefix.upper(),
+        )
+        parser.add_argument(
+            "--%schunkshape" % prefix,
+            type=int,
+            nargs=2,
+            default=None,
+            metavar=("TIME", "CHANNELS"),
+            help="Shape of the HDF5 chunks of the %s data" % prefix.upper(),
+        )
 
     if not sys.argv[1:]:
         args = parser.parse_args(["--help"])
@@ -293,4 +662,30 @@ if __name__ == '__main__':
                         metafile=args.metadata_yaml_file,
                         skip_raw=args.skipraw,
                         skip_processed=args.skipprocessed,
-                        no_lfp_iterator=args.nolfpiterator)
+                        no_lfp_iterator=args.nolfpiterator,
+                        raw_iterator=args.rawiterator,
+                        raw_buffer_mb=args.rawbuffermb,
+                        raw_compression_workers=args.rawcompressionworkers,
+                        index_cache_dir=args.indexcachedir,
+                        raw_resumable=args.rawresumable,
+                        raw_time_range=args.rawtimerange,
+                        raw_channels=args.rawchannels,
+                        backend=args.backend,
+                        raw_parts=args.rawparts,
+                        raw_live=args.rawlive,
+                        raw_live_idle_timeout=args.rawliveidletimeout,
+                        raw_scratch_dir=args.rawscratchdir,
+                        raw_preview_rate=args.rawpreviewrate,
+                        raw_nlx_records=args.nlxrecords,
+                        lfp_dtype=args.lfpdtype,
+                        lfp_scaling=args.lfpscaling,
+                        lfp_workers=args.lfpworkers,
+                        lfp_iterator=args.lfpiterator,
+                        raw_dataset_options=dict(chunk_shape=args.rawchunkshape,
+                                                 compression=args.rawcompression,
+                                                 compression_level=args.rawcompressionlevel,
+                                                 shuffle=args.rawshuffle),
+                        lfp_dataset_options=dict(chunk_shape=args.lfpchunkshape,
+                                                 compression=args.lfpcompression,
+                                                 compression_level=args.lfpcompressionlevel,
+                                                 shuffle=args.lfpshuffle))
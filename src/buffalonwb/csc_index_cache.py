@@ -0,0 +1,94 @@
+import os
+import pickle
+import hashlib
+from pathlib import Path
+
+
+# bump when the content of the index changes, to invalidate entries written by older versions
+_INDEX_VERSION = 2
+
+
+class CscIndexCache:
+    """Size-bounded on-disk cache of the index of CSC .ncs files, see add_raw_nlx_data.index_csc_file.
+
+    Each file has one entry in cache_dir, named after a hash of its resolved path. An entry is only valid for the
+    size and modification time of the file when it was indexed, so a modified file is indexed again and its entry
+    replaced. When the entries exceed max_size_mb, the least recently used ones are evicted.
+
+    The entries are pickled, so cache_dir must only be writable by trusted users.
+
+    Parameters
+    ----------
+    cache_dir : str or Path
+        Directory of the cache. It is created if it does not exist.
+    max_size_mb : float
+        Maximum total size of the entries, in MB.
+
+    """
+
+    def __init__(self, cache_dir, max_size_mb=256.):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_mb = max_size_mb
+
+    def _entry_path(self, csc_file_path):
+        key = hashlib.sha1(str(Path(csc_file_path).resolve()).encode('utf-8')).hexdigest()
+        return self.cache_dir / (key + '.pkl')
+
+    @staticmethod
+    def _file_signature(csc_file_path):
+        stat = Path(csc_file_path).stat()
+        return _INDEX_VERSION, stat.st_size, stat.st_mtime_ns
+
+    def get(self, csc_file_path):
+        """Get the cached index of a file, or None if it is not cached or the file changed since it was indexed."""
+        entry_path = self._entry_path(csc_file_path)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                signature, index = pickle.load(entry_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if signature != self._file_signature(csc_file_path):
+            return None
+        os.utime(entry_path)  # mark as recently used
+        return index
+
+    def put(self, csc_file_path, index):
+        """Store the index of a file, then evict the least recently used entries if the cache is too large."""
+        entry_path = self._entry_path(csc_file_path)
+        tmp_path = entry_path.with_suffix('.tmp%d' % os.getpid())
+        with open(tmp_path, 'wb') as entry_file:
+            pickle.dump((self._file_signature(csc_file_path), index), entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, entry_path)  # atomic, so concurrent readers never see a partial entry
+        self.evict()
+
+    def invalidate(self, csc_file_path):
+        """Remove the entry of a file."""
+        try:
+            self._entry_path(csc_file_path).unlink()
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        """Remove all entries."""
+        for entry_path in self.cache_dir.glob('*.pkl'):
+            entry_path.unlink()
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is at most max_size_mb."""
+        entries = list()
+        for entry_path in self.cache_dir.glob('*.pkl'):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size_mb * 1e6:
+                break
+            try:
+                entry_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
@@ -8,3 +8,7 @@ class UnsupportedInputException(Exception):
 
 class UnexpectedInputException(Exception):
     pass
+
+
+class ConversionInterruptedException(Exception):
+    pass
@@ -0,0 +1,95 @@
+from buffalonwb.add_raw_nlx_data import CscDataChunkIterator, CscDirectory
+from buffalonwb.compression import COMPRESSION_CODECS, get_compression_kwargs
+from pathlib import Path
+import numpy as np
+import argparse
+import tempfile
+import time
+import h5py
+
+
+def benchmark_compression(raw_nlx_path, settings, duration=60., chunk_shape=None, out_dir=None):
+    """
+    Write a time window of the raw CSC data with several chunking/compression settings and report, for each one, the
+    compression ratio and the write and read throughput.
+    :param raw_nlx_path: path to the directory of raw NLX CSC files.
+    :param settings: list of dicts with keys 'compression', 'compression_level' and 'shuffle'.
+    :param duration: length in seconds of the time window to write, starting at the beginning of the recording.
+    :param chunk_shape: shape of the HDF5 chunks. Defaults to the chunk shape of CscDataChunkIterator.
+    :param out_dir: directory for the benchmark files. Defaults to a temporary directory.
+    :return: list of dicts with the setting and its 'ratio', 'write_mbps' and 'read_mbps'.
+    """
+    csc_directory = CscDirectory(raw_nlx_path)
+    iterator = CscDataChunkIterator(data_paths=csc_directory.data_paths, chunk_shape=chunk_shape,
+                                    display_progress=False, num_records=csc_directory.num_records)
+    num_samples = min(iterator.maxshape[0], int(duration * iterator.rate))
+    data = iterator.get_block(0, num_samples)
+    chunks = tuple(min(c, s) for c, s in zip(iterator.chunk_shape, data.shape))
+    print('Benchmarking %d samples x %d channels (%0.1f MB), chunks %s'
+          % (data.shape[0], data.shape[1], data.nbytes / 1e6, chunks))
+
+    results = list()
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        for i, setting in enumerate(settings):
+            file_path = Path(tmp_dir) / ('benchmark_%d.h5' % i)
+            kwargs = get_compression_kwargs(**setting)
+
+            start = time.perf_counter()
+            with h5py.File(file_path, 'w') as f:
+                dataset = f.create_dataset('data', data=data, chunks=chunks, **kwargs)
+                storage_size = dataset.id.get_storage_size()
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with h5py.File(file_path, 'r') as f:
+                read_data = f['data'][()]
+            read_time = time.perf_counter() - start
+            if not np.array_equal(read_data, data):
+                raise Exception('Data read back with setting %s does not match the source data.' % setting)
+
+            result = dict(setting, ratio=data.nbytes / storage_size, write_mbps=data.nbytes / 1e6 / write_time,
+                          read_mbps=data.nbytes / 1e6 / read_time)
+            results.append(result)
+            print('%-12s level %-4s shuffle %-5s  ratio %5.2f  write %8.1f MB/s  read %8.1f MB/s'
+                  % (setting.get('compression'), setting.get('compression_level'), setting.get('shuffle', False),
+                     result['ratio'], result['write_mbps'], result['read_mbps']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser("A script to benchmark HDF5 compression settings on raw Neuralynx CSC data.")
+    parser.add_argument(
+        "raw_nlx_dir", help="The path to the directory holding raw Neuralynx CSC files."
+    )
+    parser.add_argument(
+        "--compression",
+        nargs="+",
+        choices=["none"] + COMPRESSION_CODECS,
+        default=["none", "gzip", "lzf"],
+        help="The compression codecs to benchmark.",
+    )
+    parser.add_argument(
+        "--levels", type=int, nargs="+", default=[None], help="The compression levels to benchmark."
+    )
+    parser.add_argument(
+        "--duration", type=float, default=60., help="Length in seconds of the benchmarked time window."
+    )
+    parser.add_argument(
+        "--chunkshape", type=int, nargs=2, default=None, metavar=("TIME", "CHANNELS"),
+        help="Shape of the HDF5 chunks.",
+    )
+    args = parser.parse_args()
+
+    settings = [dict(compression=None)] if "none" in args.compression else []
+    for compression in args.compression:
+        if compression == "none":
+            continue
+        levels = [None] if compression == "lzf" else args.levels
+        for level in levels:
+            for shuffle in (False, True):
+                settings.append(dict(compression=compression, compression_level=level, shuffle=shuffle))
+    benchmark_compression(args.raw_nlx_dir, settings, duration=args.duration, chunk_shape=args.chunkshape)
+
+
+if __name__ == '__main__':
+    main()
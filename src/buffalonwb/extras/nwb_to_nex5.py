@@ -1,14 +1,19 @@
+from buffalonwb.add_raw_nlx_data import get_raw_series_name
 from nexfile import nexwriter2
 import pynwb
 from tqdm import trange
 import numpy as np
 import argparse
-import datetime
+import warnings
 
 
 def nwb_to_nex5(nwb_path, nex5_path, elecseries_name='ElectricalSeries'):
     """
     Write the given NWB ElectricalSeries to a NEX5 file.
+    The raw data of a recording with gaps is written as one ElectricalSeries per continuous segment, named
+    'ElectricalSeries', 'ElectricalSeriesSegment1', 'ElectricalSeriesSegment2', etc. (see
+    buffalonwb.add_raw_nlx_data.get_raw_series_name). All segments of 'ElectricalSeries' are then written as the
+    fragments of the NEX5 continuous variables, at the sampling rate of the first segment.
     :param nwb_path: path to the NWB file.
     :param elecseries_name: name of the ElectricalSeries in the NWB file to be written to the NEX5 file.
     :param nex5_path: path to the NEX5 file to be written.
@@ -18,38 +23,63 @@ def nwb_to_nex5(nwb_path, nex5_path, elecseries_name='ElectricalSeries'):
         nwb = io.read()
         if elecseries_name not in nwb.acquisition:
             raise Exception('NWB file %s does not have an acquisition named "%s".' % (nwb_path, elecseries_name))
+        segment_names = [elecseries_name]
+        if elecseries_name == get_raw_series_name(0):
+            while get_raw_series_name(len(segment_names)) in nwb.acquisition:
+                segment_names.append(get_raw_series_name(len(segment_names)))
 
-        elecseries = nwb.acquisition[elecseries_name]
-        if not isinstance(elecseries, pynwb.ecephys.ElectricalSeries):
-            raise Exception('Acquisition "%s" must be of type ElectricalSeries.' % (elecseries_name))
-        if elecseries.data.dtype is not np.dtype(np.int16):
-            raise Exception('Acquisition "%s" must have int16 data.' % (elecseries_name))
+        segments = [nwb.acquisition[name] for name in segment_names]
+        for name, segment in zip(segment_names, segments):
+            if not isinstance(segment, pynwb.ecephys.ElectricalSeries):
+                raise Exception('Acquisition "%s" must be of type ElectricalSeries.' % (name))
+            if segment.data.dtype is not np.dtype(np.int16):
+                raise Exception('Acquisition "%s" must have int16 data.' % (name))
+            if segment.data.shape[1] != segments[0].data.shape[1] or segment.conversion != segments[0].conversion:
+                raise Exception('Acquisition "%s" must have the channels and conversion of "%s".'
+                                % (name, elecseries_name))
 
+        elecseries = segments[0]
         num_channels = elecseries.data.shape[1]
         # use electricalseries start time, which is relative to timestamps_reference_time
-        start_time = elecseries.starting_time
+        start_times = np.array([segment.starting_time for segment in segments])
         timestamp_freq = elecseries.rate
         conversion = elecseries.conversion*1000  # NEX5 stores data in millivolts, not volts
+        num_samples = sum(segment.data.shape[0] for segment in segments)
 
         print('Found ElectricalSeries "%s" data:' % elecseries_name)
+        print('Num segments: \t\t\t%d' % len(segments))
         print('Num channels: \t\t\t%d' % num_channels)
-        print('Num samples: \t\t\t%d' % elecseries.data.shape[0])
+        print('Num samples: \t\t\t%d' % num_samples)
         print('Sampling rate: \t\t\t%f Hz' % timestamp_freq)
-        print('Total time: \t\t\t%f seconds' % (elecseries.data.shape[0] / timestamp_freq))
+        print('Total time: \t\t\t%f seconds' % (num_samples / timestamp_freq))
         print('AD to mV conversion factor: \t%f' % conversion)
-        print('ElectricalSeries starting time: %f seconds' % start_time)
+        print('ElectricalSeries starting time: %f seconds' % start_times[0])
         print('Timestamps reference time: \t%s' % nwb.timestamps_reference_time)
         print('')
 
+        # the fitted rates of the segments differ slightly, but a NEX5 variable has a single sampling rate
+        max_drift = max(segment.data.shape[0] * abs(1 / timestamp_freq - 1 / segment.rate) for segment in segments)
+        if max_drift > 0.5 / timestamp_freq:
+            warnings.warn('The sampling rates of the segments of "%s" differ, the NEX5 times of their last samples '
+                          'are off by up to %g seconds.' % (elecseries_name, max_drift))
+
         # use modified nexwriter in order to handle AD (int16) data and given conversion factor
         writer = nexwriter2.NexWriter2(timestamp_freq, useNumpy=True)
         for ch in trange(num_channels, desc='Writing channels to NEX5 file'):
-            writer.AddContVarWithSingleFragment(
-                name='channel_'+str(ch),
-                timestampOfFirstDataPoint=start_time,
-                SamplingRate=timestamp_freq,
-                values=elecseries.data[:, ch]
-            )
+            if len(segments) == 1:
+                writer.AddContVarWithSingleFragment(
+                    name='channel_'+str(ch),
+                    timestampOfFirstDataPoint=start_times[0],
+                    SamplingRate=timestamp_freq,
+                    values=elecseries.data[:, ch]
+                )
+            else:
+                writer.AddContVarWithMultipleFragments(
+                    name='channel_'+str(ch),
+                    timestamps=start_times,
+                    SamplingRate=timestamp_freq,
+                    fragmentValues=[segment.data[:, ch] for segment in segments]
+                )
 
         writer.WriteNex5File(nex5_path, conversion=conversion)
 
@@ -61,7 +91,9 @@ def main():
     )
     parser.add_argument(
         "elecseries_name",
-        help="The name of the ElectricalSeries in the NWB file to be written to the NEX5 file.",
+        help="The name of the ElectricalSeries in the NWB file to be written to the NEX5 file. For the raw data of a "
+             "recording with gaps, 'ElectricalSeries' also writes the segments after each gap, "
+             "'ElectricalSeriesSegment1', 'ElectricalSeriesSegment2', etc., as fragments of the NEX5 variables.",
     )
     parser.add_argument(
         "nex5_path", help="The path to the NEX5 file to be written."
@@ -0,0 +1,202 @@
+from buffalonwb.add_raw_nlx_data import (_CSC_SAMPLES_PER_RECORD, CscDirectory, get_raw_channel_indices,
+                                         get_raw_segments, get_raw_series_name, read_csc_records)
+from buffalonwb.csc_index_cache import CscIndexCache
+from buffalonwb.exceptions import InconsistentInputException
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tqdm import tqdm
+import numpy as np
+import argparse
+import hashlib
+import json
+import h5py
+
+
+def get_raw_digest_path(nwb_path):
+    """Get the default path of the digest file of a raw NWB file."""
+    return Path(str(nwb_path) + '.digest.json')
+
+
+def verify_raw_nwb(nwb_path, raw_nlx_path, num_workers=4, buffer_mb=256., digest_path=None, index_cache=None,
+                   time_range=None, channels=None):
+    """
+    Compare the raw ElectricalSeries of an NWB file with the CSC files they were converted from, and write a digest
+    file of the verified data.
+    Time blocks of the ElectricalSeries and of the memory-mapped CSC files are read and compared by a pool of
+    processes, so each byte is read once and the disks are read concurrently. The blocks are aligned to the HDF5
+    chunks, so no chunk is decompressed twice. The SHA-256 hash of each block of the ElectricalSeries is kept in the
+    digest file, which verify_raw_nwb_digest checks without the CSC files.
+    :param nwb_path: path to the raw NWB file (HDF5 backend).
+    :param raw_nlx_path: path to the directory of raw NLX CSC files.
+    :param num_workers: number of processes reading and comparing the blocks.
+    :param buffer_mb: size in MB of the time blocks of all channels read at once by each process.
+    :param digest_path: path of the digest file. Defaults to get_raw_digest_path(nwb_path).
+    :param index_cache: CscIndexCache of the CSC file indexes.
+    :param time_range: time window extracted by the conversion, in seconds relative to the first sample.
+    :param channels: channel subset extracted by the conversion.
+    :return: None if the data match, otherwise a dict with the 'series', 'channel' (electrode label) and 'sample' of
+        the first mismatch, and the 'expected' and 'actual' values. The digest file is only written if the data match.
+    """
+    csc_directory = CscDirectory(raw_nlx_path, index_cache=index_cache)
+    segments, _ = get_raw_segments(csc_directory, time_range)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    data_paths = [str(csc_directory.data_paths[i]) for i in channel_indices]
+    num_records = [csc_directory.num_records[i] for i in channel_indices]
+
+    digest = dict(nwb_file=Path(nwb_path).name, series=dict())
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for segment_index, segment in enumerate(segments):
+            series_name = get_raw_series_name(segment_index)
+            dataset_path = 'acquisition/%s/data' % series_name
+            shape, block_size = _get_block_layout(nwb_path, dataset_path, buffer_mb)
+            if shape != (int(segment['num_samples']), len(channel_indices)):
+                raise InconsistentInputException('Dataset %s has shape %s but the CSC files have shape %s.'
+                                                 % (dataset_path, shape,
+                                                    (int(segment['num_samples']), len(channel_indices))))
+
+            futures = [pool.submit(_verify_block, str(nwb_path), dataset_path, start, min(start + block_size, shape[0]),
+                                   data_paths, num_records, int(segment['start_sample']))
+                       for start in range(0, shape[0], block_size)]
+            hashes = list()
+            for future in tqdm(futures, desc='Verifying %s' % series_name):
+                block_hash, mismatch = future.result()
+                if mismatch is not None:  # futures are checked in order, so this is the first mismatch
+                    for pending in futures:
+                        pending.cancel()
+                    channel, sample, expected, actual = mismatch
+                    return dict(series=series_name, channel=csc_directory.electrode_labels[channel_indices[channel]],
+                                sample=sample, expected=expected, actual=actual)
+                hashes.append(block_hash)
+            digest['series'][series_name] = dict(shape=list(shape), block_size=block_size, sha256=hashes)
+
+    with open(digest_path or get_raw_digest_path(nwb_path), 'w') as digest_file:
+        json.dump(digest, digest_file, indent=1)
+    return None
+
+
+def verify_raw_nwb_digest(nwb_path, digest_path=None, num_workers=4):
+    """
+    Check the raw ElectricalSeries of an NWB file against the digest file written by verify_raw_nwb, without reading
+    the CSC files.
+    :param nwb_path: path to the raw NWB file (HDF5 backend).
+    :param digest_path: path of the digest file. Defaults to get_raw_digest_path(nwb_path).
+    :param num_workers: number of processes reading and hashing the blocks.
+    :return: None if the data match, otherwise a dict with the 'series' and the 'start' and 'stop' samples of the
+        first block that does not match its hash.
+    """
+    with open(digest_path or get_raw_digest_path(nwb_path)) as digest_file:
+        digest = json.load(digest_file)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for series_name, series_digest in digest['series'].items():
+            dataset_path = 'acquisition/%s/data' % series_name
+            shape, _ = _get_block_layout(nwb_path, dataset_path)
+            if list(shape) != series_digest['shape']:
+                raise InconsistentInputException('Dataset %s has shape %s but the digest has shape %s.'
+                                                 % (dataset_path, shape, tuple(series_digest['shape'])))
+
+            block_size = series_digest['block_size']
+            starts = range(0, shape[0], block_size)
+            futures = [pool.submit(_verify_block, str(nwb_path), dataset_path, start, min(start + block_size, shape[0]))
+                       for start in starts]
+            for start, future, expected_hash in tqdm(zip(starts, futures, series_digest['sha256']),
+                                                     total=len(futures), desc='Verifying %s' % series_name):
+                if future.result()[0] != expected_hash:
+                    for pending in futures:
+                        pending.cancel()
+                    return dict(series=series_name, start=start, stop=min(start + block_size, shape[0]))
+    return None
+
+
+def _get_block_layout(nwb_path, dataset_path, buffer_mb=None):
+    """Get the shape of a dataset and the number of samples of the time blocks, a multiple of its chunk length."""
+    with h5py.File(nwb_path, 'r') as nwb_file:
+        dataset = nwb_file[dataset_path]
+        shape = dataset.shape
+        chunk_length = dataset.chunks[0] if dataset.chunks else 1
+    if buffer_mb is None:
+        return shape, None
+    block_size = int(buffer_mb * 1e6 / (shape[1] * 2))
+    return shape, max(chunk_length, block_size // chunk_length * chunk_length)
+
+
+def _verify_block(nwb_path, dataset_path, start, stop, data_paths=None, num_records=None, start_sample=0):
+    """
+    Read samples start to stop of an ElectricalSeries dataset, in a worker process, and hash them. If data_paths is
+    given, also compare them with the CSC files, and return the (channel, sample, expected, actual) of the first
+    mismatch: the one with the smallest sample index, on the lowest channel if several channels differ there.
+    """
+    with h5py.File(nwb_path, 'r') as nwb_file:
+        data = nwb_file[dataset_path][start:stop]
+    block_hash = hashlib.sha256(np.ascontiguousarray(data).data).hexdigest()
+    if data_paths is None:
+        return block_hash, None
+
+    # samples of the CSC files, from the first record of the block
+    first_sample = start_sample + start
+    first_record = first_sample // _CSC_SAMPLES_PER_RECORD
+    last_record = -(-(start_sample + stop) // _CSC_SAMPLES_PER_RECORD)
+    offset = first_sample - first_record * _CSC_SAMPLES_PER_RECORD
+    mismatch = None
+    for channel, (data_path, channel_num_records) in enumerate(zip(data_paths, num_records)):
+        records = read_csc_records(Path(data_path), num_records=channel_num_records)
+        expected = records['samples'][first_record:last_record].reshape(-1)[offset:offset + stop - start]
+        # only the samples before the first mismatch found so far can hold an earlier one
+        end = len(data) if mismatch is None else mismatch[1] - start
+        mismatches = np.flatnonzero(expected[:end] != data[:end, channel])
+        if len(mismatches):
+            mismatch = (channel, start + int(mismatches[0]), int(expected[mismatches[0]]),
+                        int(data[mismatches[0], channel]))
+    return block_hash, mismatch
+
+
+def main():
+    parser = argparse.ArgumentParser("A script to verify the raw data of an NWB file against its source CSC files.")
+    parser.add_argument(
+        "nwb_file", help="The path to the raw NWB file."
+    )
+    parser.add_argument(
+        "raw_nlx_dir", nargs="?", default=None,
+        help="The path to the directory holding raw Neuralynx CSC files. If omitted, the NWB file is checked against "
+             "its digest file.",
+    )
+    parser.add_argument(
+        "--digest", default=None, help="The path to the digest file. Defaults to [nwb_file].digest.json."
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of processes reading and comparing time blocks."
+    )
+    parser.add_argument(
+        "--buffermb", type=float, default=256., help="Size in MB of the time blocks read at once by each process."
+    )
+    parser.add_argument(
+        "--indexcachedir", default=None, help="Directory of a cache of the CSC file indexes."
+    )
+    parser.add_argument(
+        "--rawtimerange", type=float, nargs=2, default=None, metavar=("START", "END"),
+        help="Time window of raw data extracted by the conversion, in seconds from the first sample.",
+    )
+    parser.add_argument(
+        "--rawchannels", nargs="+", default=None, help="Channels of raw data extracted by the conversion."
+    )
+    args = parser.parse_args()
+
+    if args.raw_nlx_dir is None:
+        mismatch = verify_raw_nwb_digest(args.nwb_file, digest_path=args.digest, num_workers=args.workers)
+        if mismatch is not None:
+            raise SystemExit('Samples %d to %d of %s do not match the digest.'
+                             % (mismatch['start'], mismatch['stop'], mismatch['series']))
+    else:
+        index_cache = CscIndexCache(args.indexcachedir) if args.indexcachedir else None
+        mismatch = verify_raw_nwb(args.nwb_file, args.raw_nlx_dir, num_workers=args.workers, buffer_mb=args.buffermb,
+                                  digest_path=args.digest, index_cache=index_cache, time_range=args.rawtimerange,
+                                  channels=args.rawchannels)
+        if mismatch is not None:
+            raise SystemExit('Sample %d of channel %s of %s is %d in the NWB file but %d in the CSC file.'
+                             % (mismatch['sample'], mismatch['channel'], mismatch['series'], mismatch['actual'],
+                                mismatch['expected']))
+    print('%s matches.' % args.nwb_file)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+import tempfile
+
+import h5py
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+from buffalonwb.exceptions import UnexpectedInputException
+
+
+class StreamingDecimator:
+    """Anti-aliased decimation of a (time, channel) signal that arrives in consecutive blocks.
+
+    The signal is low-pass filtered with the FIR filter of scipy.signal.decimate and downsampled with a polyphase
+    filter (scipy.signal.upfirdn), which only computes the kept outputs. The samples that the next outputs still
+    depend on are kept between blocks, so the output is the same as decimating the whole signal at once, with the
+    signal taken as zero before its first and after its last sample. The filter is centered, so output i is aligned
+    with input sample i * factor.
+
+    Parameters
+    ----------
+    factor : int
+        Decimation factor.
+    num_channels : int
+        Number of channels of the signal.
+    piece_size : int
+        Maximum number of input samples filtered at once, to bound the memory of the float32 copies.
+
+    """
+
+    def __init__(self, factor, num_channels, piece_size=65536):
+        self.factor = factor
+        self.filter = firwin(20 * factor + 1, 1. / factor, window='hamming').astype(np.float32)
+        self.piece_size = max(piece_size, len(self.filter))
+        self._delay = (len(self.filter) - 1) // 2
+        # the buffer starts this many samples before the input sample of the next output
+        self._lead = -(-(len(self.filter) - 1) // factor) * factor
+        self._buffer = np.zeros((self._lead - self._delay, num_channels), dtype=np.float32)
+        self._num_input = 0
+        self._num_output = 0
+
+    def process(self, block):
+        """Filter the next block of the signal and return the outputs that are complete, as a float32 array."""
+        outputs = list()
+        for start in range(0, len(block), self.piece_size):
+            piece = block[start:start + self.piece_size]
+            self._buffer = np.concatenate([self._buffer, piece.astype(np.float32)])
+            self._num_input += len(piece)
+            outputs.append(self._decimate(self._num_input))
+        return np.concatenate(outputs) if outputs else self._buffer[:0]
+
+    def flush(self):
+        """Return the remaining outputs, up to the one aligned with the last input sample."""
+        num_outputs = -(-self._num_input // self.factor) - self._num_output
+        self._buffer = np.concatenate([self._buffer, np.zeros((self._delay, self._buffer.shape[1]), np.float32)])
+        return self._decimate(self._num_input + self._delay)[:num_outputs]
+
+    def _decimate(self, end):
+        """Compute the outputs whose filter window ends before input sample end."""
+        last_output = (end - 1 - self._delay) // self.factor
+        if last_output < self._num_output:
+            return self._buffer[:0]
+        buffer_start = self._buffer_start(self._num_output)
+        buffer_stop = last_output * self.factor + self._delay - buffer_start + 1
+        first = self._lead // self.factor
+        outputs = upfirdn(self.filter, self._buffer[:buffer_stop], down=self.factor, axis=0)
+        outputs = outputs[first:first + last_output - self._num_output + 1].astype(np.float32)
+        self._num_output = last_output + 1
+        self._buffer = self._buffer[self._buffer_start(self._num_output) - buffer_start:]
+        return outputs
+
+    def _buffer_start(self, output):
+        """Index of the input sample at the start of the buffer when the next output is output."""
+        return output * self.factor + self._delay - self._lead
+
+
+class RawPreview:
+    """Decimated preview of a segment of the raw data, computed from the blocks read for the raw ElectricalSeries.
+
+    The blocks are fed in order by CscDataChunkIterator as it reads them, so the CSC files are read once for both.
+    The preview is kept as int16, in the units of the raw data, in a memory-mapped scratch file until it is written
+    to the NWB file with write_raw_previews, which deletes the scratch file with close().
+
+    Parameters
+    ----------
+    name : str
+        Name of the preview ElectricalSeries.
+    rate : float
+        Sampling rate of the raw data, in Hz.
+    num_samples : int
+        Number of samples of the segment.
+    num_channels : int
+        Number of channels.
+    preview_rate : float
+        Target sampling rate of the preview, in Hz. The decimation factor is the nearest integer to rate / preview_rate.
+    scratch_dir : str or Path
+        Directory of the scratch file. Defaults to the system temporary directory.
+
+    """
+
+    def __init__(self, name, rate, num_samples, num_channels, preview_rate=1000., scratch_dir=None):
+        self.name = name
+        factor = max(1, int(round(rate / preview_rate)))
+        self.rate = rate / factor
+        self.num_samples = num_samples
+        self.shape = (-(-num_samples // factor), num_channels)
+        self._decimator = StreamingDecimator(factor, num_channels)
+        self._scratch_file = tempfile.TemporaryFile(dir=scratch_dir, prefix='buffalonwb_preview_')
+        self.data = np.memmap(self._scratch_file, dtype=np.int16, mode='w+', shape=self.shape)
+        self._num_input = 0
+        self._num_output = 0
+
+    @property
+    def complete(self):
+        return self._num_input == self.num_samples
+
+    def close(self):
+        """Delete the scratch file. The data of the preview is no longer available."""
+        self.data = None
+        self._scratch_file.close()
+
+    def process(self, start, block):
+        """Add the block of all channels starting at sample start of the segment. Blocks must be added in order."""
+        if start != self._num_input:
+            raise UnexpectedInputException('Preview %s expected the block at sample %d but got sample %d.'
+                                           % (self.name, self._num_input, start))
+        self._store(self._decimator.process(block))
+        self._num_input += len(block)
+        if self.complete:
+            self._store(self._decimator.flush())
+
+    def _store(self, outputs):
+        self.data[self._num_output:self._num_output + len(outputs)] = np.clip(
+            np.round(outputs), np.iinfo(np.int16).min, np.iinfo(np.int16).max)
+        self._num_output += len(outputs)
+
+
+def write_raw_previews(nwb_path, previews, block_size=1000000):
+    """Copy the previews computed while writing the raw data into their preallocated datasets in the NWB file.
+
+    The previews are closed afterwards, even if copying fails, so their scratch files are deleted.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path of the NWB file, written with the previews returned by add_raw_nlx_data.
+    previews : list of RawPreview
+        The previews.
+    block_size : int
+        Number of samples copied at once.
+
+    Raises
+    ------
+    UnexpectedInputException
+        if a preview did not receive all the samples of its segment.
+
+    """
+    try:
+        with h5py.File(nwb_path, 'r+') as nwb_file:
+            for preview in previews:
+                if not preview.complete:
+                    raise UnexpectedInputException('Preview %s is incomplete. The raw data must be written in order '
+                                                   'with a data chunk iterator.' % preview.name)
+                dataset = nwb_file['processing/ecephys/%s/data' % preview.name]
+                for start in range(0, preview.shape[0], block_size):
+                    dataset[start:start + block_size] = preview.data[start:start + block_size]
+    finally:
+        for preview in previews:
+            preview.close()
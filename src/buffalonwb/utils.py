@@ -0,0 +1,42 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def ordered_prefetch(function, items, num_workers=2, depth=None, processes=False):
+    """Apply a function to items in a thread or process pool, reading ahead a bounded number of items, and yield the
+    results in the order of the items.
+
+    Parameters
+    ----------
+    function : callable
+        Function to apply to each item. It should release the GIL for most of its work, e.g. file reads and numpy
+        copies, for the threads to run concurrently. With processes, it must be picklable, e.g. a module-level
+        function.
+    items : iterable
+        The items.
+    num_workers : int
+        Number of threads or processes.
+    depth : int
+        Maximum number of results computed ahead of the one being consumed. Defaults to num_workers.
+    processes : bool
+        Whether to use a process pool, for functions that hold the GIL or a lock, e.g. reads of HDF5 files with h5py.
+        The items and results are pickled between the processes.
+
+    Yields
+    ------
+    object
+        The result of the function for each item, in order.
+
+    """
+    if depth is None:
+        depth = num_workers
+    items = iter(items)
+    pending = deque()
+    executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_class(max_workers=num_workers) as pool:
+        for item in items:
+            pending.append(pool.submit(function, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,651 @@
+import os
+import json
+import zlib
+import signal
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from itertools import product
+from pathlib import Path
+
+import h5py
+import numpy as np
+from tqdm import tqdm, trange
+
+from buffalonwb.add_raw_nlx_data import (_CSC_RECORD_SIZE, _CSC_SAMPLES_PER_RECORD, CscDataChunkIterator, CscDirectory,
+                                         CscTimestamps, check_csc_records, check_csc_timestamps_aligned,
+                                         check_num_records, find_csc_segments, fit_csc_rate, get_raw_channel_indices,
+                                         get_raw_segments, get_raw_series_name, read_csc_records_at)
+from buffalonwb.compression import get_compression_kwargs
+from buffalonwb.exceptions import (ConversionInterruptedException, InconsistentInputException,
+                                   UnexpectedInputException, UnsupportedInputException)
+
+
+def write_raw_nlx_data_parallel(nwb_path, raw_nlx_path, num_workers, buffer_mb=1024., index_cache=None,
+                                csc_directory=None, time_range=None, channels=None):
+    """Fill the preallocated raw ElectricalSeries datasets of an NWB file with compressed chunks written directly.
+
+    The time blocks read from the CSC .ncs files are split into HDF5 chunks, which a pool of workers compresses with
+    the filters of the dataset. A single writer then commits the chunks in order with write_direct_chunk, so the
+    result is byte-compatible with a dataset written through the HDF5 filter pipeline. If the recording has gaps,
+    the dataset of each segment is filled.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path of the NWB file, written by add_raw_nlx_data with compression_workers set.
+    raw_nlx_path : Path
+        Path of directory of raw NLX CSC files.
+    num_workers : int
+        Number of workers compressing chunks.
+    buffer_mb : float
+        Size of the time blocks read from all channels at once, in MB.
+    index_cache : CscIndexCache
+        Cache of the CSC file indexes.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
+    time_range : tuple of float
+        Time window extracted by add_raw_nlx_data, in seconds relative to the first sample of the recording.
+    channels : list of str or int
+        Channel subset extracted by add_raw_nlx_data.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the shape of a dataset does not match the CSC files.
+    UnsupportedInputException
+        if a dataset is not chunked or uses filters other than shuffle and gzip.
+
+    """
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path, index_cache=index_cache)
+    segments, _ = get_raw_segments(csc_directory, time_range)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    data_paths = [csc_directory.data_paths[i] for i in channel_indices]
+    num_records = [csc_directory.num_records[i] for i in channel_indices]
+
+    with h5py.File(nwb_path, 'r+') as nwb_file:
+        for segment_index, segment in enumerate(segments):
+            dataset = nwb_file['acquisition/%s/data' % get_raw_series_name(segment_index)]
+            iterator = CscDataChunkIterator(data_paths=data_paths, buffer_mb=buffer_mb,
+                                            chunk_shape=dataset.chunks, start_sample=int(segment['start_sample']),
+                                            num_samples=int(segment['num_samples']),
+                                            num_records=num_records,
+                                            validated=csc_directory.is_validated(channel_indices),
+                                            on_checked=partial(csc_directory.add_checked_samples, channel_indices,
+                                                               int(segment['start_sample']),
+                                                               int(segment['num_samples'])))
+            write_chunks_parallel(dataset, iterator, num_workers)
+
+
+def write_raw_nlx_data_zarr(nwb_path, raw_nlx_path, num_workers, buffer_mb=1024., index_cache=None,
+                            csc_directory=None, time_range=None, channels=None):
+    """Fill the preallocated raw ElectricalSeries arrays of an NWB Zarr store with a pool of writer processes.
+
+    Each process reads a time block of all channels from the CSC .ncs files, compresses it with the codec of the
+    array and writes it to the store. The time blocks are aligned to the chunks of the array, so the processes write
+    disjoint chunk files and need no locking, and the conversion scales with the number of cores and disks.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path of the NWB Zarr store, written by add_raw_nlx_data with backend='zarr' and compression_workers set.
+    raw_nlx_path : Path
+        Path of directory of raw NLX CSC files.
+    num_workers : int
+        Number of writer processes.
+    buffer_mb : float
+        Size of the time blocks written by each process at once, in MB.
+    index_cache : CscIndexCache
+        Cache of the CSC file indexes.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
+    time_range : tuple of float
+        Time window extracted by add_raw_nlx_data, in seconds relative to the first sample of the recording.
+    channels : list of str or int
+        Channel subset extracted by add_raw_nlx_data.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the shape of an array does not match the CSC files.
+    ImportError
+        if the zarr package is not installed.
+
+    """
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("The hdmf-zarr package is required for the Zarr backend: pip install hdmf-zarr")
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path, index_cache=index_cache)
+    segments, _ = get_raw_segments(csc_directory, time_range)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    data_paths = [csc_directory.data_paths[i] for i in channel_indices]
+    num_records = [csc_directory.num_records[i] for i in channel_indices]
+
+    root = zarr.open_group(str(nwb_path), mode='r+')
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        for segment_index, segment in enumerate(segments):
+            series_name = get_raw_series_name(segment_index)
+            array_path = 'acquisition/%s/data' % series_name
+            array = root[array_path]
+            iterator_kwargs = dict(data_paths=data_paths, buffer_mb=buffer_mb, chunk_shape=tuple(array.chunks),
+                                   display_progress=False, start_sample=int(segment['start_sample']),
+                                   num_samples=int(segment['num_samples']), num_records=num_records,
+                                   validated=csc_directory.is_validated(channel_indices))
+            iterator = CscDataChunkIterator(**iterator_kwargs)
+            if iterator.maxshape != tuple(array.shape):
+                raise InconsistentInputException('Array %s has shape %s but the CSC files have shape %s.'
+                                                 % (array_path, tuple(array.shape), iterator.maxshape))
+
+            block_size = iterator.buffer_shape[0]
+            futures = [pool.submit(_write_zarr_block, str(nwb_path), array_path, iterator_kwargs, start,
+                                   min(start + block_size, array.shape[0]))
+                       for start in range(0, array.shape[0], block_size)]
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Writing raw data %s' % series_name):
+                future.result()
+
+
+def _write_zarr_block(nwb_path, array_path, iterator_kwargs, start, stop):
+    """Write samples start to stop of all channels to an array of a Zarr store, in a writer process."""
+    import zarr
+    array = zarr.open_group(nwb_path, mode='r+')[array_path]
+    array[start:stop] = CscDataChunkIterator(**iterator_kwargs).get_block(start, stop)
+
+
+def get_raw_part_path(nwb_path, part_index):
+    """Get the path of a part file of a raw NWB file written by write_raw_nlx_data_parts."""
+    return Path(nwb_path).with_suffix('.part%d.h5' % part_index)
+
+
+def write_raw_nlx_data_parts(nwb_path, raw_nlx_path, num_parts, buffer_mb=1024., chunk_shape=None, compression=None,
+                             compression_level=None, shuffle=False, index_cache=None, csc_directory=None,
+                             time_range=None, channels=None):
+    """Write the raw data of an NWB file as channel groups in separate part files, from parallel processes, and expose
+    them in the NWB file as one (time, channel) HDF5 virtual dataset per ElectricalSeries.
+
+    The channels are split into num_parts contiguous groups. Each group is written by its own process to a part file
+    next to the NWB file (see get_raw_part_path), with one dataset per segment of the recording. The preallocated
+    datasets of the NWB file are then replaced by virtual datasets that map each group of columns to its part file,
+    keeping their attributes. The part files are referred to by relative paths and must stay in the directory of the
+    NWB file.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path of the NWB file, written by add_raw_nlx_data with preallocate=True.
+    raw_nlx_path : Path
+        Path of directory of raw NLX CSC files.
+    num_parts : int
+        Number of channel groups, part files and writer processes.
+    buffer_mb : float
+        Size of the time blocks read from the channels of a group at once, in MB.
+    chunk_shape : tuple
+        Shape of the HDF5 chunks of the part datasets. The channel dimension is limited to the size of a group.
+        Defaults to chunks spanning all channels of a group.
+    compression : str
+        Compression codec of the part datasets, one of buffalonwb.compression.COMPRESSION_CODECS, or None.
+    compression_level : int
+        Compression level.
+    shuffle : bool
+        Whether to shuffle bytes before compression.
+    index_cache : CscIndexCache
+        Cache of the CSC file indexes.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
+    time_range : tuple of float
+        Time window extracted by add_raw_nlx_data, in seconds relative to the first sample of the recording.
+    channels : list of str or int
+        Channel subset extracted by add_raw_nlx_data.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the shape of a dataset does not match the CSC files.
+
+    """
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path, index_cache=index_cache)
+    segments, _ = get_raw_segments(csc_directory, time_range)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    series = [(get_raw_series_name(segment_index), int(segment['start_sample']), int(segment['num_samples']))
+              for segment_index, segment in enumerate(segments)]
+    groups = np.array_split(channel_indices, min(num_parts, len(channel_indices)))
+
+    with h5py.File(nwb_path, 'r') as nwb_file:
+        for series_name, _, num_samples in series:
+            shape = nwb_file['acquisition/%s/data' % series_name].shape
+            if shape != (num_samples, len(channel_indices)):
+                raise InconsistentInputException('Dataset %s has shape %s but the CSC files have shape %s.'
+                                                 % (series_name, shape, (num_samples, len(channel_indices))))
+
+    dataset_options = dict(chunk_shape=chunk_shape, compression=compression, compression_level=compression_level,
+                           shuffle=shuffle)
+    with ProcessPoolExecutor(max_workers=len(groups)) as pool:
+        futures = [pool.submit(_write_raw_part, get_raw_part_path(nwb_path, part_index), series,
+                               [csc_directory.data_paths[i] for i in group],
+                               [csc_directory.num_records[i] for i in group], buffer_mb, dataset_options,
+                               csc_directory.is_validated(group))
+                   for part_index, group in enumerate(groups)]
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Writing raw data parts'):
+            future.result()
+
+    with h5py.File(nwb_path, 'r+') as nwb_file:
+        for series_name, _, num_samples in series:
+            data_path = 'acquisition/%s/data' % series_name
+            attrs = dict(nwb_file[data_path].attrs)
+            del nwb_file[data_path]
+            layout = h5py.VirtualLayout(shape=(num_samples, len(channel_indices)), dtype=np.int16)
+            column = 0
+            for part_index, group in enumerate(groups):
+                # relative to the directory of the NWB file
+                part_name = get_raw_part_path(nwb_path, part_index).name
+                layout[:, column:column + len(group)] = h5py.VirtualSource(part_name, series_name,
+                                                                           shape=(num_samples, len(group)),
+                                                                           dtype=np.int16)
+                column += len(group)
+            dataset = nwb_file.create_virtual_dataset(data_path, layout, fillvalue=0)
+            dataset.attrs.update(attrs)
+
+
+def _write_raw_part(part_path, series, data_paths, num_records, buffer_mb, dataset_options, validated=False):
+    """Write the segments of a group of channels to a part file, in a writer process."""
+    chunk_shape = dataset_options['chunk_shape']
+    if chunk_shape is not None:
+        chunk_shape = (chunk_shape[0], min(chunk_shape[1], len(data_paths)))
+    compression_kwargs = get_compression_kwargs(compression=dataset_options['compression'],
+                                                compression_level=dataset_options['compression_level'],
+                                                shuffle=dataset_options['shuffle'])
+    with h5py.File(part_path, 'w') as part_file:
+        for series_name, start_sample, num_samples in series:
+            iterator = CscDataChunkIterator(data_paths=data_paths, buffer_mb=buffer_mb, chunk_shape=chunk_shape,
+                                            display_progress=False, start_sample=start_sample,
+                                            num_samples=num_samples, num_records=num_records,
+                                            validated=validated)
+            dataset = part_file.create_dataset(series_name, shape=iterator.maxshape, dtype=iterator.dtype,
+                                               chunks=iterator.chunk_shape, **compression_kwargs)
+            block_size = iterator.buffer_shape[0]
+            for start in range(0, num_samples, block_size):
+                stop = min(start + block_size, num_samples)
+                dataset[start:stop] = iterator.get_block(start, stop)
+
+
+def get_raw_journal_path(nwb_path):
+    """Get the path of the progress journal of a resumable raw conversion."""
+    return Path(str(nwb_path) + '.progress.json')
+
+
+def write_raw_nlx_data_resumable(nwb_path, raw_nlx_path, buffer_mb=1024., csc_directory=None, time_range=None,
+                                 channels=None):
+    """Fill the preallocated raw ElectricalSeries datasets of an NWB file in time blocks, recording progress in a
+    journal so that an interrupted conversion can be resumed.
+
+    After each time block is written, the file is flushed and the number of completed blocks is saved to the journal
+    (see get_raw_journal_path). Calling this function again on the same file skips the completed blocks. On SIGINT
+    or SIGTERM, the current block is finished and the file is closed cleanly, leaving a valid partial file and the
+    journal behind. The journal is removed when all blocks are written.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path of the NWB file, written by add_raw_nlx_data with preallocate=True.
+    raw_nlx_path : Path
+        Path of directory of raw NLX CSC files.
+    buffer_mb : float
+        Size of the time blocks read from all channels at once, in MB. Must be the same when resuming.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
+    time_range : tuple of float
+        Time window extracted by add_raw_nlx_data, in seconds relative to the first sample of the recording.
+    channels : list of str or int
+        Channel subset extracted by add_raw_nlx_data.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the journal was written for different CSC files, time window or block size, or a dataset does not match
+        the CSC files.
+    ConversionInterruptedException
+        if the conversion was stopped by SIGINT or SIGTERM. Call the function again to resume.
+
+    """
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path)
+    segments, _ = get_raw_segments(csc_directory, time_range)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    data_paths = [csc_directory.data_paths[i] for i in channel_indices]
+    num_records = [csc_directory.num_records[i] for i in channel_indices]
+
+    journal_path = get_raw_journal_path(nwb_path)
+    sources = [[str(data_path), data_path.stat().st_size, data_path.stat().st_mtime_ns] for data_path in data_paths]
+    window = None if time_range is None else [float(t) for t in time_range]
+    if journal_path.exists():
+        with open(journal_path) as journal_file:
+            journal = json.load(journal_file)
+        if (journal['sources'] != sources or journal.get('time_range') != window
+                or journal['buffer_mb'] != buffer_mb):
+            raise InconsistentInputException('The progress journal %s was written for different CSC files, time '
+                                             'range or buffer size.' % journal_path)
+        print('Resuming raw data conversion from %s' % journal_path)
+    else:
+        journal = dict(sources=sources, time_range=window, buffer_mb=buffer_mb, completed_blocks=dict())
+        _save_journal(journal_path, journal)
+
+    # stop cleanly after the current block on SIGINT or SIGTERM
+    with _stop_on_signals() as stop_signals:
+        with h5py.File(nwb_path, 'r+') as nwb_file:
+            for segment_index, segment in enumerate(segments):
+                series_name = get_raw_series_name(segment_index)
+                dataset = nwb_file['acquisition/%s/data' % series_name]
+                iterator = CscDataChunkIterator(data_paths=data_paths, buffer_mb=buffer_mb,
+                                                chunk_shape=dataset.chunks, display_progress=False,
+                                                start_sample=int(segment['start_sample']),
+                                                num_samples=int(segment['num_samples']),
+                                                num_records=num_records,
+                                                validated=csc_directory.is_validated(channel_indices))
+                if iterator.maxshape != dataset.shape:
+                    raise InconsistentInputException('Dataset %s has shape %s but the CSC files have shape %s.'
+                                                     % (dataset.name, dataset.shape, iterator.maxshape))
+
+                block_size = iterator.buffer_shape[0]
+                block_starts = range(0, dataset.shape[0], block_size)
+                completed = journal['completed_blocks'].get(series_name, 0)
+                for block_index in trange(completed, len(block_starts), initial=completed, total=len(block_starts),
+                                          desc='Writing raw data %s' % series_name):
+                    if stop_signals:
+                        break
+                    start = block_starts[block_index]
+                    stop = min(start + block_size, dataset.shape[0])
+                    dataset[start:stop] = iterator.get_block(start, stop)
+                    nwb_file.flush()
+                    journal['completed_blocks'][series_name] = block_index + 1
+                    _save_journal(journal_path, journal)
+                if stop_signals:
+                    break
+
+    if stop_signals:
+        raise ConversionInterruptedException('Raw data conversion of %s was interrupted by signal %d. Progress is '
+                                             'saved in %s, run the conversion again to resume.'
+                                             % (nwb_path, stop_signals[0], journal_path))
+    journal_path.unlink()
+
+
+@contextmanager
+def _stop_on_signals():
+    """Record SIGINT and SIGTERM in the yielded list instead of raising, so the caller can stop cleanly.
+
+    Signal handlers can only be installed from the main thread. In other threads, the list stays empty.
+    """
+    stop_signals = list()
+    previous_handlers = dict()
+    if threading.current_thread() is threading.main_thread():
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous_handlers[signum] = signal.signal(signum, lambda signum, frame: stop_signals.append(signum))
+    try:
+        yield stop_signals
+    finally:
+        for signum, handler in previous_handlers.items():
+            signal.signal(signum, handler)
+
+
+def write_raw_nlx_data_live(nwb_path, raw_nlx_path, poll_interval=1., idle_timeout=60., buffer_mb=1024.,
+                            csc_directory=None, channels=None):
+    """Append the records of CSC .ncs files that Cheetah is still writing to the resizable raw ElectricalSeries of an
+    NWB file, as they are completed.
+
+    The files are polled every poll_interval seconds. The records completed in all files since the last poll are read
+    by byte offset (see read_csc_records_at), checked like in the other conversion modes, appended to the dataset and
+    flushed, so the NWB file can be read during the recording. Appending ends when the files have not grown for
+    idle_timeout seconds or end with a partial record, as Cheetah writes when it closes them. The files are then
+    validated: every file must hold an integer number of records, all of which were appended.
+
+    The ElectricalSeries is created with the nominal rate of the CSC header. When appending ends, also if it is
+    interrupted, its rate and starting time are replaced by their least-squares fit to the start times of the
+    appended records (see fit_csc_rate), like add_raw_nlx_data does for a finished recording.
+
+    Parameters
+    ----------
+    nwb_path : str or Path
+        Path of the NWB file, written by add_raw_nlx_data with live=True.
+    raw_nlx_path : Path
+        Path of directory of raw NLX CSC files.
+    poll_interval : float
+        Time between polls of the file sizes, in seconds.
+    idle_timeout : float
+        Time without new records after which the recording is considered finished, in seconds.
+    buffer_mb : float
+        Maximum size of the records appended at once, in MB.
+    csc_directory : CscDirectory
+        The scanned directory of raw NLX CSC files, if already available. Otherwise raw_nlx_path is scanned.
+    channels : list of str or int
+        Channel subset extracted by add_raw_nlx_data.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the dataset is not empty and resizable, or the records are not consistent across records or channels.
+    UnexpectedInputException
+        if the files are not complete, or have more records than were appended, when appending ends.
+    UnsupportedInputException
+        if the recording has a gap. Convert recordings with gaps after they end.
+    ConversionInterruptedException
+        if appending was stopped by SIGINT or SIGTERM. The NWB file holds the records appended so far.
+
+    """
+    if csc_directory is None:
+        csc_directory = CscDirectory(raw_nlx_path, allow_partial_records=True)
+    channel_indices = get_raw_channel_indices(csc_directory, channels)
+    data_paths = [csc_directory.data_paths[i] for i in channel_indices]
+    max_records = max(1, int(buffer_mb * 1e6 // (len(data_paths) * _CSC_RECORD_SIZE)))
+
+    num_appended = 0
+    last_record_start = None
+    record_starts = list()
+    closed = False
+    with _stop_on_signals() as stop_signals:
+        with h5py.File(nwb_path, 'r+') as nwb_file:
+            dataset = nwb_file['acquisition/%s/data' % get_raw_series_name(0)]
+            if dataset.shape != (0, len(data_paths)) or dataset.maxshape[0] is not None:
+                raise InconsistentInputException('Dataset %s must be empty and resizable along time for a live '
+                                                 'conversion: shape %s, maxshape %s'
+                                                 % (dataset.name, dataset.shape, dataset.maxshape))
+            last_growth = time.monotonic()
+            with tqdm(desc='Appending raw data', unit='records') as progress:
+                while not closed and not stop_signals:
+                    num_complete = min(check_num_records(data_path, allow_partial=True) for data_path in data_paths)
+                    num_new = min(num_complete - num_appended, max_records)
+                    if num_new <= 0:
+                        if time.monotonic() - last_growth > idle_timeout:
+                            break
+                        time.sleep(poll_interval)
+                        continue
+
+                    records = [read_csc_records_at(data_path, num_appended, num_new) for data_path in data_paths]
+                    data, last_record_start, closed = _check_live_records(records, data_paths, last_record_start)
+                    record_starts.append(np.array(records[0]['timestamp']))
+                    num_samples = dataset.shape[0]
+                    dataset.resize(num_samples + len(data), axis=0)
+                    dataset[num_samples:] = data
+                    nwb_file.flush()
+                    num_appended += num_new
+                    last_growth = time.monotonic()
+                    progress.update(num_new)
+
+            if num_appended:
+                _set_live_timing(dataset.parent, np.concatenate(record_starts),
+                                 float(records[0]['sampling_frequency'][0]))
+
+    if stop_signals:
+        raise ConversionInterruptedException('Live raw data conversion of %s was interrupted by signal %d after %d '
+                                             'records.' % (nwb_path, stop_signals[0], num_appended))
+    if num_appended == 0:
+        raise UnexpectedInputException('No records were written to the CSC files in %s within %0.0f s.'
+                                       % (csc_directory.path, idle_timeout))
+    for data_path in data_paths:
+        num_records = check_num_records(data_path)
+        if num_records != num_appended:
+            raise UnexpectedInputException('%s has %d records but %d were appended. It was still being written after '
+                                           'appending ended.' % (data_path, num_records, num_appended))
+
+
+def _check_live_records(records, data_paths, previous_record_start):
+    """Check the records appended to each CSC file since the last poll and arrange their samples as (time, channel).
+
+    Returns the data, the start time of the last record and whether the last record is partial, which ends the files.
+    """
+    timestamps = list()
+    for channel_records in records:
+        num_samples = check_csc_records(channel_records)
+        timestamps.append(CscTimestamps(record_starts=channel_records['timestamp'],
+                                        rate=float(channel_records['sampling_frequency'][0]),
+                                        num_samples=num_samples))
+    check_csc_timestamps_aligned(timestamps, data_paths)
+
+    if previous_record_start is not None:
+        record_starts = np.concatenate([[previous_record_start], timestamps[0].record_starts])
+        continuity = CscTimestamps(record_starts=record_starts, rate=timestamps[0].rate,
+                                   num_samples=len(record_starts) * _CSC_SAMPLES_PER_RECORD)
+        if len(find_csc_segments(continuity)) > 1:
+            raise UnsupportedInputException('The recording in %s has a gap after Cheetah timestamp %d us, which is '
+                                            'not supported by live conversion. Convert the recording after it ends.'
+                                            % (data_paths[0].parent, previous_record_start))
+
+    num_samples = timestamps[0].num_samples
+    data = np.empty((num_samples, len(data_paths)), dtype=np.int16)
+    for j, channel_records in enumerate(records):
+        data[:, j] = channel_records['samples'].reshape(-1)[:num_samples]
+    closed = num_samples < len(records[0]) * _CSC_SAMPLES_PER_RECORD
+    return data, int(timestamps[0].record_starts[-1]), closed
+
+
+def _set_live_timing(series, record_starts, nominal_rate):
+    """Replace the nominal rate and starting time of a live ElectricalSeries by their fit to its record start times."""
+    rate, fit_start_time_us, residual_rms_us, residual_max_us = fit_csc_rate(record_starts, nominal_rate)
+    series['starting_time'][()] = (fit_start_time_us - float(record_starts[0])) / 1e6
+    series['starting_time'].attrs['rate'] = rate
+    series.attrs['comments'] = ('Recording converted live while Cheetah was writing the CSC files. The rate and '
+                                'starting time are a least-squares fit of the record start times (nominal rate %g Hz, '
+                                'fitted Cheetah time of the first sample %.3f us, residual RMS %.3f us, max %.3f us).'
+                                % (nominal_rate, fit_start_time_us, residual_rms_us, residual_max_us))
+
+
+def _save_journal(journal_path, journal):
+    """Write the progress journal atomically, so an interruption never leaves a partial journal."""
+    tmp_path = journal_path.with_suffix('.tmp')
+    with open(tmp_path, 'w') as journal_file:
+        json.dump(journal, journal_file)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(tmp_path, journal_path)
+
+
+def write_chunks_parallel(dataset, iterator, num_workers):
+    """Write the buffers of a data chunk iterator to a dataset, compressing chunks in parallel.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        Chunked dataset, optionally with the shuffle and gzip filters.
+    iterator : GenericDataChunkIterator
+        Iterator with the same shape as the dataset and buffers aligned to its chunks.
+    num_workers : int
+        Number of workers compressing chunks.
+
+    Raises
+    ------
+    InconsistentInputException
+        if the shape of the dataset does not match the iterator.
+    UnsupportedInputException
+        if the dataset is not chunked or uses filters other than shuffle and gzip.
+
+    """
+    compress_chunk = get_chunk_compressor(dataset)
+    if iterator.maxshape != dataset.shape:
+        raise InconsistentInputException('Dataset %s has shape %s but the source data have shape %s.'
+                                         % (dataset.name, dataset.shape, iterator.maxshape))
+
+    # bound the number of compressed chunks waiting to be written
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for buffer in iterator:
+            for chunk_offset, chunk_data in split_chunks(buffer.data, buffer.selection, dataset.chunks):
+                pending.append((chunk_offset, pool.submit(compress_chunk, chunk_data)))
+                while len(pending) > 2 * num_workers:
+                    chunk_offset, future = pending.popleft()
+                    dataset.id.write_direct_chunk(chunk_offset, future.result())
+        while pending:
+            chunk_offset, future = pending.popleft()
+            dataset.id.write_direct_chunk(chunk_offset, future.result())
+
+
+def split_chunks(data, selection, chunk_shape):
+    """Split a chunk-aligned block of data into full-size HDF5 chunks.
+
+    Parameters
+    ----------
+    data : np.array
+        The block of data.
+    selection : tuple of slice
+        Location of the block in the dataset. The start of each slice must be a multiple of the chunk shape.
+    chunk_shape : tuple
+        Shape of the HDF5 chunks.
+
+    Yields
+    ------
+    tuple
+        Offset of the chunk in the dataset and the chunk data. Edge chunks are padded with zeros, the default fill
+        value, to the full chunk shape.
+
+    """
+    starts = [s.start for s in selection]
+    for index in product(*[range(0, n, c) for n, c in zip(data.shape, chunk_shape)]):
+        block = data[tuple(slice(i, i + c) for i, c in zip(index, chunk_shape))]
+        if block.shape != tuple(chunk_shape):
+            padded = np.zeros(chunk_shape, dtype=data.dtype)
+            padded[tuple(slice(0, n) for n in block.shape)] = block
+            block = padded
+        yield tuple(s + i for s, i in zip(starts, index)), np.ascontiguousarray(block)
+
+
+def get_chunk_compressor(dataset):
+    """Get a function that compresses chunks the same way as the filter pipeline of a dataset.
+
+    Parameters
+    ----------
+    dataset : h5py.Dataset
+        A chunked dataset, optionally with the shuffle and gzip filters.
+
+    Returns
+    -------
+    function
+        Function taking a full-size chunk array and returning its filtered bytes.
+
+    Raises
+    ------
+    UnsupportedInputException
+        if the dataset is not chunked or uses filters other than shuffle and gzip.
+
+    """
+    if dataset.chunks is None:
+        raise UnsupportedInputException('Dataset %s must be chunked for direct chunk writes.' % dataset.name)
+    if dataset.compression not in (None, 'gzip') or dataset.fletcher32 or dataset.scaleoffset is not None:
+        raise UnsupportedInputException('Only the shuffle and gzip filters are supported for direct chunk writes: %s'
+                                        % dataset.name)
+    shuffle = dataset.shuffle
+    level = dataset.compression_opts if dataset.compression == 'gzip' else None
+    itemsize = dataset.dtype.itemsize
+
+    def compress_chunk(chunk_data):
+        chunk_bytes = chunk_data.tobytes()
+        if shuffle and itemsize > 1:
+            # the HDF5 shuffle filter groups the n-th byte of every element together
+            chunk_bytes = np.frombuffer(chunk_bytes, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+        if level is not None:
+            chunk_bytes = zlib.compress(chunk_bytes, level)
+        return chunk_bytes
+
+    return compress_chunk
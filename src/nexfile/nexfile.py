@@ -935,7 +935,7 @@ class NexWriter(object):
             return self._VarWriteTimestampsNumpy(var, timestamps)
         if self._BytesInTimestamp(var) == 4:
             tsTicks = [int(round(x * self.tsFreq)) for x in timestamps]
-            values = array.array('l', tsTicks)
+            values = array.array('i', tsTicks)
             values.tofile(self.theFile)
         else:
             for x in timestamps:
@@ -986,7 +986,7 @@ class NexWriter(object):
             return
         elif varType == NexFileVarType.CONTINUOUS:
             self._VarWriteTimestamps(var, var['Timestamps'])
-            values = array.array('l', var['FragmentIndexes'])
+            values = array.array('i', var['FragmentIndexes'])
             values.tofile(self.theFile)
             if self.useNumpy:
                 self._VarWriteContinuousValuesNumpy(var)
@@ -97,6 +97,36 @@ class NexWriter2(NexWriter):
 
         self.theFile.close()
 
+    def AddContVarWithMultipleFragments(self, name, timestamps, SamplingRate, fragmentValues):
+        """
+        Adds continuous variable with multiple fragments. Overwrites the original function in nexfile.py, which
+        converts numpy fragments to float64 values, to keep the int16 values of the fragments.
+        :param name: variable name
+        :param timestamps: numpy array of fragment start times in seconds
+        :param SamplingRate: sampling rate in Hz
+        :param fragmentValues: list of int16 numpy arrays, the values of each fragment
+        :return:
+        """
+        import numpy as np
+        assert(self.useNumpy)
+        self._VerifyIsNumpyArray('Timestamps', timestamps)
+        for fragment in fragmentValues:
+            self._VerifyIsNumpyArray('FragmentValues', fragment)
+        if SamplingRate <= 0 or SamplingRate > self.tsFreq:
+            raise ValueError('invalid sampling rate in continuous')
+        if len(timestamps) != len(fragmentValues):
+            raise ValueError('should be the same number of timestamps and fragments')
+        fragmentCounts = [len(fragment) for fragment in fragmentValues]
+        var = {'FragmentIndexes': [sum(fragmentCounts[:i]) for i in range(len(fragmentCounts))],
+               'FragmentCounts': fragmentCounts,
+               'ContinuousValues': np.concatenate(fragmentValues)}
+        vhValues = [NexFileVarType.CONTINUOUS, 100, name, 0, 1, 0, 0, 0, 0, 0, 0, SamplingRate, 1.0,
+                    sum(fragmentCounts), 0, 0, 0, 0, '']
+        var['Header'] = dict(zip(self.varHeaderKeys, vhValues))
+        self._AddNex5VarHeaderFields(var)
+        var['Timestamps'] = timestamps
+        self.fileData['Variables'].append(var)
+
     def _VarWriteContinuousValuesNumpy(self, var):
         """
         Writes continuous data to file. Only use this code if passing in int16 and a conversion factor. Overwrites the
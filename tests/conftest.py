@@ -0,0 +1,106 @@
+import h5py
+import numpy as np
+import pytest
+
+from buffalonwb.add_raw_nlx_data import _CSC_HEADER_SIZE, _CSC_RECORD_DTYPE, _CSC_SAMPLES_PER_RECORD
+
+_CSC_HEADER = """######## Neuralynx Data File Header
+## File Name C:\\CheetahData\\CSC{channel}.ncs
+-FileType CSC
+-FileVersion 3.4
+-FileUUID 0f1d2d7e-8b1a-4c5c-9d4e-0a1b2c3d4e5f
+-SessionUUID 1f1d2d7e-8b1a-4c5c-9d4e-0a1b2c3d4e5f
+-ProbeName
+-OriginalFileName "C:\\CheetahData\\CSC{channel}.ncs"
+-TimeCreated 2017/04/27 11:41:21
+-TimeClosed 2017/04/27 13:41:21
+-RecordSize 1044
+-ApplicationName Cheetah "6.3.2 Development"
+-AcquisitionSystem AcqSystem1 DigitalLynxSX
+-ReferenceChannel "Source 01 Reference 3"
+-SamplingFrequency 32000
+-ADMaxValue 32767
+-ADBitVolts 0.000000015624999999999999
+-AcqEntName CSC{channel}
+-NumADChannels 1
+-ADChannel {channel}
+-InputRange 500
+-InputInverted True
+-DSPLowCutFilterEnabled True
+-DspLowCutFrequency 0.1
+-DspLowCutNumTaps 0
+-DspLowCutFilterType DCO
+-DSPHighCutFilterEnabled True
+-DspHighCutFrequency 9000
+-DspHighCutNumTaps 64
+-DspHighCutFilterType FIR
+-DspDelayCompensation Enabled
+-DspFilterDelay_\xb5s 1984
+"""
+
+
+def write_csc_files(path, num_channels=4, num_records=100, last_valid_samples=300, gap_record=None, gap_us=0,
+                    seed=0):
+    """Write synthetic CSC files CSC1.ncs, CSC2.ncs, ... sampled at 32000 Hz, and return their samples."""
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    record_starts = 1000000 + (np.arange(num_records) * _CSC_SAMPLES_PER_RECORD * 1e6 / 32000).astype(np.uint64)
+    record_starts += (np.arange(num_records) // 156).astype(np.uint64)  # 1 us drift every ~156 records
+    if gap_record is not None:
+        record_starts[gap_record:] += np.uint64(gap_us)
+
+    num_samples = (num_records - 1) * _CSC_SAMPLES_PER_RECORD + last_valid_samples
+    samples = np.empty((num_samples, num_channels), dtype=np.int16)
+    for channel in range(num_channels):
+        records = np.zeros(num_records, dtype=_CSC_RECORD_DTYPE)
+        records['timestamp'] = record_starts
+        records['channel_number'] = channel
+        records['sampling_frequency'] = 32000
+        records['num_valid_samples'] = _CSC_SAMPLES_PER_RECORD
+        records['num_valid_samples'][-1] = last_valid_samples
+        records['samples'] = rng.integers(-3000, 3000, (num_records, _CSC_SAMPLES_PER_RECORD), dtype=np.int16)
+        samples[:, channel] = records['samples'].reshape(-1)[:num_samples]
+
+        header = _CSC_HEADER.format(channel=channel + 1).encode('latin-1')
+        with open(path / ('CSC%d.ncs' % (channel + 1)), 'wb') as csc_file:
+            csc_file.write(header.ljust(_CSC_HEADER_SIZE, b'\x00'))
+            records.tofile(csc_file)
+    return samples
+
+
+@pytest.fixture
+def csc_files():
+    """Function writing synthetic CSC files to a directory, see write_csc_files."""
+    return write_csc_files
+
+
+def write_lfp_files(path, channels=(1, 2, 4), num_samples=5000, num_spikes=50, seed=0):
+    """Write synthetic processed files CSC1_ex.mat, CSC2_ex.mat, ... (MATLAB v7.3) with a 1000 Hz LFP, and return the
+    LFP of the channels as a (samples, channels) array."""
+    path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    lfp = rng.standard_normal((num_samples, len(channels))) * 100 * np.array(channels)
+    for j, channel in enumerate(channels):
+        name = 'CSC%d' % channel
+        with h5py.File(path / (name + '_ex.mat'), 'w') as mat_file:
+            # MATLAB stores strings as character codes and arrays transposed
+            for field, value in (('chname', name), ('extractMethod', 'spikes'), ('filename', name + '.ncs'),
+                                 ('foldername', str(path))):
+                mat_file[field] = np.array([[ord(c)] for c in value], dtype=np.uint16)
+            mat_file['Fs'] = [[32000.]]
+            mat_file['firstts'] = [[1e6]]
+            mat_file['lfpfq'] = [[1000.]]
+            mat_file['lfp'] = lfp[np.newaxis, :, j]
+            mat_file['lfpts'] = 1. + np.arange(num_samples)[np.newaxis, :] / 1000.
+            mat_file['spkts'] = np.sort(rng.random((1, num_spikes)))
+            mat_file['spkwv'] = rng.standard_normal((32, num_spikes))
+            for field, value in dict(lfpfq=1000., n_std=4., rawspk=0., resamp=1., saveupsamp=0., spkfq=400.).items():
+                mat_file['params/' + field] = [[value]]
+            mat_file['params/spkbuff'] = [[8.], [23.]]
+    return lfp
+
+
+@pytest.fixture
+def lfp_files():
+    """Function writing synthetic processed files to a directory, see write_lfp_files."""
+    return write_lfp_files
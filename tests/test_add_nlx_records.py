@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from buffalonwb.add_nlx_records import _NEV_RECORD_DTYPE, _NTT_RECORD_DTYPE, _NVT_RECORD_DTYPE, read_nlx_file
+from buffalonwb.add_raw_nlx_data import _CSC_HEADER_SIZE
+from buffalonwb.exceptions import UnexpectedInputException
+
+
+@pytest.mark.parametrize('extension, file_type, record_dtype, record_size', [
+    ('.nev', 'Event', _NEV_RECORD_DTYPE, 184),
+    ('.nvt', 'Video', _NVT_RECORD_DTYPE, 1828),
+    ('.ntt', 'Spike', _NTT_RECORD_DTYPE, 304),
+])
+def test_read_nlx_file_round_trip(tmp_path, extension, file_type, record_dtype, record_size):
+    assert record_dtype.itemsize == record_size
+    rng = np.random.default_rng(0)
+    records = np.frombuffer(rng.bytes(20 * record_size), dtype=record_dtype).copy()
+    records['timestamp'] = 1000000 + np.arange(20) * 1000
+
+    file_path = tmp_path / ('data' + extension)
+    header = '######## Neuralynx Data File Header\n-FileType %s\n-RecordSize %d\n' % (file_type, record_size)
+    with open(file_path, 'wb') as data_file:
+        data_file.write(header.encode('latin-1').ljust(_CSC_HEADER_SIZE, b'\x00'))
+        records.tofile(data_file)
+        data_file.write(records[:1].tobytes()[:record_size // 2])  # partially written next record
+
+    with pytest.raises(UnexpectedInputException):
+        read_nlx_file(file_path)
+    read_header, read_records = read_nlx_file(file_path, allow_partial=True)
+    assert read_header['FileType'] == file_type and read_header['RecordSize'] == record_size
+    assert read_records.tobytes() == records.tobytes()
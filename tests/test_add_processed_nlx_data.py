@@ -0,0 +1,117 @@
+import shutil
+from datetime import datetime, timezone
+
+import h5py
+import numpy as np
+import pytest
+from pynwb import NWBFile
+
+from buffalonwb.add_processed_nlx_data import (LfpDataChunkIterator, LfpDirectory, MH_process_nlx_mat_file, NlxMatFile,
+                                               add_lfp, convert_lfp, get_lfp_data, get_lfp_scales, read_lfp_channels)
+from buffalonwb.conversion_module import add_electrodes
+from buffalonwb.exceptions import InconsistentInputException
+
+
+def _add_lfp(lfp_path, electrode_labels, **kwargs):
+    nwbfile = NWBFile(session_description='test', identifier='test', session_start_time=datetime.now(timezone.utc))
+    electrode_table_region = add_electrodes(
+        nwbfile=nwbfile,
+        metadata_ecephys=dict(ElectrodeGroup=[dict(name='group', description='group', location='hippocampus',
+                                                   device='device')]),
+        num_electrodes=len(electrode_labels),
+        electrode_labels=electrode_labels
+    )
+    add_lfp(nwbfile=nwbfile, lfp_path=lfp_path, electrodes=electrode_table_region,
+            all_electrode_labels=electrode_labels, **kwargs)
+    return nwbfile.processing['ecephys']['LFP']['ElectricalSeries']
+
+
+def test_nlx_mat_file_reads_fields_lazily(tmp_path, lfp_files):
+    lfp = lfp_files(tmp_path / 'mat', channels=(3, ))
+    with NlxMatFile(tmp_path / 'mat' / 'CSC3_ex.mat') as nlx_file:
+        assert nlx_file.get_string('chname') == 'CSC3'
+        assert nlx_file.get_scalar('lfpfq') == 1000.
+        assert nlx_file.get_scalar('params/n_std') == 4.
+        np.testing.assert_array_equal(nlx_file.read_lfp(), lfp[:, 0])
+        np.testing.assert_array_equal(nlx_file.read_lfp(1000, 1500), lfp[1000:1500, 0])
+
+    fields = MH_process_nlx_mat_file(tmp_path / 'mat' / 'CSC3_ex.mat', fields=('lfp_Fs', 'first_lfp_ts', 'spk_buff'))
+    assert fields == dict(lfp_Fs=1000., first_lfp_ts=pytest.approx(1.), spk_buff=[8., 23.])
+
+
+def test_lfp_directory_maps_files_by_channel_name(tmp_path, lfp_files):
+    lfp = lfp_files(tmp_path / 'mat', channels=(1, 2, 4))
+    # the files are mapped by the chname field, not by their file names
+    (tmp_path / 'mat' / 'CSC4_ex.mat').rename(tmp_path / 'mat' / 'tetrode_ex.mat')
+    lfp_directory = LfpDirectory(tmp_path / 'mat')
+    assert lfp_directory.get_data_path('CSC4') == tmp_path / 'mat' / 'tetrode_ex.mat'
+    assert lfp_directory.get_data_path('CSC3') is None
+    assert lfp_directory.num_samples == len(lfp) and lfp_directory.rate == 1000.
+
+    series = _add_lfp(tmp_path / 'mat', ['CSC1', 'CSC2', 'CSC3', 'CSC4'], iterator_flag=False)
+    assert list(series.electrodes.data) == [0, 1, 3]
+    np.testing.assert_array_equal(series.data, lfp)
+
+    shutil.copy(tmp_path / 'mat' / 'CSC1_ex.mat', tmp_path / 'mat' / 'CSC1_copy_ex.mat')
+    with pytest.raises(InconsistentInputException):
+        LfpDirectory(tmp_path / 'mat')
+
+
+@pytest.mark.parametrize('scaling', ['global', 'channel'])
+def test_int16_lfp_error_is_within_one_scale_step(tmp_path, lfp_files, scaling):
+    lfp = lfp_files(tmp_path / 'mat', channels=(1, 2, 4))
+    lfp_directory = LfpDirectory(tmp_path / 'mat')
+    channel_names = ['CSC1', 'CSC2', 'CSC4']
+    scales = get_lfp_scales(lfp_directory, channel_names, scaling=scaling, block_size=700)
+    if scaling == 'global':
+        assert np.all(scales == np.abs(lfp).max() / 32767)
+    else:
+        np.testing.assert_array_equal(scales, np.abs(lfp).max(axis=0) / 32767)
+
+    for j, channel_name in enumerate(channel_names):
+        with NlxMatFile(lfp_directory.get_data_path(channel_name)) as nlx_file:
+            converted = convert_lfp(nlx_file.read_lfp(), 'int16', scales[j])
+        assert converted.dtype == np.int16
+        assert np.abs(converted * scales[j] - lfp[:, j]).max() <= scales[j]
+
+
+def test_int16_lfp_stores_nan_as_zero(tmp_path, lfp_files):
+    lfp = lfp_files(tmp_path / 'mat', channels=(1, 2))
+    with h5py.File(tmp_path / 'mat' / 'CSC2_ex.mat', 'r+') as mat_file:
+        mat_file['lfp'][0, 10:20] = np.nan
+    with pytest.warns(UserWarning, match='10 NaN values'):
+        series = _add_lfp(tmp_path / 'mat', ['CSC1', 'CSC2'], iterator_flag=False, dtype='int16')
+    assert 'stored as 0' in series.comments
+    data = np.asarray(series.data)
+    assert np.all(data[10:20, 1] == 0)
+    assert np.abs(data[:, 0] * series.conversion - lfp[:, 0]).max() <= series.conversion
+
+
+def test_parallel_lfp_channels_are_read_in_order(tmp_path, lfp_files):
+    lfp = lfp_files(tmp_path / 'mat', channels=(1, 2, 3, 4, 5))
+    lfp_directory = LfpDirectory(tmp_path / 'mat')
+    channel_names = ['CSC4', 'CSC1', 'CSC5', 'CSC2', 'CSC3']
+    sequential = list(read_lfp_channels(lfp_directory, channel_names, dtype='float32'))
+    parallel = list(read_lfp_channels(lfp_directory, channel_names, dtype='float32', num_workers=2))
+    assert len(parallel) == len(channel_names)
+    for channel_name, sequential_channel, parallel_channel in zip(channel_names, sequential, parallel):
+        np.testing.assert_array_equal(parallel_channel, sequential_channel)
+        np.testing.assert_array_equal(parallel_channel, lfp[:, int(channel_name[3:]) - 1].astype(np.float32))
+
+
+@pytest.mark.parametrize('num_workers', [None, 2])
+def test_lfp_iterator_matches_lfp_data(tmp_path, lfp_files, num_workers):
+    lfp_files(tmp_path / 'mat', channels=(1, 2, 4), num_samples=20000)
+    lfp_directory = LfpDirectory(tmp_path / 'mat')
+    channel_names = ['CSC1', 'CSC2', 'CSC4']
+    scales = get_lfp_scales(lfp_directory, channel_names, scaling='channel')
+    iterator = LfpDataChunkIterator(lfp_directory=lfp_directory, channel_names=channel_names, dtype='int16',
+                                    scales=scales, buffer_mb=0.02, chunk_shape=(1000, 3), display_progress=False,
+                                    num_workers=num_workers)
+    data = np.empty(iterator.maxshape, dtype=iterator.dtype)
+    num_buffers = 0
+    for buffer in iterator:
+        data[buffer.selection] = buffer.data
+        num_buffers += 1
+    assert num_buffers > 1
+    np.testing.assert_array_equal(data, get_lfp_data(lfp_directory, channel_names, dtype='int16', scales=scales))
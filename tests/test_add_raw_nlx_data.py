@@ -0,0 +1,173 @@
+from functools import partial
+
+import numpy as np
+import pytest
+
+from buffalonwb import add_raw_nlx_data
+from buffalonwb.add_raw_nlx_data import (CscDataChunkIterator, CscDirectory, CscTransposeDataChunkIterator,
+                                         fit_csc_rate, get_raw_segments)
+from buffalonwb.csc_index_cache import CscIndexCache
+
+
+def _read_segment(csc_directory, segment):
+    start_sample, num_samples = int(segment['start_sample']), int(segment['num_samples'])
+    channel_indices = list(range(len(csc_directory)))
+    iterator = CscDataChunkIterator(data_paths=csc_directory.data_paths, buffer_mb=0.1, chunk_shape=(1024, 4),
+                                    display_progress=False, start_sample=start_sample, num_samples=num_samples,
+                                    num_records=csc_directory.num_records,
+                                    validated=csc_directory.is_validated(channel_indices),
+                                    on_checked=partial(csc_directory.add_checked_samples, channel_indices,
+                                                       start_sample, num_samples))
+    data = np.empty(iterator.maxshape, dtype=np.int16)
+    for chunk in iterator:
+        data[chunk.selection] = chunk.data
+    return data
+
+
+def _count_calls(monkeypatch, counts):
+    for function_name in ('index_csc_file', 'check_csc_records', 'find_csc_segments'):
+        function = getattr(add_raw_nlx_data, function_name)
+
+        def counted(*args, function=function, function_name=function_name, **kwargs):
+            counts[function_name] += 1
+            return function(*args, **kwargs)
+        monkeypatch.setattr(add_raw_nlx_data, function_name, counted)
+
+    check_block = CscDataChunkIterator._check_block
+
+    def counted_check_block(self, *args):
+        counts['_check_block'] += 1
+        return check_block(self, *args)
+    monkeypatch.setattr(CscDataChunkIterator, '_check_block', counted_check_block)
+
+
+def test_first_run_fills_index_cache(tmp_path, monkeypatch, csc_files):
+    csc_files(tmp_path / 'csc', num_records=100)
+    index_cache = CscIndexCache(tmp_path / 'cache')
+    counts = dict(index_csc_file=0, check_csc_records=0, find_csc_segments=0, _check_block=0)
+    _count_calls(monkeypatch, counts)
+
+    csc_directory = CscDirectory(tmp_path / 'csc', index_cache=index_cache)
+    assert counts['index_csc_file'] == 0
+    assert not csc_directory.is_validated()
+
+    segments, _ = get_raw_segments(csc_directory)
+    _read_segment(csc_directory, segments[0])
+    # only the first file is indexed by reading it again, for its segments
+    assert counts['index_csc_file'] == 1 and counts['check_csc_records'] == 1
+    assert counts['_check_block'] > 0
+    assert csc_directory.is_validated()
+
+    monkeypatch.undo()
+    for data_path in csc_directory.data_paths:
+        cached_index = index_cache.get(data_path)
+        index = add_raw_nlx_data.index_csc_file(data_path)
+        np.testing.assert_array_equal(cached_index.pop('segments'), index.pop('segments'))
+        assert cached_index == index
+
+
+def test_partial_run_does_not_fill_index_cache(tmp_path, csc_files):
+    csc_files(tmp_path / 'csc', num_records=100)
+    index_cache = CscIndexCache(tmp_path / 'cache')
+    csc_directory = CscDirectory(tmp_path / 'csc', index_cache=index_cache)
+    segments, _ = get_raw_segments(csc_directory, (0.2, 0.9))
+    _read_segment(csc_directory, segments[0])
+    assert not csc_directory.is_validated()
+    assert index_cache.get(csc_directory.data_paths[1]) is None
+
+
+@pytest.mark.parametrize('time_range', [None, (0.2, 0.9)])
+def test_repeated_conversion_skips_validation(tmp_path, monkeypatch, csc_files, time_range):
+    samples = csc_files(tmp_path / 'csc', num_records=100)
+    index_cache = CscIndexCache(tmp_path / 'cache')
+
+    csc_directory = CscDirectory(tmp_path / 'csc', index_cache=index_cache)
+    segments, _ = get_raw_segments(csc_directory)
+    _read_segment(csc_directory, segments[0])
+    segments, _ = get_raw_segments(csc_directory, time_range)
+    first_data = _read_segment(csc_directory, segments[0])
+
+    counts = dict(index_csc_file=0, check_csc_records=0, find_csc_segments=0, _check_block=0)
+    _count_calls(monkeypatch, counts)
+    csc_directory = CscDirectory(tmp_path / 'csc', index_cache=index_cache)
+    assert csc_directory.is_validated()
+    second_segments, _ = get_raw_segments(csc_directory, time_range)
+    second_data = _read_segment(csc_directory, second_segments[0])
+
+    assert counts == dict(index_csc_file=0, check_csc_records=0, find_csc_segments=0, _check_block=0)
+    np.testing.assert_array_equal(second_segments, segments)
+    np.testing.assert_array_equal(second_data, first_data)
+    start = int(segments['start_sample'][0])
+    np.testing.assert_array_equal(second_data, samples[start:start + len(second_data)])
+
+
+def test_time_window_keeps_segment_fit(tmp_path, csc_files):
+    csc_files(tmp_path / 'csc', num_records=400, gap_record=250, gap_us=100000)
+    csc_directory = CscDirectory(tmp_path / 'csc')
+    whole_segments, whole_starting_times = get_raw_segments(csc_directory)
+    assert len(whole_segments) == 2
+
+    segments, starting_times = get_raw_segments(csc_directory, (0.1, 5.))
+    assert len(segments) == 2
+    np.testing.assert_array_equal(segments['rate'], whole_segments['rate'])
+    start_sample = int(segments['start_sample'][0])
+    assert start_sample == int(np.ceil(0.1 * 32000))
+    assert starting_times[0] == pytest.approx(whole_starting_times[0] + start_sample / whole_segments['rate'][0])
+    assert starting_times[1] == whole_starting_times[1]
+    assert segments['start_sample'][1] == whole_segments['start_sample'][1]
+    assert segments['start_sample'][1] + segments['num_samples'][1] < whole_segments['num_samples'].sum()
+
+
+def test_transpose_iterator_closes_scratch_file(tmp_path, csc_files):
+    samples = csc_files(tmp_path / 'csc', num_records=20)
+    csc_directory = CscDirectory(tmp_path / 'csc')
+    iterator = CscTransposeDataChunkIterator(data_paths=csc_directory.data_paths, buffer_mb=0.1,
+                                             chunk_shape=(1024, 4), display_progress=False, scratch_dir=tmp_path)
+    data = np.empty(iterator.maxshape, dtype=np.int16)
+    for chunk in iterator:
+        data[chunk.selection] = chunk.data
+    np.testing.assert_array_equal(data, samples)
+    assert iterator._scratch_file is None
+
+
+def test_time_window_reads_only_window_records(tmp_path, monkeypatch, csc_files):
+    samples = csc_files(tmp_path / 'csc', num_records=1000, gap_record=600, gap_us=100000)
+    csc_directory = CscDirectory(tmp_path / 'csc')
+    counts = dict(index_csc_file=0, check_csc_records=0, find_csc_segments=0, _check_block=0)
+    _count_calls(monkeypatch, counts)
+    reads = []
+    read_csc_records_at = add_raw_nlx_data.read_csc_records_at
+
+    def counted_read(csc_file_path, start_record, num_records):
+        reads.append((start_record, num_records))
+        return read_csc_records_at(csc_file_path, start_record, num_records)
+    monkeypatch.setattr(add_raw_nlx_data, 'read_csc_records_at', counted_read)
+
+    segments, _ = get_raw_segments(csc_directory, (9., 11.))
+    assert counts['index_csc_file'] == 0 and counts['check_csc_records'] == 0
+    assert len(segments) == 2 and segments['start_sample'][1] == 600 * 512
+
+    first_record = int(segments['start_sample'][0]) // 512
+    last_record = -(-int(segments['start_sample'][1] + segments['num_samples'][1]) // 512)
+    outside_reads = [(start, num) for start, num in reads if start < first_record or start + num > last_record]
+    # the first and last record of the file, and for each end of the window the records of the binary search
+    assert all(num == 1 for _, num in outside_reads)
+    num_probes = 2 + 2 * (int(np.ceil(np.log2(1000))) + 1)
+    assert len(outside_reads) <= num_probes
+    assert sum(num for _, num in reads) <= last_record - first_record + num_probes
+
+    monkeypatch.undo()
+    data = np.concatenate([_read_segment(csc_directory, segment) for segment in segments])
+    start = int(segments['start_sample'][0])
+    np.testing.assert_array_equal(data, samples[start:start + len(data)])
+
+
+def test_fit_csc_rate_recovers_actual_rate():
+    rate = 32000.012966
+    # Cheetah rounds the start time of each record to the microsecond
+    record_starts = np.round(5e9 + 0.4 + np.arange(100000) * 512 * 1e6 / rate).astype(np.uint64)
+    fitted_rate, fit_start_time_us, residual_rms_us, residual_max_us = fit_csc_rate(record_starts, 32000.)
+    assert fitted_rate == pytest.approx(rate, abs=1e-6)
+    assert fit_start_time_us == pytest.approx(5e9 + 0.4, abs=0.01)
+    assert residual_rms_us == pytest.approx(1 / np.sqrt(12), rel=0.05)
+    assert residual_max_us < 0.51
@@ -0,0 +1,16 @@
+import numpy as np
+from scipy.signal import decimate
+
+from buffalonwb.raw_preview import StreamingDecimator
+
+
+def test_streaming_decimator_matches_scipy_decimate():
+    rng = np.random.default_rng(0)
+    signal = rng.integers(-3000, 3000, (50000, 3)).astype(np.int16)
+    decimator = StreamingDecimator(factor=8, num_channels=3, piece_size=1000)
+    block_stops = np.append(np.sort(rng.integers(0, len(signal), 20)), len(signal))
+    outputs = [decimator.process(signal[start:stop]) for start, stop in zip(np.append(0, block_stops), block_stops)]
+    outputs.append(decimator.flush())
+
+    expected = decimate(signal.astype(np.float64), 8, ftype='fir', axis=0)
+    np.testing.assert_allclose(np.concatenate(outputs), expected, rtol=0, atol=1e-2)
@@ -0,0 +1,28 @@
+import h5py
+
+from buffalonwb.extras.verify_raw_nwb import verify_raw_nwb, verify_raw_nwb_digest
+
+
+def _write_raw_nwb(nwb_path, samples):
+    with h5py.File(nwb_path, 'w') as nwb_file:
+        nwb_file.create_dataset('acquisition/ElectricalSeries/data', data=samples, chunks=(4096, samples.shape[1]))
+
+
+def test_verify_raw_nwb_matches(tmp_path, csc_files):
+    samples = csc_files(tmp_path / 'csc', num_records=40)
+    _write_raw_nwb(tmp_path / 'raw.nwb', samples)
+
+    assert verify_raw_nwb(tmp_path / 'raw.nwb', tmp_path / 'csc', num_workers=1, buffer_mb=0.1) is None
+    assert verify_raw_nwb_digest(tmp_path / 'raw.nwb', num_workers=1) is None
+
+
+def test_verify_raw_nwb_reports_earliest_mismatch(tmp_path, csc_files):
+    samples = csc_files(tmp_path / 'csc', num_records=40)
+    samples[7000, 0] += 1  # CSC1
+    samples[5000, 2] += 1  # CSC3
+    _write_raw_nwb(tmp_path / 'raw.nwb', samples)
+
+    mismatch = verify_raw_nwb(tmp_path / 'raw.nwb', tmp_path / 'csc', num_workers=1, buffer_mb=1.)
+    assert mismatch == dict(series='ElectricalSeries', channel='CSC3', sample=5000, expected=int(samples[5000, 2]) - 1,
+                            actual=int(samples[5000, 2]))
+    assert not (tmp_path / 'raw.nwb.digest.json').exists()
@@ -0,0 +1,143 @@
+import os
+import signal
+from datetime import datetime, timezone
+
+import h5py
+import numpy as np
+import pytest
+from pynwb import NWBHDF5IO, NWBFile
+
+from buffalonwb import write_raw_nlx_data
+from buffalonwb.add_raw_nlx_data import (_CSC_HEADER_SIZE, _CSC_RECORD_SIZE, CscDataChunkIterator, CscDirectory,
+                                         add_raw_nlx_data, get_raw_segments)
+from buffalonwb.conversion_module import add_electrodes
+from buffalonwb.exceptions import ConversionInterruptedException
+from buffalonwb.write_raw_nlx_data import (get_raw_journal_path, get_raw_part_path, write_chunks_parallel,
+                                           write_raw_nlx_data_live, write_raw_nlx_data_parts,
+                                           write_raw_nlx_data_resumable)
+
+
+def _write_raw_nwb(nwb_path, csc_directory, **kwargs):
+    nwbfile = NWBFile(session_description='test', identifier='test', session_start_time=datetime.now(timezone.utc))
+    electrode_table_region = add_electrodes(
+        nwbfile=nwbfile,
+        metadata_ecephys=dict(ElectrodeGroup=[dict(name='group', description='group', location='hippocampus',
+                                                   device='device')]),
+        num_electrodes=len(csc_directory),
+        electrode_labels=csc_directory.electrode_labels
+    )
+    add_raw_nlx_data(nwbfile=nwbfile, raw_nlx_path=csc_directory.path, electrode_table_region=electrode_table_region,
+                     csc_directory=csc_directory, **kwargs)
+    with NWBHDF5IO(str(nwb_path), mode='w') as io:
+        io.write(nwbfile)
+
+
+def _read_chunks(dataset):
+    chunks = dict()
+    for i in range(dataset.id.get_num_chunks()):
+        chunk_offset = dataset.id.get_chunk_info(i).chunk_offset
+        chunks[chunk_offset] = dataset.id.read_direct_chunk(chunk_offset)
+    return chunks
+
+
+def test_parallel_chunks_match_filter_pipeline(tmp_path, csc_files):
+    samples = csc_files(tmp_path / 'csc', num_records=50)
+    csc_directory = CscDirectory(tmp_path / 'csc')
+    dataset_options = dict(shape=samples.shape, dtype=np.int16, chunks=(3000, 2), compression='gzip',
+                           compression_opts=4, shuffle=True)
+    with h5py.File(tmp_path / 'raw.h5', 'w') as h5_file:
+        pipeline_dataset = h5_file.create_dataset('pipeline', **dataset_options)
+        pipeline_dataset[()] = samples
+        direct_dataset = h5_file.create_dataset('direct', **dataset_options)
+        iterator = CscDataChunkIterator(data_paths=csc_directory.data_paths, buffer_mb=0.1,
+                                        chunk_shape=direct_dataset.chunks, display_progress=False,
+                                        num_records=csc_directory.num_records)
+        write_chunks_parallel(direct_dataset, iterator, num_workers=3)
+
+        np.testing.assert_array_equal(direct_dataset[()], samples)
+        assert _read_chunks(direct_dataset) == _read_chunks(pipeline_dataset)
+
+
+def test_resumed_conversion_matches_uninterrupted(tmp_path, monkeypatch, csc_files):
+    csc_files(tmp_path / 'csc', num_records=100)
+    csc_directory = CscDirectory(tmp_path / 'csc')
+    for nwb_path in (tmp_path / 'uninterrupted.nwb', tmp_path / 'resumed.nwb'):
+        _write_raw_nwb(nwb_path, csc_directory, preallocate=True, chunk_shape=(1024, 4))
+    write_raw_nlx_data_resumable(tmp_path / 'uninterrupted.nwb', csc_directory.path, buffer_mb=0.05,
+                                 csc_directory=csc_directory)
+
+    # interrupt the first conversion by SIGINT while its third block is read
+    get_block = CscDataChunkIterator.get_block
+    block_starts = list()
+    interrupted = list()
+
+    def interrupted_get_block(self, start, stop):
+        block_starts.append(start)
+        if len(block_starts) == 3 and not interrupted:
+            interrupted.append(start)
+            os.kill(os.getpid(), signal.SIGINT)
+        return get_block(self, start, stop)
+    monkeypatch.setattr(CscDataChunkIterator, 'get_block', interrupted_get_block)
+    with pytest.raises(ConversionInterruptedException):
+        write_raw_nlx_data_resumable(tmp_path / 'resumed.nwb', csc_directory.path, buffer_mb=0.05,
+                                     csc_directory=csc_directory)
+    assert get_raw_journal_path(tmp_path / 'resumed.nwb').exists()
+
+    # the interrupted block is completed before stopping, so the resumed conversion starts at the next one
+    block_starts.clear()
+    write_raw_nlx_data_resumable(tmp_path / 'resumed.nwb', csc_directory.path, buffer_mb=0.05,
+                                 csc_directory=csc_directory)
+    assert block_starts[0] > interrupted[0]
+    assert not get_raw_journal_path(tmp_path / 'resumed.nwb').exists()
+
+    with h5py.File(tmp_path / 'uninterrupted.nwb', 'r') as uninterrupted, \
+            h5py.File(tmp_path / 'resumed.nwb', 'r') as resumed:
+        np.testing.assert_array_equal(resumed['acquisition/ElectricalSeries/data'][()],
+                                      uninterrupted['acquisition/ElectricalSeries/data'][()])
+
+
+def test_parts_are_joined_by_virtual_datasets(tmp_path, csc_files):
+    samples = csc_files(tmp_path / 'csc', num_channels=5, num_records=100, gap_record=60, gap_us=100000)
+    csc_directory = CscDirectory(tmp_path / 'csc')
+    _write_raw_nwb(tmp_path / 'raw.nwb', csc_directory, preallocate=True, chunk_shape=(1024, 5))
+    write_raw_nlx_data_parts(tmp_path / 'raw.nwb', csc_directory.path, num_parts=3, buffer_mb=0.05,
+                             chunk_shape=(1024, 5), compression='gzip', csc_directory=csc_directory)
+    assert all(get_raw_part_path(tmp_path / 'raw.nwb', part_index).exists() for part_index in range(3))
+
+    with NWBHDF5IO(str(tmp_path / 'raw.nwb'), mode='r') as io:
+        nwbfile = io.read()
+        segments = [nwbfile.acquisition[name].data for name in ('ElectricalSeries', 'ElectricalSeriesSegment1')]
+        assert all(data.is_virtual for data in segments)
+        np.testing.assert_array_equal(segments[0][()], samples[:60 * 512])
+        np.testing.assert_array_equal(segments[1][()], samples[60 * 512:])
+
+
+def test_live_conversion_appends_growing_files(tmp_path, monkeypatch, csc_files):
+    samples = csc_files(tmp_path / 'full', num_records=100)
+    full_directory = CscDirectory(tmp_path / 'full')
+    (tmp_path / 'csc').mkdir()
+    file_bytes = [data_path.read_bytes() for data_path in full_directory.data_paths]
+    data_paths = [tmp_path / 'csc' / data_path.name for data_path in full_directory.data_paths]
+    # Cheetah is writing the 31st record
+    written = [_CSC_HEADER_SIZE + 30 * _CSC_RECORD_SIZE + _CSC_RECORD_SIZE // 2]
+    for data_path, full_bytes in zip(data_paths, file_bytes):
+        data_path.write_bytes(full_bytes[:written[0]])
+
+    def record_between_polls(poll_interval):
+        for data_path, full_bytes in zip(data_paths, file_bytes):
+            with open(data_path, 'ab') as csc_file:
+                csc_file.write(full_bytes[written[0]:written[0] + 7 * _CSC_RECORD_SIZE])
+        written[0] += 7 * _CSC_RECORD_SIZE
+    monkeypatch.setattr(write_raw_nlx_data.time, 'sleep', record_between_polls)
+
+    csc_directory = CscDirectory(tmp_path / 'csc', allow_partial_records=True)
+    _write_raw_nwb(tmp_path / 'raw.nwb', csc_directory, live=True, chunk_shape=(1024, 4))
+    write_raw_nlx_data_live(tmp_path / 'raw.nwb', csc_directory.path, poll_interval=0., idle_timeout=10.,
+                            buffer_mb=0.05, csc_directory=csc_directory)
+
+    segments, starting_times = get_raw_segments(full_directory)
+    with NWBHDF5IO(str(tmp_path / 'raw.nwb'), mode='r') as io:
+        series = io.read().acquisition['ElectricalSeries']
+        np.testing.assert_array_equal(series.data[()], samples)
+        assert series.rate == pytest.approx(segments['rate'][0], rel=1e-12)
+        assert series.starting_time == pytest.approx(starting_times[0], abs=1e-9)